@@ -182,6 +182,25 @@ class ImageItem(Item):
         tileMimeType = tileSource.getTileMimeType()
         return tileData, tileMimeType
 
+    def getCompositeTile(self, item, x, y, z, channels, **kwargs):
+        """
+        Get a tile that blends several frames into one color image.
+
+        :param item: the item with the large image.
+        :param x: the x tile location.
+        :param y: the y tile location.
+        :param z: the tile level.
+        :param channels: a list of channel dictionaries.  See the tile
+            source's getCompositeTile.
+        :returns: the tile data and mime type.
+        """
+        tileSource = self._loadTileSource(item, **kwargs)
+        if not hasattr(tileSource, 'getCompositeTile'):
+            raise TileSourceException('This image does not support composite tiles.')
+        tileData = tileSource.getCompositeTile(x, y, z, channels)
+        tileMimeType = tileSource.getTileMimeType()
+        return tileData, tileMimeType
+
     def delete(self, item, skipFileIds=None):
         deleted = False
         if 'largeImage' in item:
@@ -216,6 +216,7 @@ class LargeImageResource(Resource):
         self.resourceName = 'large_image'
         self.route('GET', ('cache', ), self.cacheInfo)
         self.route('PUT', ('cache', 'clear'), self.cacheClear)
+        self.route('GET', ('cache', 'methods'), self.cacheMethodsInfo)
         self.route('GET', ('settings',), self.getPublicSettings)
         self.route('GET', ('thumbnails',), self.countThumbnails)
         self.route('PUT', ('thumbnails',), self.createThumbnails)
@@ -237,11 +238,24 @@ class LargeImageResource(Resource):
 
     @describeRoute(
         Description('Get information on caches.')
+        .notes('This includes hits, misses, evictions, bytes stored, and '
+               'time spent computing values and waiting for locks for each '
+               'cache.')
     )
     @access.admin
     def cacheInfo(self, params):
         return cache_util.cachesInfo()
 
+    @describeRoute(
+        Description('Get statistics on cached methods.')
+        .notes('This includes hits, misses, evictions, bytes stored, and '
+               'time spent computing values and waiting for locks for each '
+               'cached method, such as getTile for each tile source.')
+    )
+    @access.admin
+    def cacheMethodsInfo(self, params):
+        return cache_util.methodStatsInfo()
+
     @describeRoute(
         Description('Get public settings for large image display.')
     )
@@ -17,6 +17,7 @@
 #############################################################################
 
 import cherrypy
+import json
 import math
 import os
 import re
@@ -90,6 +91,8 @@ class TilesItemResource(ItemResource):
                            self.getTile)
         apiRoot.item.route('GET', (':itemId', 'tiles', 'fzxy', ':frame', ':z', ':x', ':y'),
                            self.getTileWithFrame)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'composite', ':z', ':x', ':y'),
+                           self.getCompositeTile)
         apiRoot.item.route('GET', (':itemId', 'tiles', 'images'),
                            self.getAssociatedImagesList)
         apiRoot.item.route('GET', (':itemId', 'tiles', 'images', ':image'),
@@ -107,6 +110,9 @@ class TilesItemResource(ItemResource):
         filter_logging.addLoggingFilter(
             'GET (/[^/ ?#]+)*/item/[^/ ?#]+/tiles/dzi_files(/[^/ ?#]+){2}',
             frequency=250)
+        filter_logging.addLoggingFilter(
+            'GET (/[^/ ?#]+)*/item/[^/ ?#]+/tiles/composite(/[^/ ?#]+){3}',
+            frequency=250)
         # Cache the model singleton
         self.imageItemModel = ImageItem()
 
@@ -411,6 +417,57 @@ class TilesItemResource(ItemResource):
         return self._getTile(item, z, x, y, params, mayRedirect=redirect)
     getTileWithFrame.accessLevel = 'public'
 
+    @describeRoute(
+        Description('Get a large image tile that blends several frames, such '
+                    'as the channels of a multiplexed image, into one color '
+                    'image.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('z', 'The layer number of the tile (0 is the most zoomed-out '
+               'layer).', paramType='path')
+        .param('x', 'The X coordinate of the tile (0 is the left side).',
+               paramType='path')
+        .param('y', 'The Y coordinate of the tile (0 is the top).',
+               paramType='path')
+        .param('channels', 'A JSON list of channels, each an object with '
+               '"frame", the frame number, and optionally "color", a color '
+               'name or #rrggbb value, and "min" and "max", the values that '
+               'map to black and to the full color.')
+        .produces(ImageMimeTypes)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+    )
+    # See getTile for caching rationale
+    def getCompositeTile(self, itemId, z, x, y, params):
+        item = loadmodelcache.loadModel(
+            self, 'item', id=itemId, allowCookie=True, level=AccessType.READ)
+        self.requireParams(['channels'], params)
+        try:
+            channels = json.loads(params['channels'])
+            if not isinstance(channels, list):
+                raise ValueError()
+        except ValueError:
+            raise RestException('The channels parameter must be a JSON list.')
+        try:
+            x, y, z = int(x), int(y), int(z)
+        except ValueError:
+            raise RestException('x, y, and z must be integers', code=400)
+        if x < 0 or y < 0 or z < 0:
+            raise RestException('x, y, and z must be positive integers',
+                                code=400)
+        # Explicitly set a expires time to encourage browsers to cache this for
+        # a while.
+        setResponseHeader('Expires', cherrypy.lib.httputil.HTTPDate(
+            cherrypy.serving.response.time + 600))
+        try:
+            tileData, tileMime = self.imageItemModel.getCompositeTile(
+                item, x, y, z, channels)
+        except TileGeneralException as e:
+            raise RestException(e.args[0], code=404)
+        setResponseHeader('Content-Type', tileMime)
+        setRawResponse()
+        return tileData
+    getCompositeTile.accessLevel = 'public'
+
     @describeRoute(
         Description('Get a test large image tile.')
         .param('z', 'The layer number of the tile (0 is the most zoomed-out '
@@ -15,6 +15,8 @@ from girder_jobs.models.job import Job
 # from girder_worker.girder_plugin.constants import PluginSettings as WorkerSettings
 from girder_worker.girder_plugin.status import CustomJobStatus
 
+import large_image_source_test
+
 from girder_large_image import constants
 from girder_large_image.models.image_item import ImageItem
 
@@ -276,6 +278,17 @@ def testCaches(server, admin):
     assert utilities.respStatus(resp) == 200
     results = resp.json
     assert 'tilesource' in results
+    assert 'hits' in results['tilesource']['stats']
+    source = large_image_source_test.TestTileSource()
+    source.getTile(0, 0, 0)
+    source.getTile(0, 0, 0)
+    resp = server.request(path='/large_image/cache/methods', user=admin)
+    assert utilities.respStatus(resp) == 200
+    results = resp.json
+    stats = results['large_image_source_test.TestTileSource.getTile']
+    assert stats['hits'] >= 1
+    assert stats['misses'] >= 1
+    assert stats['bytes'] > 0
     resp = server.request(path='/large_image/cache/clear', method='PUT', user=admin)
     assert utilities.respStatus(resp) == 200
     results = resp.json
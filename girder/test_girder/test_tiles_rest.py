@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import json
 import math
 import mock
 import os
@@ -1087,3 +1088,34 @@ def testTilesWithFrameNumbers(server, admin, fsAssetstore):
                           user=admin, isJson=False)
     assert utilities.respStatus(resp) == 200
     assert utilities.getBody(resp, text=False) == image1
+
+
+@pytest.mark.plugin('large_image')
+def testTilesComposite(server, admin, fsAssetstore):
+    file = utilities.uploadExternalFile(
+        'data/sample.ome.tif.sha512', admin, fsAssetstore)
+    itemId = str(file['itemId'])
+    channels = [{'frame': 0, 'color': '#ff0000'}, {'frame': 1, 'color': '#00ff00'}]
+    resp = server.request(path='/item/%s/tiles/composite/0/0/0' % itemId,
+                          user=admin, isJson=False,
+                          params={'channels': json.dumps(channels)})
+    assert utilities.respStatus(resp) == 200
+    assert resp.headers['Content-Type'] == 'image/jpeg'
+    image = utilities.getBody(resp, text=False)
+    assert image[:3] == b'\xff\xd8\xff'
+    resp = server.request(path='/item/%s/tiles/zxy/0/0/0' % itemId,
+                          user=admin, isJson=False, params={'frame': 0})
+    assert utilities.getBody(resp, text=False) != image
+    # Bad channels are rejected
+    resp = server.request(path='/item/%s/tiles/composite/0/0/0' % itemId,
+                          user=admin, params={'channels': 'not json'})
+    assert utilities.respStatus(resp) == 400
+    for badChannels, message in (
+            ([], 'At least one channel'),
+            (['red'], 'Invalid composite channel'),
+            ([{'frame': 0, 'min': 'low'}], 'Invalid composite channel'),
+            ([{'frame': 1000}], 'Frame does not exist')):
+        resp = server.request(path='/item/%s/tiles/composite/0/0/0' % itemId,
+                              user=admin, params={'channels': json.dumps(badChannels)})
+        assert utilities.respStatus(resp) == 404
+        assert message in resp.json['message']
@@ -18,12 +18,20 @@
 
 import atexit
 
-from .cache import (LruCacheMetaclass, strhash, methodcache, getTileCache,
-                    isTileCacheSetup, CacheProperties)
+from .cache import (LruCacheMetaclass, strhash, methodcache, methodcacheMany,
+                    getTileCache, isTileCacheSetup, getSynthesizedLevelCache,
+                    CacheProperties, CacheStats, MethodStats, getCacheStats,
+                    FileHandleCache)
 try:
     from .memcache import MemCache
 except ImportError:
     MemCache = None
+try:
+    from .shmcache import SharedMemCache
+except ImportError:
+    SharedMemCache = None
+from .diskcache import DiskCache
+from .layeredcache import LayeredCache
 from .cachefactory import CacheFactory, pickAvailableCache
 from cachetools import cached, Cache, LRUCache
 
@@ -33,14 +41,15 @@ def cachesClear(*args, **kwargs):
     """
     Clear the tilesource caches and the load model cache.  Note that this does
     not clear memcached (which could be done with tileCache._client.flush_all,
-    but that can affect programs other than this one).
+    but that can affect programs other than this one), the shared cache, or
+    the disk cache (which are used by other processes).
     """
     for name in LruCacheMetaclass.namedCaches:
         with LruCacheMetaclass.namedCaches[name][1]:
             LruCacheMetaclass.namedCaches[name][0].clear()
     if isTileCacheSetup():
         tileCache, tileLock = getTileCache()
-        if isinstance(tileCache, LRUCache):
+        if isinstance(tileCache, (LRUCache, LayeredCache)):
             try:
                 with tileLock:
                     tileCache.clear()
@@ -48,12 +57,52 @@ def cachesClear(*args, **kwargs):
                 pass
 
 
+def _cacheSizeInfo(cache):
+    """
+    Report the size of a cache.
+
+    :param cache: the cache.
+    :returns: a dictionary with 'maxsize', 'used', and 'items' or None if the
+        cache doesn't report its size.
+    """
+    if not isinstance(cache, (LRUCache, DiskCache, LayeredCache)) and not (
+            SharedMemCache and isinstance(cache, SharedMemCache)):
+        return None
+    return {
+        'maxsize': cache.maxsize,
+        'used': cache.currsize,
+        'items': len(cache),
+    }
+
+
+def cachesStatsReset():
+    """
+    Reset the usage statistics of all caches and cached methods.
+    """
+    for name in LruCacheMetaclass.namedCaches:
+        getCacheStats(LruCacheMetaclass.namedCaches[name][0]).reset()
+    if isTileCacheSetup():
+        getCacheStats(getTileCache()[0]).reset()
+    for stats in list(MethodStats.values()):
+        stats.reset()
+
+
 def cachesInfo(*args, **kwargs):
     """
     Report on each cache.
 
     :returns: a dictionary with the cache names as the keys and values that
-        include 'maxsize' and 'used', if known.
+        include 'maxsize', 'used', and 'items', if known.  The tile cache's
+        'maxsize' and 'used' are in bytes; other caches count items.  Caches
+        of objects that hold open files, such as tile sources, also have
+        'maxFileHandles' and 'fileHandles' with the file handles the objects
+        are expected to use.  If the
+        tile cache is layered, 'tiers' has the hits, misses, and sizes of
+        each tier, and the other values are for the in-process tier.  Each
+        cache has 'stats' with the hits, misses, evictions, bytes stored,
+        time spent computing missing values, and time spent waiting for the
+        cache lock.  See methodStatsInfo for the same statistics for each
+        cached method.
     """
     info = {}
     for name in LruCacheMetaclass.namedCaches:
@@ -61,24 +110,57 @@ def cachesInfo(*args, **kwargs):
             cache = LruCacheMetaclass.namedCaches[name][0]
             info[name] = {
                 'maxsize': cache.maxsize,
-                'used': cache.currsize
+                'used': cache.currsize,
+                'items': len(cache),
+                'stats': getCacheStats(cache).info(),
             }
+            if isinstance(cache, FileHandleCache):
+                info[name].update({
+                    'maxsize': cache.maxItems,
+                    'used': len(cache),
+                    'maxFileHandles': cache.maxsize,
+                    'fileHandles': cache.currsize,
+                })
     if isTileCacheSetup():
         tileCache, tileLock = getTileCache()
-        if isinstance(tileCache, LRUCache):
-            try:
-                with tileLock:
-                    info['tileCache'] = {
-                        'maxsize': tileCache.maxsize,
-                        'used': tileCache.currsize
+        try:
+            with tileLock:
+                tileInfo = _cacheSizeInfo(tileCache) or {}
+                tileInfo['stats'] = getCacheStats(tileCache).info()
+                if isinstance(tileCache, LayeredCache):
+                    tileInfo['tiers'] = {
+                        'l1': dict(tileCache.stats['l1'], **_cacheSizeInfo(tileCache.l1)),
+                        'l2': dict(tileCache.stats['l2'], **(
+                            _cacheSizeInfo(tileCache.l2) or {})),
                     }
-            except Exception:
-                pass
-    # It would be nice to include memcached, but pylibmc's client.get_stats()
-    # doesn't seem to work.
+            info['tileCache'] = tileInfo
+        except Exception:
+            pass
+    # It would be nice to include the size of memcached, but pylibmc's
+    # client.get_stats() doesn't seem to work.
+    return info
+
+
+def methodStatsInfo():
+    """
+    Report on the usage of each method decorated with methodcache.
+
+    :returns: a dictionary with the full name of each method that has been
+        used as keys and a dictionary of its hits, misses, evictions, bytes
+        stored, time spent computing missing values, and time spent waiting
+        for the cache lock as values.
+    """
+    info = {}
+    for name, stats in list(MethodStats.items()):
+        methodInfo = stats.info()
+        if methodInfo['hits'] or methodInfo['misses']:
+            info[name] = methodInfo
     return info
 
 
-__all__ = ('CacheFactory', 'getTileCache', 'isTileCacheSetup', 'MemCache',
+__all__ = ('CacheFactory', 'getTileCache', 'isTileCacheSetup', 'getSynthesizedLevelCache',
+           'MemCache', 'SharedMemCache',
+           'DiskCache', 'LayeredCache', 'FileHandleCache',
            'strhash', 'LruCacheMetaclass', 'pickAvailableCache', 'cached',
-           'Cache', 'LRUCache', 'methodcache', 'CacheProperties')
+           'Cache', 'LRUCache', 'methodcache', 'methodcacheMany', 'CacheProperties',
+           'CacheStats', 'MethodStats', 'getCacheStats', 'cachesStatsReset', 'methodStatsInfo')
@@ -20,15 +20,37 @@ try:
     import resource
 except ImportError:
     resource = None
+import cachetools
+import functools
 import six
+import threading
+import time
 
-from .cachefactory import CacheFactory, pickAvailableCache
+from .cachefactory import CacheFactory, estimateSize, pickAvailableCache
+from .diskcache import DiskCache
 from .. import config
 
 
 _tileCache = None
 _tileLock = None
-
+# Used in place of a cache lock when an object doesn't have one
+_noLock = threading.Lock()
+# Statistics for each method decorated with methodcache
+MethodStats = {}
+_statsLock = threading.Lock()
+# Use the most precise timer available
+_timer = getattr(time, 'perf_counter', time.time)
+# Computations in progress for _singleFlight
+_flights = {}
+_flightsLock = threading.Lock()
+# Disk caches for the tiles of missing levels, keyed by (path, size)
+_synthesizedLevelCaches = {}
+_synthesizedLevelCachesLock = threading.Lock()
+
+
+# Tile sources are expected to use this many file handles each, unless their
+# class has a cacheFileHandles attribute with a different estimate.
+TileSourceFileHandles = 20
 
 # If we have a resource module, ask to use as many file handles as the hard
 # limit allows, then calculate how may tile sources we can have open based on
@@ -42,7 +64,7 @@ if resource:
         # Reserve some file handles for general use, and expect that tile
         # sources could use many handles each.  This is conservative, since
         # running out of file handles breaks the program in general.
-        MaximumTileSources = max(3, (SoftNoFile - 10) / 20)
+        MaximumTileSources = max(3, (SoftNoFile - 10) / TileSourceFileHandles)
     except Exception:
         pass
 
@@ -53,6 +75,9 @@ CacheProperties = {
         # individual tiles
         'itemExpectedSize': 24 * 1024 ** 2,
         'maxItems': MaximumTileSources,
+        # Each item is weighted by the file handles its class expects to use,
+        # so sources that use fewer handles can be cached in greater numbers.
+        'itemFileHandles': TileSourceFileHandles,
         # The cache timeout is not currently being used, but it is set here in
         # case we ever choose to implement it.
         'cacheTimeout': 300,
@@ -74,51 +99,424 @@ def strhash(*args, **kwargs):
     return '%r' % (args, )
 
 
+class CacheStats(object):
+    """
+    Counters for how a cache or a cached method is used.  Times are in
+    seconds, and bytes is the estimated size of the values that were stored.
+    Coalesced calls are misses that waited for a concurrent call with the same
+    key rather than computing the value.
+    """
+
+    counters = ('hits', 'misses', 'coalesced', 'evictions', 'bytes', 'computeTime',
+                'lockTime')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Set all counters to zero.
+        """
+        with self._lock:
+            self._values = dict.fromkeys(self.counters, 0)
+
+    def add(self, **kwargs):
+        """
+        Add to counters.
+
+        :param **kwargs: the counters to increase and the amounts.
+        """
+        with self._lock:
+            for counter, value in six.iteritems(kwargs):
+                self._values[counter] += value
+
+    def info(self):
+        """
+        Get the current counters.
+
+        :returns: a dictionary of counters.
+        """
+        with self._lock:
+            return dict(self._values)
+
+
+def getCacheStats(cache):
+    """
+    Get the statistics for a cache, creating them if needed.
+
+    :param cache: the cache.
+    :returns: a CacheStats object.
+    """
+    stats = getattr(cache, '_cacheStats', None)
+    if stats is None:
+        with _statsLock:
+            stats = getattr(cache, '_cacheStats', None)
+            if stats is None:
+                stats = cache._cacheStats = CacheStats()
+    return stats
+
+
+def getMethodStats(name):
+    """
+    Get the statistics for a method decorated with methodcache, creating them
+    if needed.
+
+    :param name: the full name of the method.
+    :returns: a CacheStats object.
+    """
+    with _statsLock:
+        if name not in MethodStats:
+            MethodStats[name] = CacheStats()
+        return MethodStats[name]
+
+
+def _methodName(method):
+    method = getattr(method, '__wrapped__', method)
+    return '%s.%s' % (method.__module__, getattr(method, '__qualname__', method.__name__))
+
+
+def _addStats(statsList, **kwargs):
+    for stats in statsList:
+        stats.add(**kwargs)
+
+
 def methodcache(key=None):
     """
     Decorator to wrap a function with a memoizing callable that saves results
     in self.cache.  This is largely taken from cachetools, but uses a cache
     from self.cache rather than a passed value.  If self.cache_lock is
-    present and not none, a lock is used.
+    present and not none, a lock is used.  If concurrent calls miss the cache
+    with the same key, only one computes the value and the others wait for
+    it.  Hits, misses, and timing are recorded for both the method and the
+    cache.
 
     :param key: if a function, use that for the key, otherwise use self.wrapKey.
     """
     def decorator(func):
+        methodStats = getMethodStats(_methodName(func))
+
         @six.wraps(func)
         def wrapper(self, *args, **kwargs):
-            k = key(*args, **kwargs) if key else self.wrapKey(*args, **kwargs)
-            if hasattr(self, '_classkey'):
-                k = self._classkey + ' ' + k
+            k = _methodcacheKey(self, key, args, kwargs)
             lock = getattr(self, 'cache_lock', None)
+            stats = (methodStats, getCacheStats(self.cache))
+            start = _timer()
+            lockTime = 0
             try:
                 if lock:
                     with self.cache_lock:
-                        return self.cache[k]
+                        lockTime = _timer() - start
+                        v = self.cache[k]
                 else:
-                    return self.cache[k]
+                    v = self.cache[k]
+                _addStats(stats, hits=1, lockTime=lockTime)
+                return v
             except KeyError:
                 pass  # key not found
             except ValueError:
                 # this can happen if a different version of python wrote the record
                 pass
-            v = func(self, *args, **kwargs)
-            try:
-                if lock:
-                    with self.cache_lock:
-                        self.cache[k] = v
-                else:
-                    self.cache[k] = v
-            except ValueError:
-                pass  # value too large
-            except KeyError:
-                # the key was refused for some reason
-                config.getConfig('logger').debug(
-                    'Had a cache KeyError while trying to store a value to key %r' % (k))
+            counts = {'lockTime': lockTime}
+
+            def compute():
+                start = _timer()
+                v = func(self, *args, **kwargs)
+                counts['computeTime'] = _timer() - start
+                return v
+
+            def store(v):
+                storeLockTime, counts['evictions'], counts['bytes'] = _methodcacheStore(
+                    self, k, v)
+                counts['lockTime'] += storeLockTime
+
+            v, computed = _singleFlight((id(self.cache), k), compute, store)
+            if computed:
+                _addStats(stats, misses=1, **counts)
+            else:
+                _addStats(stats, coalesced=1, **counts)
             return v
+        wrapper._methodcacheKeyFunc = key
         return wrapper
     return decorator
 
 
+class _Flight(object):
+    """
+    A computation that other threads can wait for.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.success = False
+        self.value = None
+        self.thread = threading.current_thread()
+
+
+def _singleFlight(flightKey, compute, store=None):
+    """
+    Compute a value once for concurrent requests with the same key.  The
+    first caller computes the value and any callers that arrive before it is
+    done wait for and share the result.  If the computation raises an
+    exception, each waiting caller tries again.  A computation that makes
+    the same request on its own thread, such as a cached method that calls
+    a cached method of its parent class with the same arguments, computes
+    the value rather than waiting for itself.
+
+    :param flightKey: a hashable key identifying the computation.
+    :param compute: a function that takes no arguments and returns the value.
+    :param store: an optional function that is called with the computed value
+        before waiting callers are released, such as to add it to a cache.
+    :returns: the value and True if this call computed it.
+    """
+    with _flightsLock:
+        flight = _flights.get(flightKey)
+        leader = flight is None
+        if leader:
+            flight = _flights[flightKey] = _Flight()
+    if not leader and flight.thread is threading.current_thread():
+        value = compute()
+        if store:
+            store(value)
+        return value, True
+    if not leader:
+        flight.event.wait()
+        if flight.success:
+            return flight.value, False
+        return _singleFlight(flightKey, compute, store)
+    try:
+        flight.value = compute()
+        if store:
+            store(flight.value)
+        flight.success = True
+        return flight.value, True
+    finally:
+        with _flightsLock:
+            _flights.pop(flightKey, None)
+        flight.event.set()
+
+
+def _methodcacheStore(self, k, v):
+    """
+    Store a value computed by a methodcache-decorated method.
+
+    :param self: the instance the method was called on.
+    :param k: the cache key.
+    :param v: the value.
+    :returns: the time spent waiting for the lock, the number of values
+        evicted, and the estimated size of the value if it was stored.
+    """
+    lock = getattr(self, 'cache_lock', None)
+    lockTime = evictions = storedBytes = 0
+    try:
+        if lock:
+            start = _timer()
+            with lock:
+                lockTime = _timer() - start
+                evictions = _storeCounted(self.cache, k, v)
+        else:
+            evictions = _storeCounted(self.cache, k, v)
+        storedBytes = estimateSize(v)
+    except ValueError:
+        pass  # value too large
+    except KeyError:
+        # the key was refused for some reason
+        config.getConfig('logger').debug(
+            'Had a cache KeyError while trying to store a value to key %r' % (k))
+    return lockTime, evictions, storedBytes
+
+
+def _storeCounted(cache, key, value):
+    """
+    Store a value in a cache and count how many values were evicted to make
+    room for it.
+
+    :param cache: the cache.
+    :param key: the key to store.
+    :param value: the value to store.
+    :returns: the number of evicted values, if the cache reports its length.
+    """
+    before = len(cache)
+    cache[key] = value
+    if before < 0:
+        return 0
+    return max(0, before + 1 - len(cache))
+
+
+def _methodcacheKey(self, key, args, kwargs):
+    """
+    Compute the cache key used by methodcache for a call.
+
+    :param self: the instance the method is called on.
+    :param key: a key function or None to use self.wrapKey.
+    :param args: the positional arguments of the call.
+    :param kwargs: the keyword arguments of the call.
+    :returns: the cache key.
+    """
+    k = key(*args, **kwargs) if key else self.wrapKey(*args, **kwargs)
+    if hasattr(self, '_classkey'):
+        k = self._classkey + ' ' + k
+    return k
+
+
+def _cacheGetMany(cache, keys):
+    """
+    Get multiple values from a cache.  If the cache has a getMany method, it
+    is used.  The caller is responsible for any locking.
+
+    :param cache: the cache to query.
+    :param keys: a list of keys.
+    :returns: a dictionary of the keys that were found and their values.
+    """
+    getMany = getattr(cache, 'getMany', None)
+    if getMany:
+        try:
+            return getMany(keys)
+        except ValueError:
+            # this can happen if a different version of python wrote a record
+            return {}
+    found = {}
+    for k in keys:
+        try:
+            found[k] = cache[k]
+        except KeyError:
+            pass  # key not found
+        except ValueError:
+            # this can happen if a different version of python wrote the record
+            pass
+    return found
+
+
+def _cacheSetMany(cache, items):
+    """
+    Store multiple values in a cache.  If the cache has a setMany method, it
+    is used.  The caller is responsible for any locking.
+
+    :param cache: the cache to update.
+    :param items: a dictionary of keys and values to store.
+    :returns: a list of the keys that were stored.  If the cache has a
+        setMany method that doesn't report this, all of the keys.
+    """
+    setMany = getattr(cache, 'setMany', None)
+    if setMany:
+        stored = setMany(items)
+        return list(items) if stored is None else stored
+    stored = []
+    for k, v in six.iteritems(items):
+        try:
+            cache[k] = v
+            stored.append(k)
+        except ValueError:
+            pass  # value too large
+        except KeyError:
+            # the key was refused for some reason
+            config.getConfig('logger').debug(
+                'Had a cache KeyError while trying to store a value to key %r' % (k))
+    return stored
+
+
+def methodcacheMany(self, method, calls, order=None):
+    """
+    Call a methodcache-decorated method for a list of arguments.  All of the
+    cache keys are looked up at once, only the calls that are not in the cache
+    are computed, and the new results are stored at once.  This takes the
+    cache lock twice rather than twice per call.  If the cache has getMany
+    and setMany methods (such as MemCache), they are used so that the
+    lookups and stores can each be done in a single request.
+
+    :param self: the instance the method is called on.
+    :param method: the decorated method, such as type(self).getTile.  If the
+        method was not decorated with methodcache, it is called for each item
+        without any caching.
+    :param calls: a list of (args, kwargs) tuples.
+    :param order: if not None, a function that is passed a list of the
+        indices within calls that need to be computed and returns the list in
+        the order they should be computed.
+    :returns: a list of results in the same order as calls.
+    """
+    func = getattr(method, '__wrapped__', None)
+    if func is None or not hasattr(method, '_methodcacheKeyFunc'):
+        return [method(self, *args, **kwargs) for args, kwargs in calls]
+    keys = [_methodcacheKey(self, method._methodcacheKeyFunc, args, kwargs)
+            for args, kwargs in calls]
+    lock = getattr(self, 'cache_lock', None)
+    stats = (getMethodStats(_methodName(method)), getCacheStats(self.cache))
+    start = _timer()
+    with (lock if lock else _noLock):
+        lockTime = _timer() - start
+        found = _cacheGetMany(self.cache, keys)
+    results = [found.get(k) for k in keys]
+    misses = [idx for idx, k in enumerate(keys) if k not in found]
+    if not misses:
+        _addStats(stats, hits=len(results), lockTime=lockTime)
+        return results
+    if order:
+        misses = order(misses)
+    computed = {}
+    coalesced = set()
+    start = _timer()
+    for idx in misses:
+        k = keys[idx]
+        if k not in computed:
+            args, kwargs = calls[idx]
+            # Values computed by concurrent calls are shared, but this batch
+            # stores its own values after they are all computed.
+            computed[k], isLeader = _singleFlight(
+                (id(self.cache), k), lambda args=args, kwargs=kwargs: func(self, *args, **kwargs))
+            if not isLeader:
+                coalesced.add(k)
+        results[idx] = computed[k]
+    computeTime = _timer() - start
+    toStore = {k: v for k, v in six.iteritems(computed) if k not in coalesced}
+    start = _timer()
+    with (lock if lock else _noLock):
+        lockTime += _timer() - start
+        before = len(self.cache)
+        stored = _cacheSetMany(self.cache, toStore)
+        evictions = max(0, before + len(stored) - len(self.cache)) if before >= 0 else 0
+    _addStats(stats, hits=len(results) - len(misses), misses=len(toStore),
+              coalesced=len(coalesced), computeTime=computeTime, lockTime=lockTime,
+              evictions=evictions, bytes=sum(estimateSize(toStore[k]) for k in stored))
+    return results
+
+
+def _fileHandleCount(default, instance):
+    """
+    Get the number of file handles that an object cached by the
+    LruCacheMetaclass is expected to use.
+
+    :param default: the number to use if the object's class doesn't specify
+        one.
+    :param instance: the cached object.
+    :returns: the number of file handles.
+    """
+    return getattr(instance, 'cacheFileHandles', None) or default
+
+
+class FileHandleCache(cachetools.LRUCache):
+    """
+    An LRU cache of objects that hold open files.  Its size is the number of
+    file handles the objects are expected to use, and the number of objects
+    is separately limited, such as by the memory they are expected to use.
+    """
+
+    def __init__(self, maxItems, maxFileHandles, itemFileHandles):
+        """
+        :param maxItems: the maximum number of objects.
+        :param maxFileHandles: the maximum number of file handles.
+        :param itemFileHandles: the number of file handles an object uses if
+            its class doesn't have a cacheFileHandles attribute.
+        """
+        super(FileHandleCache, self).__init__(
+            maxFileHandles, getsizeof=functools.partial(_fileHandleCount, itemFileHandles))
+        self.maxItems = maxItems
+
+    def __setitem__(self, key, value):
+        super(FileHandleCache, self).__setitem__(key, value)
+        while len(self) > self.maxItems:
+            self.popitem()
+
+
 class LruCacheMetaclass(type):
     """
     """
@@ -134,12 +532,15 @@ class LruCacheMetaclass(type):
         cacheName = kwargs.get('cacheName', cacheName)
 
         maxSize = CacheProperties.get(cacheName, {}).get('cacheMaxSize', None)
+        itemHandles = CacheProperties.get(cacheName, {}).get('itemFileHandles')
         if (maxSize is None and cacheName in CacheProperties and
                 'maxItems' in CacheProperties[cacheName] and
                 'itemExpectedSize' in CacheProperties[cacheName] and 'itemExpectedSize'):
+            # If items are weighted by their file handles, maxItems limits the
+            # file handles rather than the number of items.
             maxSize = pickAvailableCache(
                 CacheProperties[cacheName]['itemExpectedSize'],
-                maxItems=CacheProperties[cacheName]['maxItems'])
+                maxItems=CacheProperties[cacheName]['maxItems'] if not itemHandles else None)
         maxSize = namespace.pop('cacheMaxSize', maxSize)
         maxSize = kwargs.get('cacheMaxSize', maxSize)
         if maxSize is None:
@@ -156,7 +557,12 @@ class LruCacheMetaclass(type):
             cacheName = cls
 
         if LruCacheMetaclass.namedCaches.get(cacheName) is None:
-            cache, cacheLock = CacheFactory().getCache(maxSize)
+            if itemHandles:
+                maxHandles = int(CacheProperties[cacheName].get('maxItems', maxSize) * itemHandles)
+                cache = FileHandleCache(maxSize, maxHandles, itemHandles)
+                cacheLock = threading.Lock()
+            else:
+                cache, cacheLock = CacheFactory().getCache(maxSize)
             LruCacheMetaclass.namedCaches[cacheName] = (cache, cacheLock)
             config.getConfig('logger').info(
                 'Created LRU Cache for %r with %d maximum size' % (cacheName, maxSize))
@@ -181,14 +587,35 @@ class LruCacheMetaclass(type):
         else:
             key = strhash(args[0], kwargs)
         key = cls.__name__ + ' ' + key
+        start = _timer()
         with cacheLock:
+            counts = {'lockTime': _timer() - start}
             try:
                 instance = cache[key]
+                getCacheStats(cache).add(hits=1, **counts)
+                return instance
             except KeyError:
-                instance = super(LruCacheMetaclass, cls).__call__(*args, **kwargs)
-                cache[key] = instance
-                instance._classkey = key
+                pass
 
+        # Open the source without holding the cache lock, so that different
+        # sources can be opened concurrently, but only open it once if it is
+        # requested by multiple threads.
+        def construct():
+            start = _timer()
+            instance = super(LruCacheMetaclass, cls).__call__(*args, **kwargs)
+            counts['computeTime'] = _timer() - start
+            instance._classkey = key
+            return instance
+
+        def store(instance):
+            start = _timer()
+            with cacheLock:
+                counts['lockTime'] += _timer() - start
+                counts['evictions'] = _storeCounted(cache, key, instance)
+
+        instance, computed = _singleFlight((id(cache), key), construct, store)
+        counts['misses' if computed else 'coalesced'] = 1
+        getCacheStats(cache).add(**counts)
         return instance
 
 
@@ -213,3 +640,25 @@ def isTileCacheSetup():
     :returns: True if _tileCache is not None.
     """
     return _tileCache is not None
+
+
+def getSynthesizedLevelCache():
+    """
+    Get the disk cache that stores tiles of levels that are missing from files
+    based on the 'cache_synthesized_levels_path' config value.
+
+    :returns: a DiskCache or None if these tiles are not stored.
+    """
+    path = config.getConfig('cache_synthesized_levels_path')
+    if not path:
+        return None
+    key = (path, config.getConfig('cache_synthesized_levels_size'))
+    with _synthesizedLevelCachesLock:
+        if key not in _synthesizedLevelCaches:
+            try:
+                _synthesizedLevelCaches[key] = DiskCache(*key)
+            except EnvironmentError:
+                config.getConfig('logger').info(
+                    'Cannot store tiles of missing levels in %s' % path)
+                _synthesizedLevelCaches[key] = None
+        return _synthesizedLevelCaches[key]
@@ -19,6 +19,10 @@
 
 import threading
 import math
+import numpy
+import PIL.Image
+import six
+import sys
 try:
     import psutil
 except ImportError:
@@ -30,6 +34,12 @@ try:
     from .memcache import MemCache
 except ImportError:
     MemCache = None
+try:
+    from .shmcache import SharedMemCache
+except ImportError:
+    SharedMemCache = None
+from .diskcache import DiskCache
+from .layeredcache import LayeredCache
 
 
 def pickAvailableCache(sizeEach, portion=8, maxItems=None):
@@ -45,62 +55,177 @@ def pickAvailableCache(sizeEach, portion=8, maxItems=None):
         unless maxItems is less.
     """
     # Estimate usage based on (1 / portion) of the total virtual memory.
-    if psutil:
-        memory = psutil.virtual_memory().total
-    else:
-        memory = 1024 ** 3
+    memory = getAvailableMemory()
     numItems = max(int(math.floor(memory / portion / sizeEach)), 2)
     if maxItems:
         numItems = min(numItems, maxItems)
     return numItems
 
 
+def getAvailableMemory():
+    """
+    Get the total virtual memory of the system.
+
+    :returns: the memory in bytes.  If this can't be determined, 1 GB is
+        assumed.
+    """
+    if psutil:
+        return psutil.virtual_memory().total
+    return 1024 ** 3
+
+
+def estimateSize(value):
+    """
+    Estimate the memory used by a cached value.  This accounts for the pixel
+    data of PIL images and numpy arrays, which sys.getsizeof does not, and the
+    contents of tuples, lists, and dictionaries.
+
+    :param value: the value to estimate.
+    :returns: the approximate size in bytes.
+    """
+    if isinstance(value, PIL.Image.Image):
+        # PIL stores multi-band and 32-bit images with 4 bytes per pixel
+        if value.mode in ('1', 'L', 'P'):
+            pixelSize = 1
+        elif value.mode.startswith('I;16'):
+            pixelSize = 2
+        else:
+            pixelSize = 4
+        return sys.getsizeof(value) + value.width * value.height * pixelSize
+    if isinstance(value, numpy.ndarray):
+        if value.base is not None:
+            return sys.getsizeof(value) + value.nbytes
+        return sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(estimateSize(entry) for entry in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            estimateSize(key) + estimateSize(entry) for key, entry in six.iteritems(value))
+    return sys.getsizeof(value)
+
+
 class CacheFactory(object):
     logged = False
 
+    def getMemoryPortion(self):
+        """
+        Get the inverse fraction of memory that the python tile cache can use.
+
+        :returns: the portion from the config, but at least 3.
+        """
+        defaultPortion = 32
+        try:
+            portion = int(config.getConfig('cache_python_memory_portion', defaultPortion))
+            if portion < 3:
+                portion = 3
+        except ValueError:
+            portion = defaultPortion
+        return portion
+
     def getCacheSize(self, numItems):
         if numItems is None:
-            defaultPortion = 32
-            try:
-                portion = int(config.getConfig('cache_python_memory_portion', defaultPortion))
-                if portion < 3:
-                    portion = 3
-            except ValueError:
-                portion = defaultPortion
-            numItems = pickAvailableCache(256**2 * 4 * 2, portion)
+            numItems = pickAvailableCache(256**2 * 4 * 2, self.getMemoryPortion())
         return numItems
 
+    def getCacheByteSize(self):
+        """
+        Get the maximum number of bytes the python tile cache can use.  This
+        is the cache_python_memory_size config value, if set, or a portion of
+        the available memory.
+
+        :returns: the size in bytes.
+        """
+        try:
+            size = int(config.getConfig('cache_python_memory_size') or 0)
+        except ValueError:
+            size = 0
+        if size <= 0:
+            size = int(getAvailableMemory() // self.getMemoryPortion())
+        return size
+
+    def getMemCache(self):
+        """
+        Create a memcached cache based on the config settings.
+
+        :returns: a MemCache or None if memcached is not available.
+        """
+        # check if credentials and location exist, otherwise assume
+        # location is 127.0.0.1 (localhost) with no password
+        url = config.getConfig('cache_memcached_url')
+        if not url:
+            url = '127.0.0.1'
+        memcachedUsername = config.getConfig('cache_memcached_username')
+        if not memcachedUsername:
+            memcachedUsername = None
+        memcachedPassword = config.getConfig('cache_memcached_password')
+        if not memcachedPassword:
+            memcachedPassword = None
+        try:
+            return MemCache(url, memcachedUsername, memcachedPassword,
+                            mustBeAvailable=True)
+        except Exception:
+            config.getConfig('logger').info('Cannot use memcached for caching.')
+        return None
+
+    def getSharedCache(self):
+        """
+        Create a shared memory cache based on the config settings.
+
+        :returns: a SharedMemCache or None if it cannot be used.
+        """
+        try:
+            return SharedMemCache(
+                config.getConfig('cache_shared_path'),
+                int(config.getConfig('cache_shared_size') or 0) or self.getCacheByteSize())
+        except Exception:
+            config.getConfig('logger').info('Cannot use a shared cache for caching.')
+        return None
+
+    def getDiskCache(self):
+        """
+        Create a disk cache based on the config settings.
+
+        :returns: a DiskCache or None if it cannot be used.
+        """
+        try:
+            return DiskCache(config.getConfig('cache_disk_path'),
+                             config.getConfig('cache_disk_size'))
+        except Exception:
+            config.getConfig('logger').info('Cannot use a disk cache for caching.')
+        return None
+
     def getCache(self, numItems=None):
         # memcached is the fallback default, if available.
         cacheBackend = config.getConfig('cache_backend', 'python')
         if cacheBackend:
             cacheBackend = str(cacheBackend).lower()
         cache = None
-        if cacheBackend == 'memcached' and MemCache and numItems is None:
-            # lock needed because pylibmc(memcached client) is not threadsafe
-            cacheLock = threading.Lock()
-
-            # check if credentials and location exist, otherwise assume
-            # location is 127.0.0.1 (localhost) with no password
-            url = config.getConfig('cache_memcached_url')
-            if not url:
-                url = '127.0.0.1'
-            memcachedUsername = config.getConfig('cache_memcached_username')
-            if not memcachedUsername:
-                memcachedUsername = None
-            memcachedPassword = config.getConfig('cache_memcached_password')
-            if not memcachedPassword:
-                memcachedPassword = None
+        if numItems is None:
+            if cacheBackend == 'memcached' and MemCache:
+                cache = self.getMemCache()
+            elif cacheBackend == 'shared' and SharedMemCache:
+                cache = self.getSharedCache()
+            elif cacheBackend == 'disk':
+                cache = self.getDiskCache()
+        if cache is not None:
             try:
-                cache = MemCache(url, memcachedUsername, memcachedPassword,
-                                 mustBeAvailable=True)
-            except Exception:
-                config.getConfig('logger').info('Cannot use memcached for caching.')
-                cache = None
+                l1Size = int(config.getConfig('cache_l1_size') or 0)
+            except ValueError:
+                l1Size = 0
+            if l1Size > 0:
+                cache = LayeredCache(LRUCache(l1Size, getsizeof=estimateSize), cache)
+                cacheBackend = 'python and %s' % cacheBackend
+        # A lock is needed because pylibmc (the memcached client) and
+        # cachetools are not threadsafe.  The shared and disk caches are, but
+        # use a lock for consistency.
+        cacheLock = threading.Lock()
         if cache is None:  # fallback backend
             cacheBackend = 'python'
-            cache = LRUCache(self.getCacheSize(numItems))
-            cacheLock = threading.Lock()
+            if numItems is None:
+                # The tile cache is limited by the memory used by the values
+                cache = LRUCache(self.getCacheByteSize(), getsizeof=estimateSize)
+            else:
+                cache = LRUCache(self.getCacheSize(numItems))
         if numItems is None and not CacheFactory.logged:
             config.getConfig('logprint').info('Using %s for large_image caching' % cacheBackend)
             CacheFactory.logged = True
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import cachetools
+import errno
+import hashlib
+import os
+import stat
+import tempfile
+import threading
+import time
+from six.moves import cPickle as pickle
+
+from .. import config
+
+
+# os.replace is atomic even if the destination exists, but isn't in Python 2
+_replace = getattr(os, 'replace', os.rename)
+
+
+def defaultDiskCachePath():
+    """
+    Get the default directory of the disk cache.  The directory name includes
+    the user id, so each user has their own directory.
+
+    :returns: a directory path.
+    """
+    return os.path.join(tempfile.gettempdir(), 'large_image_disk_cache_%d' % os.getuid())
+
+
+class DiskCache(cachetools.Cache):
+    """
+    Use a directory as a persistent cache that survives restarts and can be
+    shared by processes on a host.
+
+    Each value is pickled into its own file in a subdirectory based on the
+    SHA-256 hash of its key.  Files are written to a temporary name and
+    renamed so that a partial value is never read.  Reading a value updates
+    the file's modification time, and when the cache exceeds its size, the
+    least recently used files are removed.
+
+    Since other processes may write to the same directory, the size of the
+    cache is periodically recomputed from its files.  This and eviction are
+    done in a background thread so that they don't delay a caller.
+
+    Since values are unpickled, the directory must be owned by the current
+    user and must not be writable by anyone else.
+    """
+
+    # When the cache is too large, remove files until it is this fraction of
+    # the maximum size, so that eviction doesn't happen on every write.
+    evictFraction = 0.9
+    # Recompute the size of the cache from its files at most this often in
+    # seconds, unless this process's writes make it too large.
+    scanInterval = 60
+    tempPrefix = '.tmp'
+
+    def __init__(self, path=None, size=None, getsizeof=None):
+        """
+        Open or create a disk cache.
+
+        :param path: the cache directory.  If None, a directory in the temp
+            directory is used.
+        :param size: the maximum size of the cache in bytes.  If None, 4 GB
+            is used.
+        """
+        super(DiskCache, self).__init__(0, getsizeof=getsizeof)
+        self.path = path or defaultDiskCachePath()
+        self._maxsize = int(size or 4 * 1024 ** 3)
+        try:
+            os.makedirs(self.path, 0o700)
+        except OSError:
+            if not os.path.isdir(self.path):
+                raise
+        pathStat = os.lstat(self.path)
+        if (not stat.S_ISDIR(pathStat.st_mode) or pathStat.st_uid != os.getuid() or
+                pathStat.st_mode & 0o022):
+            raise ValueError(
+                '%s must be a directory that only the current user can write to' % self.path)
+        self._sizeLock = threading.Lock()
+        self._currsize, self._count = 0, 0
+        self._lastScan = None
+        self._scanThread = None
+        # files this instance changes while a scan is in progress
+        self._scanChanges = None
+        # files this instance is changing and their sizes before the change
+        self._changing = {}
+        self._rescan = False
+        self._scheduleScan()
+
+    def __repr__(self):
+        return 'DiskCache(%r)' % self.path
+
+    def _filePath(self, key):
+        hashedKey = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.path, hashedKey[:2], hashedKey[2:])
+
+    def _listFiles(self):
+        """
+        List the files in the cache.
+
+        :returns: a list of (modification time, size, path) tuples.
+        """
+        files = []
+        for shard in os.listdir(self.path):
+            shardPath = os.path.join(self.path, shard)
+            if not os.path.isdir(shardPath):
+                continue
+            for name in os.listdir(shardPath):
+                if name.startswith(self.tempPrefix):
+                    continue
+                filePath = os.path.join(shardPath, name)
+                try:
+                    fileStat = os.stat(filePath)
+                except OSError:
+                    continue  # removed by another process
+                files.append((fileStat.st_mtime, fileStat.st_size, filePath))
+        return files
+
+    def _scheduleScan(self, force=False):
+        """
+        Recompute the size of the cache in a background thread if it hasn't
+        been done recently.
+
+        :param force: if True, recompute the size even if it was done
+            recently.  If a scan is in progress, another is done after it.
+        """
+        with self._sizeLock:
+            if self._scanThread is not None:
+                self._rescan = self._rescan or force
+                return
+            if (not force and self._lastScan is not None and
+                    time.time() - self._lastScan < self.scanInterval):
+                return
+            self._scanThread = threading.Thread(target=self._scanLoop)
+            self._scanThread.daemon = True
+            self._scanThread.start()
+
+    def _scanLoop(self):
+        """
+        Scan the cache until no further scans are requested.  This is run in
+        a background thread.
+        """
+        while True:
+            try:
+                self._scan()
+            except Exception as exc:
+                config.getConfig('logprint').error(
+                    'Failed to scan disk cache %s: %s' % (self.path, exc))
+            with self._sizeLock:
+                self._lastScan = time.time()
+                if not self._rescan:
+                    self._scanThread = None
+                    return
+                self._rescan = False
+
+    def _waitForScan(self):
+        """
+        Wait for a background scan of the cache to finish, if there is one.
+        """
+        thread = self._scanThread
+        if thread is not None:
+            thread.join()
+
+    def _scan(self):
+        """
+        Compute the size of the cache from its files, which includes values
+        written by other processes.  If this exceeds the maximum size, remove
+        the least recently used files until the cache is below its eviction
+        size.
+        """
+        with self._sizeLock:
+            self._scanChanges = set(self._changing)
+        try:
+            files = self._listFiles()
+            listedSizes = {filePath: fileSize for _, fileSize, filePath in files}
+            currsize = sum(listedSizes.values())
+            if currsize > self._maxsize:
+                for _, fileSize, filePath in sorted(files):
+                    if currsize <= self._maxsize * self.evictFraction:
+                        break
+                    try:
+                        os.unlink(filePath)
+                    except OSError:
+                        pass
+                    currsize -= fileSize
+                    del listedSizes[filePath]
+        finally:
+            with self._sizeLock:
+                changes, self._scanChanges = self._scanChanges, None
+        with self._sizeLock:
+            currsize, count = self._adjustForChanges(currsize, listedSizes, changes)
+            self._currsize, self._count = currsize, count
+
+    def _adjustForChanges(self, currsize, listedSizes, changes):
+        """
+        Adjust the size of the cache found by a scan for files that this
+        instance changed during the scan, since the scan may or may not have
+        seen the changes.  Files that are still being changed are counted at
+        their size before the change, since the change is counted when it is
+        done.  The size lock must be held.
+
+        :param currsize: the size of the listed files.
+        :param listedSizes: a dictionary of the listed file paths and sizes.
+        :param changes: a set of the file paths that were changed.
+        :returns: the size and number of files in the cache.
+        """
+        count = len(listedSizes)
+        for filePath in changes:
+            if filePath in self._changing:
+                fileSize = self._changing[filePath]
+            else:
+                try:
+                    fileSize = os.path.getsize(filePath)
+                except OSError:
+                    fileSize = None
+            listedSize = listedSizes.get(filePath)
+            currsize += (fileSize or 0) - (listedSize or 0)
+            count += (fileSize is not None) - (listedSize is not None)
+        return currsize, count
+
+    def _beginChange(self, filePath, oldSize):
+        """
+        Note that this instance is about to write or remove a file.
+
+        :param filePath: the path of the file.
+        :param oldSize: the size of the file or None if it doesn't exist.
+        """
+        with self._sizeLock:
+            self._changing.setdefault(filePath, oldSize)
+            if self._scanChanges is not None:
+                self._scanChanges.add(filePath)
+
+    def _endChange(self, filePath, sizeDelta, countDelta):
+        """
+        Count a change to a file that this instance wrote or removed.
+
+        :param filePath: the path of the file.
+        :param sizeDelta: the change in the size of the cache in bytes.
+        :param countDelta: the change in the number of files.
+        :returns: True if the cache is larger than its maximum size.
+        """
+        with self._sizeLock:
+            self._changing.pop(filePath, None)
+            if self._scanChanges is not None:
+                self._scanChanges.add(filePath)
+            self._currsize = max(0, self._currsize + sizeDelta)
+            self._count = max(0, self._count + countDelta)
+            return self._currsize > self._maxsize
+
+    def __getitem__(self, key):
+        filePath = self._filePath(key)
+        try:
+            with open(filePath, 'rb') as fptr:
+                data = fptr.read()
+        except EnvironmentError:
+            return self.__missing__(key)
+        try:
+            # Mark the file as recently used
+            os.utime(filePath, None)
+        except OSError:
+            pass
+        try:
+            return pickle.loads(data)
+        except Exception:
+            # This can happen if a different version of python wrote the
+            # record.
+            raise ValueError('Cannot load cached value')
+
+    def __setitem__(self, key, value):
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            raise ValueError('Cannot pickle value')
+        if len(data) > self._maxsize:
+            raise ValueError('value too large')
+        filePath = self._filePath(key)
+        try:
+            oldSize = os.path.getsize(filePath)
+        except OSError:
+            oldSize = None
+        self._beginChange(filePath, oldSize)
+        written = False
+        try:
+            written = self._writeFile(filePath, data)
+        finally:
+            overfull = self._endChange(
+                filePath, len(data) - (oldSize or 0) if written else 0,
+                1 if written and oldSize is None else 0)
+        if written:
+            self._scheduleScan(overfull)
+
+    def _writeFile(self, filePath, data):
+        """
+        Write a file by writing a temporary file and renaming it.
+
+        :param filePath: the destination path.
+        :param data: the data to write.
+        :returns: True if the file was written, False if it could not be.
+        """
+        shardPath = os.path.dirname(filePath)
+        tempPath = None
+        try:
+            if not os.path.isdir(shardPath):
+                try:
+                    os.makedirs(shardPath)
+                except OSError:
+                    # another process may have made the directory
+                    if not os.path.isdir(shardPath):
+                        raise
+            fd, tempPath = tempfile.mkstemp(dir=shardPath, prefix=self.tempPrefix)
+            with os.fdopen(fd, 'wb') as fptr:
+                fptr.write(data)
+            _replace(tempPath, filePath)
+        except EnvironmentError as exc:
+            if tempPath:
+                try:
+                    os.unlink(tempPath)
+                except OSError:
+                    pass
+            if exc.errno == errno.ENOSPC:
+                config.getConfig('logprint').info('Disk cache is out of space')
+                self._scheduleScan(True)
+            else:
+                config.getConfig('logprint').error(
+                    'Failed to write disk cache file %s: %s' % (filePath, exc))
+            return False
+        return True
+
+    def __delitem__(self, key):
+        filePath = self._filePath(key)
+        try:
+            fileSize = os.path.getsize(filePath)
+        except OSError:
+            raise KeyError(key)
+        self._beginChange(filePath, fileSize)
+        removed = False
+        try:
+            os.unlink(filePath)
+            removed = True
+        except OSError:
+            raise KeyError(key)
+        finally:
+            self._endChange(filePath, -fileSize if removed else 0, -1 if removed else 0)
+
+    def __contains__(self, key):
+        return os.path.exists(self._filePath(key))
+
+    def __iter__(self):
+        # keys are only stored as hashes, so they can't be listed
+        return iter(())
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def currsize(self):
+        return self._currsize
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    def clear(self):
+        """
+        Remove all values from the cache.  This affects all processes using
+        the cache directory.
+        """
+        for _, _, filePath in self._listFiles():
+            try:
+                os.unlink(filePath)
+            except OSError:
+                pass
+        with self._sizeLock:
+            self._currsize, self._count = 0, 0
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import cachetools
+import six
+
+
+class LayeredCache(cachetools.Cache):
+    """
+    Check a small in-process cache (L1) before a slower or shared cache (L2),
+    such as memcached.  Values found in L2 are copied to L1, and values that
+    are stored are written to both.  Hits and misses are counted for each
+    tier.  Like cachetools caches, this is not thread safe.
+    """
+
+    def __init__(self, l1, l2, getsizeof=None):
+        """
+        Create a layered cache.
+
+        :param l1: the cache to check first.  This is usually a cachetools
+            LRUCache.
+        :param l2: the cache to check if a value is not in l1.
+        """
+        super(LayeredCache, self).__init__(0, getsizeof=getsizeof)
+        self.l1 = l1
+        self.l2 = l2
+        self.stats = {
+            'l1': {'hits': 0, 'misses': 0},
+            'l2': {'hits': 0, 'misses': 0},
+        }
+
+    def __repr__(self):
+        return 'LayeredCache(%r, %r)' % (self.l1, self.l2)
+
+    def _setL1(self, key, value):
+        try:
+            self.l1[key] = value
+        except ValueError:
+            pass  # value too large
+
+    def __getitem__(self, key):
+        try:
+            value = self.l1[key]
+            self.stats['l1']['hits'] += 1
+            return value
+        except KeyError:
+            self.stats['l1']['misses'] += 1
+        try:
+            value = self.l2[key]
+        except KeyError:
+            self.stats['l2']['misses'] += 1
+            return self.__missing__(key)
+        self.stats['l2']['hits'] += 1
+        self._setL1(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._setL1(key, value)
+        self.l2[key] = value
+
+    def __delitem__(self, key):
+        try:
+            del self.l1[key]
+        except KeyError:
+            pass
+        del self.l2[key]
+
+    def __contains__(self, key):
+        return key in self.l1 or key in self.l2
+
+    def __iter__(self):
+        return iter(self.l1)
+
+    def __len__(self):
+        return len(self.l1)
+
+    @property
+    def currsize(self):
+        return self.l1.currsize
+
+    @property
+    def maxsize(self):
+        return self.l1.maxsize
+
+    def clear(self):
+        """
+        Clear the in-process cache.  The L2 cache may be used by other
+        processes, so it is not cleared.
+        """
+        self.l1.clear()
+
+    def getMany(self, keys):
+        """
+        Get multiple values, checking the L2 cache for all of the values that
+        aren't in L1 at once if it supports getMany.
+
+        :param keys: a list of keys.
+        :returns: a dictionary of the keys that were found and their values.
+        """
+        found = {}
+        l2keys = []
+        for key in keys:
+            try:
+                found[key] = self.l1[key]
+            except KeyError:
+                l2keys.append(key)
+        self.stats['l1']['hits'] += len(found)
+        self.stats['l1']['misses'] += len(l2keys)
+        if not l2keys:
+            return found
+        if hasattr(self.l2, 'getMany'):
+            l2found = self.l2.getMany(l2keys)
+        else:
+            l2found = {}
+            for key in l2keys:
+                try:
+                    l2found[key] = self.l2[key]
+                except (KeyError, ValueError):
+                    pass
+        self.stats['l2']['hits'] += len(l2found)
+        self.stats['l2']['misses'] += len(l2keys) - len(l2found)
+        for key, value in six.iteritems(l2found):
+            self._setL1(key, value)
+        found.update(l2found)
+        return found
+
+    def setMany(self, items):
+        """
+        Store multiple values in both tiers, using the L2 cache's setMany if
+        it has one.
+
+        :param items: a dictionary of keys and values to store.
+        :returns: a list of the keys that were stored in the L2 cache or None
+            if the L2 cache doesn't report this.
+        """
+        for key, value in six.iteritems(items):
+            self._setL1(key, value)
+        if hasattr(self.l2, 'setMany'):
+            return self.l2.setMany(items)
+        stored = []
+        for key, value in six.iteritems(items):
+            try:
+                self.l2[key] = value
+                stored.append(key)
+            except (KeyError, ValueError):
+                pass  # the value was refused
+        return stored
@@ -132,3 +132,51 @@ class MemCache(cachetools.Cache):
             if 'SUCCESS' not in repr(exc.args):
                 self.logError(pylibmc.Error, config.getConfig('logprint').exception,
                               'pylibmc exception')
+
+    def getMany(self, keys):
+        """
+        Get multiple values from memcached in a single request.
+
+        :param keys: a list of keys.
+        :returns: a dictionary of the keys that were found and their values.
+            Keys that are not in the cache are not in the dictionary.
+        """
+        hashedKeys = {hashlib.sha256(key.encode()).hexdigest(): key for key in keys}
+        try:
+            values = self._client.get_multi(list(hashedKeys))
+        except pylibmc.ServerDown:
+            self.logError(pylibmc.ServerDown, config.getConfig('logprint').info,
+                          'Memcached ServerDown')
+            return {}
+        except pylibmc.Error:
+            self.logError(pylibmc.Error, config.getConfig('logprint').exception,
+                          'pylibmc exception')
+            return {}
+        return {hashedKeys[hashedKey]: value for hashedKey, value in six.iteritems(values)}
+
+    def setMany(self, items):
+        """
+        Store multiple values in memcached in a single request.
+
+        :param items: a dictionary of keys and values to store.
+        """
+        hashedItems = {hashlib.sha256(key.encode()).hexdigest(): value
+                       for key, value in six.iteritems(items)}
+        try:
+            self._client.set_multi(hashedItems)
+        except TypeError:
+            self.logError(
+                TypeError, config.getConfig('logprint').error,
+                'Failed to save values with keys %r' % list(hashedItems))
+        except KeyError:
+            self.logError(
+                KeyError, config.getConfig('logprint').error,
+                'Failed to save values with keys %r' % list(hashedItems))
+        except pylibmc.ServerDown:
+            self.logError(pylibmc.ServerDown, config.getConfig('logprint').info,
+                          'Memcached ServerDown')
+        except pylibmc.Error as exc:
+            # See __setitem__; values that are too large are not an error.
+            if 'SUCCESS' not in repr(exc.args):
+                self.logError(pylibmc.Error, config.getConfig('logprint').exception,
+                              'pylibmc exception')
@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+
+#############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#############################################################################
+
+import cachetools
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import six
+import stat
+import struct
+import tempfile
+import threading
+from six.moves import cPickle as pickle
+
+# lockf locks never conflict within a process, so caches that use the same
+# file in one process share a thread lock.
+_pathLocks = {}
+_pathLocksLock = threading.Lock()
+
+
+def _pathLock(path):
+    """
+    Get the thread lock used by all caches in this process for a file.
+
+    :param path: the path of the cache file.
+    :returns: a reentrant lock.
+    """
+    path = os.path.realpath(path)
+    with _pathLocksLock:
+        if path not in _pathLocks:
+            _pathLocks[path] = threading.RLock()
+        return _pathLocks[path]
+
+
+def defaultSharedCachePath():
+    """
+    Get the default path of the shared cache file.  This is in /dev/shm if it
+    exists, since that is memory backed, and otherwise in the temp directory.
+
+    The file name includes the user id, so each user has their own file, and
+    the layout version, so a different version of this module uses its own
+    file.
+
+    :returns: a file path.
+    """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        base = '/dev/shm'
+    else:
+        base = tempfile.gettempdir()
+    return os.path.join(base, 'large_image_cache_%d_v%d' % (
+        os.getuid(), SharedMemCache.version))
+
+
+class SharedMemCache(cachetools.Cache):
+    """
+    Use a memory-mapped file as a cache that is shared by all processes on a
+    host.
+
+    The file is divided into size classes, each of which is a set-associative
+    table of fixed-size slots.  A value is pickled and stored in the smallest
+    class whose slots can hold it; each key maps to a single set of slots per
+    class, and when a set is full, a slot is evicted using the CLOCK
+    algorithm.  Keys are stored as SHA-256 digests.  Access from different
+    processes is coordinated with a lock on the file.
+
+    Once the file exists, its layout is used as is; remove the file to use a
+    different size.  Since other processes may have the file mapped, an
+    existing file is never reinitialized; if it isn't a cache file with the
+    same layout version, an error is raised.  Since values are unpickled,
+    the file must be owned by the current user and must not be accessible by
+    anyone else.
+    """
+
+    magic = b'LISC'
+    version = 1
+    # number of slots in each set
+    ways = 8
+    # slot data sizes in bytes
+    defaultSizeClasses = tuple(16 * 1024 * 2 ** power for power in range(8))
+    # magic, version, number of classes, ways, bytes used, items stored
+    headerFormat = '<4sIIIQQ'
+    # data size, number of sets, offset of the clock hands, offset of the slots
+    classFormat = '<QQQQ'
+    classTableOffset = 64
+    headerSize = 4096
+    # key digest, data length, reference bit
+    slotFormat = '<32sIB3x'
+    slotHeaderSize = struct.calcsize(slotFormat)
+    emptyDigest = b'\0' * 32
+
+    def __init__(self, path=None, size=None, sizeClasses=None, getsizeof=None):
+        """
+        Open or create a shared cache.
+
+        :param path: the path of the cache file.  If None, a file in /dev/shm
+            or the temp directory is used.
+        :param size: the approximate size of the cache in bytes.  This is only
+            used when the file is created.  If None, 1 GB is used.
+        :param sizeClasses: a list of slot sizes in bytes.  This is only used
+            when the file is created.  If None, sizes from 16 kB to 2 MB are
+            used.  Values larger than the largest size are not cached.
+        """
+        super(SharedMemCache, self).__init__(0, getsizeof=getsizeof)
+        self.path = path or defaultSharedCachePath()
+        self._threadLock = _pathLock(self.path)
+        self._mmap = None
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            fileStat = os.fstat(self._fd)
+            if (not stat.S_ISREG(fileStat.st_mode) or fileStat.st_uid != os.getuid() or
+                    fileStat.st_mode & 0o077):
+                raise ValueError(
+                    '%s must be a file that only the current user can access' % self.path)
+            with self._locked(fcntl.LOCK_EX):
+                if not os.fstat(self._fd).st_size:
+                    self._createLayout(size or 1024 ** 3, sizeClasses or self.defaultSizeClasses)
+                elif not self._readLayout():
+                    raise ValueError('%s is not a compatible shared cache file' % self.path)
+        except Exception:
+            self._close()
+            raise
+
+    def __del__(self):
+        self._close()
+
+    def _close(self):
+        if getattr(self, '_mmap', None) is not None:
+            self._mmap.close()
+            self._mmap = None
+        if getattr(self, '_fd', None) is not None:
+            # Closing any descriptor of the file releases this process's locks
+            # on it, so don't close it while another cache holds the lock.
+            with self._threadLock:
+                os.close(self._fd)
+                self._fd = None
+
+    def __repr__(self):
+        return 'SharedMemCache(%r)' % self.path
+
+    @contextlib.contextmanager
+    def _locked(self, mode):
+        """
+        Lock the cache against other threads and processes.
+
+        :param mode: fcntl.LOCK_SH or fcntl.LOCK_EX.
+        """
+        with self._threadLock:
+            # lockf locks belong to the process, so they still work if the
+            # cache is used after a fork.
+            fcntl.lockf(self._fd, mode)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _readLayout(self):
+        """
+        Read the layout of an existing cache file.  The file is not modified.
+
+        :returns: True if the file has a valid layout.
+        """
+        fileSize = os.fstat(self._fd).st_size
+        if fileSize < self.headerSize:
+            return False
+        self._mmap = mmap.mmap(self._fd, fileSize)
+        magic, version, numClasses, ways, _, _ = struct.unpack_from(
+            self.headerFormat, self._mmap, 0)
+        if magic != self.magic or version != self.version or ways != self.ways:
+            self._mmap.close()
+            self._mmap = None
+            return False
+        self._classes = [struct.unpack_from(
+            self.classFormat, self._mmap,
+            self.classTableOffset + idx * struct.calcsize(self.classFormat))
+            for idx in range(numClasses)]
+        end = max(slotsOffset + numSets * self.ways * (self.slotHeaderSize + dataSize)
+                  for dataSize, numSets, _, slotsOffset in self._classes)
+        if end > fileSize:
+            self._mmap.close()
+            self._mmap = None
+            return False
+        return True
+
+    def _createLayout(self, size, sizeClasses):
+        """
+        Initialize an empty cache file.  Each size class receives an equal
+        share of the size.
+
+        :param size: the approximate size of the cache in bytes.
+        :param sizeClasses: a list of slot sizes in bytes.
+        """
+        sizeClasses = sorted(sizeClasses)
+        if (len(sizeClasses) * struct.calcsize(self.classFormat) >
+                self.headerSize - self.classTableOffset):
+            raise ValueError('Too many size classes')
+        self._classes = []
+        offset = self.headerSize
+        for dataSize in sizeClasses:
+            stride = self.slotHeaderSize + dataSize
+            numSets = max(1, size // len(sizeClasses) // (stride * self.ways))
+            handsOffset = offset
+            offset += (numSets + 7) // 8 * 8
+            self._classes.append((dataSize, numSets, handsOffset, offset))
+            offset += numSets * self.ways * stride
+        os.ftruncate(self._fd, offset)
+        self._mmap = mmap.mmap(self._fd, offset)
+        for idx, entry in enumerate(self._classes):
+            struct.pack_into(
+                self.classFormat, self._mmap,
+                self.classTableOffset + idx * struct.calcsize(self.classFormat), *entry)
+        struct.pack_into(self.headerFormat, self._mmap, 0, self.magic, self.version,
+                         len(self._classes), self.ways, 0, 0)
+
+    def _digest(self, key):
+        return hashlib.sha256(key.encode()).digest()
+
+    def _slots(self, digest):
+        """
+        Yield the slots where a key could be stored.
+
+        :param digest: the key digest.
+        :yields: (class index, set index, way, slot offset).
+        """
+        hashValue = struct.unpack('<Q', digest[:8])[0]
+        for classIdx, (dataSize, numSets, _, slotsOffset) in enumerate(self._classes):
+            setIdx = hashValue % numSets
+            stride = self.slotHeaderSize + dataSize
+            offset = slotsOffset + setIdx * self.ways * stride
+            for way in range(self.ways):
+                yield classIdx, setIdx, way, offset + way * stride
+
+    def _find(self, digest):
+        """
+        Find the slot that holds a key.
+
+        :param digest: the key digest.
+        :returns: the slot offset or None.
+        """
+        for _, _, _, offset in self._slots(digest):
+            if self._mmap[offset:offset + 32] == digest:
+                return offset
+        return None
+
+    def _adjustUsage(self, bytesDelta, itemsDelta):
+        used, items = struct.unpack_from('<QQ', self._mmap, 16)
+        struct.pack_into('<QQ', self._mmap, 16, max(0, used + bytesDelta),
+                         max(0, items + itemsDelta))
+
+    def _clearSlot(self, offset):
+        """
+        Remove the value in a slot.  The cache must be exclusively locked.
+
+        :param offset: the slot offset.
+        """
+        digest, length, _ = struct.unpack_from(self.slotFormat, self._mmap, offset)
+        if digest != self.emptyDigest:
+            struct.pack_into(self.slotFormat, self._mmap, offset, self.emptyDigest, 0, 0)
+            self._adjustUsage(-length, -1)
+
+    def _pickSlot(self, digest, classIdx):
+        """
+        Pick a slot in a size class for a key, evicting a value if needed.
+        The cache must be exclusively locked.
+
+        :param digest: the key digest.
+        :param classIdx: the size class.
+        :returns: the slot offset.
+        """
+        dataSize, numSets, handsOffset, slotsOffset = self._classes[classIdx]
+        setIdx = struct.unpack('<Q', digest[:8])[0] % numSets
+        stride = self.slotHeaderSize + dataSize
+        setOffset = slotsOffset + setIdx * self.ways * stride
+        for way in range(self.ways):
+            offset = setOffset + way * stride
+            if self._mmap[offset:offset + 32] == self.emptyDigest:
+                return offset
+        hand = struct.unpack_from('<B', self._mmap, handsOffset + setIdx)[0] % self.ways
+        while True:
+            offset = setOffset + hand * stride
+            hand = (hand + 1) % self.ways
+            if not struct.unpack_from('<B', self._mmap, offset + 36)[0]:
+                break
+            struct.pack_into('<B', self._mmap, offset + 36, 0)
+        struct.pack_into('<B', self._mmap, handsOffset + setIdx, hand)
+        self._clearSlot(offset)
+        return offset
+
+    def _load(self, digest):
+        """
+        Get the pickled data for a key.  The cache must be locked.
+
+        :param digest: the key digest.
+        :returns: the pickled data or None.
+        """
+        offset = self._find(digest)
+        if offset is None:
+            return None
+        length = struct.unpack_from('<I', self._mmap, offset + 32)[0]
+        start = offset + self.slotHeaderSize
+        data = self._mmap[start:start + length]
+        # This races with other readers, but they would all set it.
+        struct.pack_into('<B', self._mmap, offset + 36, 1)
+        return data
+
+    def _store(self, digest, data):
+        """
+        Store pickled data for a key.  The cache must be exclusively locked.
+
+        :param digest: the key digest.
+        :param data: the pickled data.
+        """
+        offset = self._find(digest)
+        if offset is not None:
+            self._clearSlot(offset)
+        classIdx = [idx for idx, entry in enumerate(self._classes) if entry[0] >= len(data)][0]
+        offset = self._pickSlot(digest, classIdx)
+        start = offset + self.slotHeaderSize
+        self._mmap[start:start + len(data)] = data
+        # Write the digest last so a partial value is never found
+        struct.pack_into(self.slotFormat, self._mmap, offset, self.emptyDigest, len(data), 1)
+        self._mmap[offset:offset + 32] = digest
+        self._adjustUsage(len(data), 1)
+
+    def _pickle(self, value):
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            raise ValueError('Cannot pickle value')
+        if len(data) > self._classes[-1][0]:
+            raise ValueError('value too large')
+        return data
+
+    def _unpickle(self, data):
+        try:
+            return pickle.loads(data)
+        except Exception:
+            # This can happen if a different version of python wrote the
+            # record.
+            raise ValueError('Cannot load cached value')
+
+    def __getitem__(self, key):
+        digest = self._digest(key)
+        with self._locked(fcntl.LOCK_SH):
+            data = self._load(digest)
+        if data is None:
+            return self.__missing__(key)
+        return self._unpickle(data)
+
+    def __setitem__(self, key, value):
+        data = self._pickle(value)
+        digest = self._digest(key)
+        with self._locked(fcntl.LOCK_EX):
+            self._store(digest, data)
+
+    def __delitem__(self, key):
+        digest = self._digest(key)
+        with self._locked(fcntl.LOCK_EX):
+            offset = self._find(digest)
+            if offset is None:
+                raise KeyError(key)
+            self._clearSlot(offset)
+
+    def __contains__(self, key):
+        digest = self._digest(key)
+        with self._locked(fcntl.LOCK_SH):
+            return self._find(digest) is not None
+
+    def __iter__(self):
+        # keys are only stored as digests, so they can't be listed
+        return iter(())
+
+    def __len__(self):
+        return struct.unpack_from('<Q', self._mmap, 24)[0]
+
+    @property
+    def currsize(self):
+        return struct.unpack_from('<Q', self._mmap, 16)[0]
+
+    @property
+    def maxsize(self):
+        return sum(dataSize * numSets * self.ways
+                   for dataSize, numSets, _, _ in self._classes)
+
+    def clear(self):
+        """
+        Remove all values from the cache.  This affects all processes using
+        the cache.
+        """
+        with self._locked(fcntl.LOCK_EX):
+            for dataSize, numSets, _, slotsOffset in self._classes:
+                stride = self.slotHeaderSize + dataSize
+                for slot in range(numSets * self.ways):
+                    offset = slotsOffset + slot * stride
+                    self._mmap[offset:offset + 32] = self.emptyDigest
+            struct.pack_into('<QQ', self._mmap, 16, 0, 0)
+
+    def getMany(self, keys):
+        """
+        Get multiple values from the cache with a single lock.
+
+        :param keys: a list of keys.
+        :returns: a dictionary of the keys that were found and their values.
+        """
+        found = {}
+        with self._locked(fcntl.LOCK_SH):
+            for key in keys:
+                data = self._load(self._digest(key))
+                if data is not None:
+                    found[key] = data
+        return {key: self._unpickle(data) for key, data in six.iteritems(found)}
+
+    def setMany(self, items):
+        """
+        Store multiple values in the cache with a single lock.  Values that
+        are too large or can't be pickled are skipped.
+
+        :param items: a dictionary of keys and values to store.
+        :returns: a list of the keys that were stored.
+        """
+        pickled = {}
+        for key, value in six.iteritems(items):
+            try:
+                pickled[key] = self._pickle(value)
+            except ValueError:
+                pass  # value too large
+        with self._locked(fcntl.LOCK_EX):
+            for key, data in six.iteritems(pickled):
+                self._store(self._digest(key), data)
+        return list(pickled)
@@ -12,15 +12,56 @@ ConfigValues = {
     'logger': fallbackLogger,
     'logprint': fallbackLogger,
 
-    'cache_backend': 'python',  # 'python' or 'memcached'
+    'cache_backend': 'python',  # 'python', 'memcached', 'shared', or 'disk'
     # 'python' cache can use 1/(val) of the available memory
     'cache_python_memory_portion': 32,
+    # if set, the 'python' tile cache uses this many bytes instead
+    'cache_python_memory_size': None,
     # cache_memcached_url may be a list
     'cache_memcached_url': '127.0.0.1',
     'cache_memcached_username': None,
     'cache_memcached_password': None,
+    # 'shared' cache is a memory-mapped file used by all processes on a host.
+    # The path defaults to a per-user file in /dev/shm or the temp directory,
+    # and the file must only be accessible by the current user.  The size is
+    # in bytes and defaults to the same size as the 'python' cache; it only
+    # applies when the file is created.
+    'cache_shared_path': None,
+    'cache_shared_size': None,
+    # 'disk' cache is a directory that persists across restarts.  The path
+    # defaults to a per-user directory in the temp directory, and the
+    # directory must only be writable by the current user.  The size is in
+    # bytes.
+    'cache_disk_path': None,
+    'cache_disk_size': 4 * 1024 ** 3,
+    # Tiles of levels that are missing from a file are made from higher
+    # resolution levels.  If this is a directory path, each made tile is
+    # stored there, so the levels persist across restarts and are shared by
+    # processes, and each missing level is made from the next level.  The
+    # size is in bytes.
+    'cache_synthesized_levels_path': None,
+    'cache_synthesized_levels_size': 4 * 1024 ** 3,
+    # If positive, a 'python' cache of this many bytes is checked before a
+    # 'memcached', 'shared', or 'disk' cache.
+    'cache_l1_size': 0,
 
     'max_small_image_size': 4096,
+
+    # getRegion can fetch and decode tiles using a pool of this many threads.
+    # 0 or 1 assembles regions serially.
+    'region_threads': 0,
+
+    # How the TIFF source reads raw tile data: 'mmap' maps each file once and
+    # slices tiles from it without copying, 'pread' reads tiles from one file
+    # descriptor per file, and 'libtiff' reads each tile through libtiff.
+    # Files that can't be mapped use 'pread'.
+    'tiff_read_mode': 'mmap',
+
+    # The largest width or height in pixels of a region that the OpenSlide
+    # source reads to make one tile.  Lower resolution levels that would need
+    # more are made from the next level instead.  If None, this is based on
+    # the available memory.
+    'openslide_max_read_size': None,
 }
 
 
@@ -2,14 +2,19 @@
 
 import math
 import numpy
+import os
 import PIL
 import PIL.Image
 import PIL.ImageColor
 import PIL.ImageDraw
 import six
+import struct
+import threading
+from multiprocessing.pool import ThreadPool
 from six import BytesIO
 
-from ..cache_util import getTileCache, strhash, methodcache
+from ..cache_util import getTileCache, getSynthesizedLevelCache, strhash, methodcache, \
+    methodcacheMany
 from ..constants import SourcePriority, \
     TILE_FORMAT_IMAGE, TILE_FORMAT_NUMPY, TILE_FORMAT_PIL, \
     TileOutputMimeTypes, TileOutputPILFormat, TileInputUnits
@@ -20,14 +25,150 @@ from .. import exceptions
 # Turn off decompression warning check
 PIL.Image.MAX_IMAGE_PIXELS = None
 
+# The thread pool used for concurrent region assembly.  This is a tuple of
+# (number of threads, pool), created as needed.
+_regionPool = None
+_regionPoolLock = threading.Lock()
+_regionPoolThread = threading.local()
+
+
+def _getRegionPool():
+    """
+    Get the thread pool used to fetch tiles concurrently when assembling a
+    region.  The pool is sized based on the 'region_threads' config value and
+    is recreated if that value changes.  Threads in the pool never use the
+    pool themselves, as that could deadlock.
+
+    :returns: a ThreadPool or None if tiles should be fetched serially.
+    """
+    global _regionPool
+
+    try:
+        threads = int(config.getConfig('region_threads') or 0)
+    except (TypeError, ValueError):
+        threads = 0
+    if threads <= 1 or getattr(_regionPoolThread, 'active', False):
+        return None
+    oldPool = None
+    with _regionPoolLock:
+        if _regionPool is None or _regionPool[0] != threads:
+            if _regionPool is not None:
+                oldPool = _regionPool[1]
+            _regionPool = (threads, ThreadPool(threads))
+        pool = _regionPool[1]
+    if oldPool is not None:
+        # Let any outstanding work finish in the old pool, then release its
+        # threads.  This is done outside of the lock so other callers can use
+        # the new pool while we wait.
+        oldPool.close()
+        oldPool.join()
+    return pool
+
+
+def _loadRegionTile(tile):
+    """
+    Load the image data of a tile from a tile iterator.  This is run in the
+    region thread pool.
+
+    :param tile: a LazyTileDict.
+    :returns: the tile, with its image data loaded.
+    """
+    _regionPoolThread.active = True
+    # Accessing the tile key fetches and decodes the image data
+    tile['tile']
+    return tile
+
+
+def _imageToPIL(image):
+    """
+    Convert an image to a PIL image.  Numpy arrays may have any number of
+    bands and any integer or floating point data type; they are reduced to 8
+    bits per sample.  Unsigned and signed integers keep their most significant
+    byte, and floating point values are expected to be in the range [0, 1].
+    Arrays with more than four bands use their first band.
+
+    :param image: a PIL image or a numpy array with a shape of (height, width)
+        or (height, width, bands).
+    :returns: a PIL image.
+    """
+    if isinstance(image, PIL.Image.Image):
+        return image
+    if len(image.shape) == 3:
+        if image.shape[2] > 4:
+            image = image[:, :, 0]
+        elif image.shape[2] == 1:
+            image = image[:, :, 0]
+    if image.dtype.kind == 'f':
+        image = numpy.clip(numpy.nan_to_num(image) * 255, 0, 255)
+    elif image.dtype.kind in 'iu' and image.dtype != numpy.uint8:
+        if image.dtype.kind == 'i':
+            # Offset signed values so that the minimum value is 0
+            image = image.view('u%d' % image.dtype.itemsize) ^ (
+                1 << (image.dtype.itemsize * 8 - 1))
+        image = image >> (8 * (image.dtype.itemsize - 1))
+    image = image.astype(numpy.uint8)
+    mode = 'L' if len(image.shape) == 2 else {2: 'LA', 3: 'RGB', 4: 'RGBA'}[image.shape[2]]
+    return PIL.Image.fromarray(image, mode)
+
+
+def _pilToNumpy(image, dtype, bands):
+    """
+    Convert a PIL image to a numpy array of a specific data type and number of
+    bands.  This is the reverse of _imageToPIL, and is used to combine 8-bit
+    images with images of a greater bit depth.
+
+    :param image: a PIL image.
+    :param dtype: the numpy data type of the result.
+    :param bands: the number of bands of the result.
+    :returns: a numpy array with a shape of (height, width, bands).
+    """
+    image = numpy.asarray(image.convert({3: 'RGB', 4: 'RGBA'}.get(bands, 'L')))
+    if len(image.shape) == 2:
+        image = image[:, :, numpy.newaxis]
+    dtype = numpy.dtype(dtype)
+    if dtype.kind == 'f':
+        image = image.astype(dtype) / 255
+    elif dtype != numpy.uint8:
+        unsigned = numpy.dtype('u%d' % dtype.itemsize)
+        image = image.astype(unsigned) * unsigned.type(numpy.iinfo(unsigned).max // 255)
+        if dtype.kind == 'i':
+            image = (image ^ unsigned.type(1 << (dtype.itemsize * 8 - 1))).view(dtype)
+    image = image.astype(dtype, copy=False)
+    if image.shape[2] != bands:
+        image = numpy.repeat(image[:, :, :1], bands, axis=2)
+    return image
+
+
+def _resizeNumpy(image, width, height, resample):
+    """
+    Resize a numpy array of any data type and number of bands.  Each band is
+    resized as a floating point PIL image so that the full bit depth is kept.
+
+    :param image: a numpy array with a shape of (height, width, bands).
+    :param width: the width of the result.
+    :param height: the height of the result.
+    :param resample: a PIL resampling filter.
+    :returns: a numpy array with the same data type and number of bands.
+    """
+    result = numpy.dstack([
+        numpy.asarray(PIL.Image.fromarray(
+            image[:, :, band].astype(numpy.float32), 'F').resize((width, height), resample))
+        for band in range(image.shape[2])])
+    if image.dtype.kind in 'iu':
+        info = numpy.iinfo(image.dtype)
+        result = numpy.clip(numpy.rint(result), info.min, info.max)
+    return result.astype(image.dtype)
+
 
 def _encodeImage(image, encoding='JPEG', jpegQuality=95, jpegSubsampling=0,
                  format=(TILE_FORMAT_IMAGE, ), tiffCompression='raw',
                  **kwargs):
     """
-    Convert a PIL image into the raw output bytes and a mime type.
+    Convert a PIL image or numpy array into the raw output bytes and a mime
+    type.  Numpy arrays are only reduced to 8 bits per sample if they are
+    returned in a format other than TILE_FORMAT_NUMPY.
 
-    :param image: a PIL image.
+    :param image: a PIL image or a numpy array.
     :param encoding: a valid PIL encoding (typically 'PNG' or 'JPEG').  Must
         also be in the TileOutputMimeTypes map.
     :param jpegQuality: the quality to use when encoding a JPEG.
@@ -43,6 +184,10 @@ def _encodeImage(image, encoding='JPEG', jpegQuality=95, jpegSubsampling=0,
     """
     if not isinstance(format, tuple):
         format = (format, )
+    if isinstance(image, numpy.ndarray):
+        if TILE_FORMAT_NUMPY in format:
+            return image, TILE_FORMAT_NUMPY
+        image = _imageToPIL(image)
     imageData = image
     imageFormatOrMimeType = TILE_FORMAT_PIL
     if TILE_FORMAT_PIL in format:
@@ -95,6 +240,58 @@ def _letterboxImage(image, width, height, fill):
     return result
 
 
+def _cropJpeg(data, width, height):
+    """
+    Crop a baseline JPEG to a smaller width and height without decoding it.
+    This is done by changing the image size in the Start Of Frame marker, so
+    it is only possible if the cropped image keeps the top-left corner, has
+    the same number of MCUs (minimum coded units) in each row, and all of the
+    components are in one scan.  The compressed data is unchanged; decoders
+    stop after the rows that are needed and ignore the rest.
+
+    :param data: the JPEG file as bytes.
+    :param width: the desired width in pixels.
+    :param height: the desired height in pixels.
+    :returns: the cropped JPEG as bytes, or None if it can't be cropped
+        losslessly.
+    """
+    if data[:2] != b'\xff\xd8':
+        return None
+    pos = 2
+    frame = None
+    while pos + 4 <= len(data) and data[pos:pos + 1] == b'\xff':
+        marker = six.indexbytes(data, pos + 1)
+        if marker == 0xFF or marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # Fill bytes and markers without a length
+            pos += 1 if marker == 0xFF else 2
+            continue
+        if marker in (0xC0, 0xC1):
+            # Baseline or extended sequential Huffman coded frame
+            frame = (pos, ) + struct.unpack('>HHB', data[pos + 5:pos + 10])
+            frame += (max(six.indexbytes(data, pos + 11 + 3 * idx) >> 4
+                          for idx in range(frame[3])), )
+        elif 0xC2 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            # Progressive, lossless, or arithmetic coded frames
+            return None
+        elif marker == 0xDA:
+            break
+        pos += 2 + struct.unpack('>H', data[pos + 2:pos + 4])[0]
+    else:
+        return None
+    if frame is None:
+        return None
+    framePos, frameHeight, frameWidth, components, maxSampling = frame
+    mcuWidth = 8 * maxSampling if components > 1 else 8
+    if (not frameHeight or width > frameWidth or height > frameHeight or
+            six.indexbytes(data, pos + 4) != components or
+            -(-width // mcuWidth) != -(-frameWidth // mcuWidth)):
+        return None
+    if (width, height) == (frameWidth, frameHeight):
+        return data
+    return b''.join([
+        data[:framePos + 5], struct.pack('>HH', height, width), data[framePos + 9:]])
+
+
 def nearPowerOfTwo(val1, val2, tolerance=0.02):
     """
     Check if two values are different by nearly a power of two.
@@ -148,6 +345,9 @@ class LazyTileDict(dict):
         self.requestedScale = tileInfo.get('requestedScale')
         self.metadata = tileInfo.get('metadata')
         self.retile = tileInfo.get('retile') and self.metadata
+        # This can be set to the result of source.getTile if it was fetched
+        # as part of a batch.
+        self.tileData = None
 
         self.deferredKeys = ('tile', 'format')
         self.alwaysAllowPIL = True
@@ -221,21 +421,70 @@ class LazyTileDict(dict):
         xmax = int((self['x'] + self.width - 1) // self.metadata['tileWidth'] + 1)
         ymin = int(max(0, self['y'] // self.metadata['tileHeight']))
         ymax = int((self['y'] + self.height - 1) // self.metadata['tileHeight'] + 1)
-        for x in range(xmin, xmax):
-            for y in range(ymin, ymax):
-                tileData = self.source.getTile(
-                    x, y, self.level,
-                    pilImageAllowed=True, sparseFallback=True, frame=self.frame)
-                if not isinstance(tileData, PIL.Image.Image):
-                    tileData = PIL.Image.open(BytesIO(tileData))
-                if retile is None:
-                    retile = PIL.Image.new(
-                        tileData.mode, (self.width, self.height))
-                retile.paste(tileData, (
-                    int(x * self.metadata['tileWidth'] - self['x']),
-                    int(y * self.metadata['tileHeight'] - self['y'])))
+        tiles = [(x, y, self.level, self.frame)
+                 for x in range(xmin, xmax) for y in range(ymin, ymax)]
+        tileList = self.source.getTiles(tiles, pilImageAllowed=True, sparseFallback=True)
+        for (x, y, _, _), tileData in zip(tiles, tileList):
+            if not isinstance(tileData, PIL.Image.Image):
+                tileData = PIL.Image.open(BytesIO(tileData))
+            if retile is None:
+                retile = PIL.Image.new(
+                    tileData.mode, (self.width, self.height))
+            retile.paste(tileData, (
+                int(x * self.metadata['tileWidth'] - self['x']),
+                int(y * self.metadata['tileHeight'] - self['y'])))
         return retile
 
+    def _getTileData(self):
+        """
+        Get the tile data from the tile source, unless it was already fetched
+        as part of a batch.
+
+        :returns: the tile data as returned by the tile source's getTile.
+        """
+        if self.tileData is not None:
+            return self.tileData
+        if not self.retile:
+            return self.source.getTile(
+                self.x, self.y, self.level,
+                pilImageAllowed=True, numpyAllowed=True, sparseFallback=True,
+                frame=self.frame)
+        return self._retileTile()
+
+    def _prepareNumpyTile(self, tileData):
+        """
+        Numpy tiles keep their full bit depth only if they can be returned as
+        numpy arrays.  Otherwise, they are converted to 8-bit PIL images.
+
+        :param tileData: a numpy array.
+        :returns: the tile data, cropped if needed, and its format.
+        """
+        if self.alwaysAllowPIL or TILE_FORMAT_NUMPY not in self.format:
+            return _imageToPIL(tileData), TILE_FORMAT_PIL
+        if self.crop and not self.retile:
+            tileData = tileData[self.crop[1]:self.crop[3], self.crop[0]:self.crop[2]]
+        return tileData, TILE_FORMAT_NUMPY
+
+    def _resampleTile(self, tileData, tileFormat):
+        """
+        Resample a tile based on the requested scale, updating the width and
+        height of the tile.
+
+        :param tileData: a PIL image or a numpy array.
+        :param tileFormat: the format of the tile data.
+        :returns: the resampled tile data.
+        """
+        resample = PIL.Image.LANCZOS if self.resample is True else self.resample
+        if tileFormat == TILE_FORMAT_NUMPY:
+            size = (tileData.shape[1], tileData.shape[0])
+        else:
+            size = tileData.size
+        self['width'] = max(1, int(size[0] / self.requestedScale))
+        self['height'] = max(1, int(size[1] / self.requestedScale))
+        if tileFormat == TILE_FORMAT_NUMPY:
+            return _resizeNumpy(tileData, self['width'], self['height'], resample)
+        return tileData.resize((self['width'], self['height']), resample=resample)
+
     def __getitem__(self, key, *args, **kwargs):
         """
         If this is the first time either the tile or format key is requested,
@@ -249,38 +498,30 @@ class LazyTileDict(dict):
             # tile's own values.
             self.loaded = True
 
-            if not self.retile:
-                tileData = self.source.getTile(
-                    self.x, self.y, self.level,
-                    pilImageAllowed=True, sparseFallback=True, frame=self.frame)
-            else:
-                tileData = self._retileTile()
+            tileData = self._getTileData()
             tileFormat = TILE_FORMAT_PIL
-            # If the tile isn't in PIL format, and it is not in an image format
-            # that is the same as a desired output format and encoding, convert
-            # it to PIL format.
-            if not isinstance(tileData, PIL.Image.Image):
-                pilData = PIL.Image.open(BytesIO(tileData))
-                if (self.format and TILE_FORMAT_IMAGE in self.format and
-                        pilData.format == self.encoding):
-                    tileFormat = TILE_FORMAT_IMAGE
+            if isinstance(tileData, numpy.ndarray):
+                tileData, tileFormat = self._prepareNumpyTile(tileData)
+            if tileFormat != TILE_FORMAT_NUMPY:
+                # If the tile isn't in PIL format, and it is not in an image
+                # format that is the same as a desired output format and
+                # encoding, convert it to PIL format.
+                if not isinstance(tileData, PIL.Image.Image):
+                    pilData = PIL.Image.open(BytesIO(tileData))
+                    if (self.format and TILE_FORMAT_IMAGE in self.format and
+                            pilData.format == self.encoding):
+                        tileFormat = TILE_FORMAT_IMAGE
+                    else:
+                        tileData = pilData
                 else:
-                    tileData = pilData
-            else:
-                pilData = tileData
-            if self.crop and not self.retile:
-                tileData = pilData.crop(self.crop)
-                tileFormat = TILE_FORMAT_PIL
+                    pilData = tileData
+                if self.crop and not self.retile:
+                    tileData = pilData.crop(self.crop)
+                    tileFormat = TILE_FORMAT_PIL
 
             # resample if needed
             if self.resample not in (False, None) and self.requestedScale:
-                self['width'] = max(1, int(
-                    tileData.size[0] / self.requestedScale))
-                self['height'] = max(1, int(
-                    tileData.size[1] / self.requestedScale))
-                tileData = tileData.resize(
-                    (self['width'], self['height']),
-                    resample=PIL.Image.LANCZOS if self.resample is True else self.resample)
+                tileData = self._resampleTile(tileData, tileFormat)
 
             # Reformat the image if required
             if not self.alwaysAllowPIL:
@@ -943,6 +1184,71 @@ class TileSource(object):
                 tile['gheight'] = tile['height'] * scale
                 yield tile
 
+    def _regionTileIterator(self, iterInfo, format=None):
+        """
+        Given tile iterator information, iterate through the tiles needed to
+        assemble a region.  If the 'region_threads' config value is greater
+        than one, tile images are fetched and decoded concurrently in a thread
+        pool and tiles are yielded in the order that they finish loading.
+        Otherwise, this is the same as _tileIterator.  Concurrent fetching
+        requires that the tile source's getTile method is thread safe.
+
+        :param iterInfo: tile iterator information.  See _tileIteratorInfo.
+        :param format: if not None, a tuple of formats passed to the setFormat
+            method of each tile before it is loaded.
+        :yields: an iterator that returns a dictionary as listed in
+            _tileIterator.
+        """
+        tiles = self._tileIterator(iterInfo)
+        if format is not None:
+            tiles = self._setTileFormats(tiles, format)
+        pool = _getRegionPool()
+        if pool is None:
+            # Fetch the tiles a row at a time so that cache lookups are batched
+            row = []
+            for tile in tiles:
+                if row and tile['level_y'] != row[0]['level_y']:
+                    self._fetchTileData(row)
+                    for rowTile in row:
+                        yield rowTile
+                    row = []
+                row.append(tile)
+            self._fetchTileData(row)
+            for rowTile in row:
+                yield rowTile
+            return
+        for tile in pool.imap_unordered(_loadRegionTile, tiles):
+            yield tile
+
+    def _setTileFormats(self, tiles, format):
+        """
+        Set the format of each tile from a tile iterator.
+
+        :param tiles: an iterator of LazyTileDict tiles.
+        :param format: a tuple of formats.  See LazyTileDict.setFormat.
+        :yields: the tiles.
+        """
+        for tile in tiles:
+            tile.setFormat(format)
+            yield tile
+
+    def _fetchTileData(self, tiles):
+        """
+        Get the tile data for a list of tiles from the tile iterator with a
+        single call to getTiles.
+
+        :param tiles: a list of LazyTileDict tiles.  The tileData attribute of
+            each tile that doesn't need to be retiled is set.
+        """
+        tiles = [tile for tile in tiles if not tile.retile and tile.tileData is None]
+        if not tiles:
+            return
+        tileDataList = self.getTiles(
+            [(tile.x, tile.y, tile.level, tile.frame) for tile in tiles],
+            pilImageAllowed=True, numpyAllowed=True, sparseFallback=True)
+        for tile, tileData in zip(tiles, tileDataList):
+            tile.tileData = tileData
+
     def _pilFormatMatches(self, image, match=True, **kwargs):
         """
         Determine if the specified PIL image matches the format of the tile
@@ -979,11 +1285,56 @@ class TileSource(object):
         # compatibility could be an issue.
         return False
 
+    def _edgeTileContent(self, x, y, z):
+        """
+        Determine if a tile extends past the edge of the image and edge
+        adjustment is enabled.
+
+        :param x: tile x value.
+        :param y: tile y value.
+        :param z: tile z (level) value.
+        :returns: None if the tile doesn't need edge adjustment, or a tuple
+            of the width and height of the part of the tile within the image.
+        """
+        if not self.edge:
+            return None
+        sizeX = int(self.sizeX * 2 ** (z - (self.levels - 1)))
+        sizeY = int(self.sizeY * 2 ** (z - (self.levels - 1)))
+        maxX = (x + 1) * self.tileWidth
+        maxY = (y + 1) * self.tileHeight
+        if maxX <= sizeX and maxY <= sizeY:
+            return None
+        return (min(self.tileWidth, sizeX - (maxX - self.tileWidth)),
+                min(self.tileHeight, sizeY - (maxY - self.tileHeight)))
+
+    def _adjustEdgeTile(self, tile, contentWidth, contentHeight):
+        """
+        Crop an edge tile or fill the part that is outside of the image,
+        based on the edge option of the tile source.
+
+        :param tile: a PIL image of the tile.
+        :param contentWidth: the width of the part of the tile in the image.
+        :param contentHeight: the height of the part of the tile in the image.
+        :returns: a PIL image.
+        """
+        if self.edge in (True, 'crop'):
+            return tile.crop((0, 0, contentWidth, contentHeight))
+        color = PIL.ImageColor.getcolor(self.edge, tile.mode)
+        if contentWidth < self.tileWidth:
+            PIL.ImageDraw.Draw(tile).rectangle(
+                [(contentWidth, 0), (self.tileWidth, contentHeight)],
+                fill=color, outline=None)
+        if contentHeight < self.tileHeight:
+            PIL.ImageDraw.Draw(tile).rectangle(
+                [(0, contentHeight), (self.tileWidth, self.tileHeight)],
+                fill=color, outline=None)
+        return tile
+
     def _outputTile(self, tile, tileEncoding, x, y, z, pilImageAllowed=False,
-                    **kwargs):
+                    numpyAllowed=False, **kwargs):
         """
-        Convert a tile from a PIL image or image in memory to the desired
-        encoding.
+        Convert a tile from a PIL image, numpy array, or image in memory to
+        the desired encoding.
 
         :param tile: the tile to convert.
         :param tileEncoding: the current tile encoding.
@@ -991,36 +1342,29 @@ class TileSource(object):
         :param y: tile y value.  Used for cropping or edge adjustment.
         :param z: tile z (level) value.  Used for cropping or edge adjustment.
         :param pilImageAllowed: True if a PIL image may be returned.
-        :returns: either a PIL image or a memory object with an image file.
-        """
-        isEdge = False
-        if self.edge:
-            sizeX = int(self.sizeX * 2 ** (z - (self.levels - 1)))
-            sizeY = int(self.sizeY * 2 ** (z - (self.levels - 1)))
-            maxX = (x + 1) * self.tileWidth
-            maxY = (y + 1) * self.tileHeight
-            isEdge = maxX > sizeX or maxY > sizeY
-        if tileEncoding != TILE_FORMAT_PIL:
+        :param numpyAllowed: True if a numpy array may be returned.  Tiles
+            that are numpy arrays are then returned at their full bit depth
+            unless an edge needs to be filled with a color.
+        :returns: either a numpy array, a PIL image, or a memory object with
+            an image file.
+        """
+        edgeContent = self._edgeTileContent(x, y, z)
+        isEdge = edgeContent is not None
+        if tileEncoding == TILE_FORMAT_NUMPY:
+            if numpyAllowed and (not isEdge or self.edge in (True, 'crop')):
+                return tile[:edgeContent[1], :edgeContent[0]] if isEdge else tile
+            tile = _imageToPIL(tile)
+        elif tileEncoding != TILE_FORMAT_PIL:
             if tileEncoding == self.encoding and not isEdge:
                 return tile
+            if (tileEncoding == self.encoding == 'JPEG' and isEdge and
+                    self.edge in (True, 'crop')):
+                croppedTile = _cropJpeg(tile, *edgeContent)
+                if croppedTile is not None:
+                    return croppedTile
             tile = PIL.Image.open(BytesIO(tile))
         if isEdge:
-            contentWidth = min(self.tileWidth,
-                               sizeX - (maxX - self.tileWidth))
-            contentHeight = min(self.tileHeight,
-                                sizeY - (maxY - self.tileHeight))
-            if self.edge in (True, 'crop'):
-                tile = tile.crop((0, 0, contentWidth, contentHeight))
-            else:
-                color = PIL.ImageColor.getcolor(self.edge, tile.mode)
-                if contentWidth < self.tileWidth:
-                    PIL.ImageDraw.Draw(tile).rectangle(
-                        [(contentWidth, 0), (self.tileWidth, contentHeight)],
-                        fill=color, outline=None)
-                if contentHeight < self.tileHeight:
-                    PIL.ImageDraw.Draw(tile).rectangle(
-                        [(0, contentHeight), (self.tileWidth, self.tileHeight)],
-                        fill=color, outline=None)
+            tile = self._adjustEdgeTile(tile, *edgeContent)
         if pilImageAllowed:
             return tile
         encoding = TileOutputPILFormat.get(self.encoding, self.encoding)
@@ -1077,6 +1421,41 @@ class TileSource(object):
     def getTile(self, x, y, z, pilImageAllowed=False, sparseFallback=False, frame=None):
         raise NotImplementedError()
 
+    def getTiles(self, tiles, **kwargs):
+        """
+        Get a list of tiles.  This returns the same results as calling getTile
+        for each tile, but the tile cache is checked for all of the tiles at
+        once, and tiles that are not in the cache are read in the order
+        returned by _sortTileRequests.
+
+        :param tiles: a list of (x, y, z) or (x, y, z, frame) tuples.
+        :param **kwargs: additional parameters to pass to getTile, such as
+            pilImageAllowed and sparseFallback.
+        :returns: a list of tiles in the same order as the tiles parameter.
+        """
+        calls = []
+        for tile in tiles:
+            tileKwargs = kwargs
+            if len(tile) > 3:
+                tileKwargs = kwargs.copy()
+                tileKwargs['frame'] = tile[3]
+            calls.append((tuple(tile[:3]), tileKwargs))
+        return methodcacheMany(
+            self, type(self).getTile, calls,
+            order=lambda misses: self._sortTileRequests(misses, calls))
+
+    def _sortTileRequests(self, indices, calls):
+        """
+        Determine the order in which tiles that are not in the cache are read
+        by getTiles.  Sources can override this to read tiles in an order that
+        is more efficient for the underlying file.
+
+        :param indices: a list of indices within calls that need to be read.
+        :param calls: a list of ((x, y, z), kwargs) tuples for getTile.
+        :returns: the list of indices in the order they should be read.
+        """
+        return indices
+
     def getTileMimeType(self):
         return TileOutputMimeTypes.get(self.encoding, 'image/jpeg')
 
@@ -1239,7 +1618,8 @@ class TileSource(object):
         :param format: the desired format or a tuple of allowed formats.
             Formats are members of (TILE_FORMAT_PIL, TILE_FORMAT_NUMPY,
             TILE_FORMAT_IMAGE).  If TILE_FORMAT_IMAGE, encoding may be
-            specified.
+            specified.  If TILE_FORMAT_NUMPY is allowed and TILE_FORMAT_PIL is
+            not, the region is assembled directly in a numpy array.
         :param **kwargs: optional arguments.  Some options are region, output,
             encoding, jpegQuality, jpegSubsampling, tiffCompression, fill.  See
             tileIterator.
@@ -1256,6 +1636,14 @@ class TileSource(object):
             #  image = PIL.Image.new('RGB', (0, 0))
             image = PIL.Image.new('RGB', (1, 1)).crop((0, 0, 0, 0))
             return _encodeImage(image, format=format, **kwargs)
+        if not isinstance(format, tuple):
+            format = (format, )
+        if TILE_FORMAT_NUMPY in format and TILE_FORMAT_PIL not in format:
+            return self._getRegionNumpy(iterInfo, **kwargs), TILE_FORMAT_NUMPY
+        if TILE_FORMAT_IMAGE in format and TILE_FORMAT_PIL not in format:
+            imageData = self._getRegionJpeg(iterInfo, **kwargs)
+            if imageData is not None:
+                return imageData, TileOutputMimeTypes['JPEG']
         regionWidth = iterInfo['region']['width']
         regionHeight = iterInfo['region']['height']
         top = iterInfo['region']['top']
@@ -1281,7 +1669,7 @@ class TileSource(object):
             raise exceptions.TileSourceException(
                 'Insufficient memory to get region of %d x %d pixels.' % (
                     regionWidth, regionHeight))
-        for tile in self._tileIterator(iterInfo):
+        for tile in self._regionTileIterator(iterInfo):
             # Add each tile to the image.  PIL crops these if they are off the
             # edge.
             image.paste(tile['tile'], (tile['x'] - left, tile['y'] - top))
@@ -1299,6 +1687,140 @@ class TileSource(object):
             image = _letterboxImage(image, maxWidth, maxHeight, kwargs['fill'])
         return _encodeImage(image, format=format, **kwargs)
 
+    def _getRegionJpeg(self, iterInfo, **kwargs):
+        """
+        Get a region that is exactly one JPEG source tile, or a lossless crop
+        of one, without decoding and reencoding it.  This is only done if the
+        tile source's JPEG options match the requested options.
+
+        :param iterInfo: tile iterator information.  See _tileIteratorInfo.
+        :param **kwargs: optional arguments.  Some options are encoding,
+            jpegQuality, jpegSubsampling, output, and fill.  See getRegion.
+        :returns: the region as JPEG bytes, or None if it can't be returned
+            this way.
+        """
+        if (kwargs.get('encoding', 'JPEG') != 'JPEG' or self.encoding != 'JPEG' or
+                int(kwargs.get('jpegQuality', 95)) != self.jpegQuality or
+                int(kwargs.get('jpegSubsampling', 0)) != self.jpegSubsampling):
+            return None
+        region = iterInfo['region']
+        tileSize = iterInfo['tile_size']
+        maxWidth = kwargs.get('output', {}).get('maxWidth') or region['width']
+        maxHeight = kwargs.get('output', {}).get('maxHeight') or region['height']
+        if (iterInfo['xmax'] != iterInfo['xmin'] + 1 or
+                iterInfo['ymax'] != iterInfo['ymin'] + 1 or
+                (tileSize['width'], tileSize['height']) != (self.tileWidth, self.tileHeight) or
+                iterInfo['tile_overlap']['x'] or iterInfo['tile_overlap']['y'] or
+                region['left'] != iterInfo['xmin'] * self.tileWidth or
+                region['top'] != iterInfo['ymin'] * self.tileHeight or
+                int(math.floor(iterInfo['output']['width'])) != region['width'] or
+                int(math.floor(iterInfo['output']['height'])) != region['height'] or
+                (kwargs.get('fill') and str(kwargs['fill']).lower() != 'none' and (
+                    maxWidth > region['width'] or maxHeight > region['height']))):
+            return None
+        tile = self.getTile(
+            iterInfo['xmin'], iterInfo['ymin'], iterInfo['level'],
+            sparseFallback=True, frame=iterInfo.get('frame'))
+        if not isinstance(tile, six.binary_type):
+            return None
+        return _cropJpeg(tile, region['width'], region['height'])
+
+    def _getRegionNumpy(self, iterInfo, **kwargs):
+        """
+        Assemble a region directly into a numpy array.  Each tile is copied
+        into a slice of a single preallocated array, avoiding a full-size PIL
+        image and the copy needed to convert it to numpy.
+
+        If the tile source returns numpy tiles with more than 8 bits per sample
+        or more than four bands, the region has the data type and number of
+        bands of the tiles, so the full bit depth is kept.  Otherwise, the
+        region is 8-bit RGBA.
+
+        :param iterInfo: tile iterator information.  See _tileIteratorInfo.
+        :param **kwargs: optional arguments.  Some options are output and
+            fill.  See getRegion.
+        :returns: the region as a numpy array with a shape of (height, width,
+            bands).
+        """
+        regionWidth = iterInfo['region']['width']
+        regionHeight = iterInfo['region']['height']
+        top = iterInfo['region']['top']
+        left = iterInfo['region']['left']
+        outWidth = int(math.floor(iterInfo['output']['width']))
+        outHeight = int(math.floor(iterInfo['output']['height']))
+        image = None
+        for tile in self._regionTileIterator(
+                iterInfo, format=(TILE_FORMAT_PIL, TILE_FORMAT_NUMPY)):
+            tileData = tile['tile']
+            if image is None:
+                # The first tile determines the type of the region.  The PIL
+                # image that getRegion creates via frombuffer is always RGBA,
+                # regardless of the iterator mode, so match that for 8-bit
+                # tiles with no more than four bands.
+                if isinstance(tileData, numpy.ndarray) and (
+                        tileData.dtype != numpy.uint8 or tileData.shape[2] > 4):
+                    image = self._allocateRegionNumpy(
+                        regionWidth, regionHeight, tileData.shape[2], tileData.dtype)
+                else:
+                    image = self._allocateRegionNumpy(regionWidth, regionHeight)
+            if isinstance(tileData, numpy.ndarray):
+                if image.dtype == numpy.uint8 and image.shape[2] == 4:
+                    tileData = numpy.asarray(_imageToPIL(tileData).convert('RGBA'))
+            elif image.dtype == numpy.uint8 and image.shape[2] == 4:
+                # Match what PIL's paste does when the modes differ
+                tileData = numpy.asarray(tileData.convert('RGBA'))
+            else:
+                tileData = _pilToNumpy(tileData, image.dtype, image.shape[2])
+            x = tile['x'] - left
+            y = tile['y'] - top
+            # Crop tiles that are off the edge of the region
+            tileData = tileData[:regionHeight - y, :regionWidth - x]
+            image[y:y + tileData.shape[0], x:x + tileData.shape[1]] = tileData
+        if image is None:
+            image = self._allocateRegionNumpy(regionWidth, regionHeight)
+        maxWidth = kwargs.get('output', {}).get('maxWidth')
+        maxHeight = kwargs.get('output', {}).get('maxHeight')
+        fill = bool(kwargs.get('fill') and str(kwargs['fill']).lower() != 'none' and
+                    maxWidth and maxHeight)
+        if outWidth != regionWidth or outHeight != regionHeight or fill:
+            resample = PIL.Image.BICUBIC if outWidth > regionWidth else PIL.Image.LANCZOS
+            if image.dtype != numpy.uint8 or image.shape[2] != 4:
+                if outWidth != regionWidth or outHeight != regionHeight:
+                    image = _resizeNumpy(image, outWidth, outHeight, resample)
+                if fill:
+                    # Colors can't be mapped to arbitrary bands, so data with
+                    # more than 8 bits per sample is letterboxed with zeros.
+                    padY = max(0, maxHeight - image.shape[0])
+                    padX = max(0, maxWidth - image.shape[1])
+                    image = numpy.pad(image, (
+                        (padY // 2, padY - padY // 2), (padX // 2, padX - padX // 2), (0, 0)),
+                        'constant')
+                return image
+            # Resampling and letterboxing are done with PIL
+            pilImage = PIL.Image.fromarray(image, 'RGBA')
+            if outWidth != regionWidth or outHeight != regionHeight:
+                pilImage = pilImage.resize((outWidth, outHeight), resample)
+            if fill:
+                pilImage = _letterboxImage(pilImage, maxWidth, maxHeight, kwargs['fill'])
+            image = numpy.asarray(pilImage)
+        return image
+
+    def _allocateRegionNumpy(self, width, height, bands=4, dtype=numpy.uint8):
+        """
+        Allocate the numpy array used to assemble a region.
+
+        :param width: the width of the region in pixels.
+        :param height: the height of the region in pixels.
+        :param bands: the number of bands of the region.
+        :param dtype: the numpy data type of the region.
+        :returns: an array of zeros with a shape of (height, width, bands).
+        """
+        try:
+            return numpy.zeros((height, width, bands), dtype=dtype)
+        except MemoryError:
+            raise exceptions.TileSourceException(
+                'Insufficient memory to get region of %d x %d pixels.' % (width, height))
+
     def getRegionAtAnotherScale(self, sourceRegion, sourceScale=None,
                                 targetScale=None, targetUnits=None, **kwargs):
         """
@@ -1716,6 +2238,56 @@ class FileTileSource(TileSource):
     def _getLargeImagePath(self):
         return self.largeImagePath
 
+    def _getSynthesizedTile(self, x, y, z, makeTile, frame=None):
+        """
+        Get a tile of a level that is missing from the file.  If the
+        'cache_synthesized_levels_path' config value is set, the tile is
+        stored in a disk cache once it is made, so later requests, including
+        from other processes, read it as a single tile.
+
+        :param x: location of tile within the level.
+        :param y: location of tile within the level.
+        :param z: the missing level.
+        :param makeTile: a function without parameters that makes the tile
+            as a PIL image.
+        :param frame: the frame of the tile or None.
+        :returns: the tile as a PIL image.
+        """
+        cache = getSynthesizedLevelCache()
+        if cache is None:
+            return makeTile()
+        key = self._synthesizedTileKey(x, y, z, frame)
+        try:
+            return PIL.Image.open(BytesIO(cache[key]))
+        except (KeyError, ValueError, IOError):
+            pass
+        tile = makeTile()
+        output = BytesIO()
+        tile.save(output, 'PNG')
+        try:
+            cache[key] = output.getvalue()
+        except ValueError:
+            pass  # the value was refused
+        return tile
+
+    def _synthesizedTileKey(self, x, y, z, frame):
+        """
+        Get the disk cache key of a tile of a missing level.  This includes the
+        size and modification time of the file, so tiles of a file that has
+        been replaced are not used.
+
+        :param x: location of tile within the level.
+        :param y: location of tile within the level.
+        :param z: the missing level.
+        :param frame: the frame of the tile or None.
+        :returns: a string key.
+        """
+        path = os.path.abspath(self._getLargeImagePath())
+        stat = os.stat(path)
+        return 'synthesized_level %s %s %d %r %d %d %d %d %d %r' % (
+            self.name, path, stat.st_size, stat.st_mtime, self.tileWidth,
+            self.tileHeight, z, x, y, frame)
+
     @classmethod
     def canRead(cls, path, *args, **kwargs):
         """
@@ -16,20 +16,29 @@
 #  limitations under the License.
 ##############################################################################
 
+import cachetools
 import math
+import numpy
 import PIL.Image
+import PIL.ImageColor
 import six
+import threading
+import weakref
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from pkg_resources import DistributionNotFound, get_distribution
+from six import BytesIO
 from six.moves import range
 
-from large_image.cache_util import LruCacheMetaclass, methodcache
+from large_image.cache_util import LruCacheMetaclass, methodcache, strhash
 from large_image.constants import SourcePriority
 from large_image.exceptions import TileSourceException
-from large_image.tilesource import TILE_FORMAT_PIL
+from large_image.tilesource import TILE_FORMAT_NUMPY, TILE_FORMAT_PIL
 
 from large_image_source_tiff import TiffFileTileSource
+from large_image_source_tiff.tiff_ifd import readTiffDirectories
 from large_image_source_tiff.tiff_reader import TiledTiffDirectory, \
-    InvalidOperationTiffException, TiffException, IOTiffException
+    InvalidOperationTiffException, TiffException, IOTiffException, SharedTiffFile
 
 
 try:
@@ -64,6 +73,42 @@ _omeUnitsToMeters = {
     u'\u00c5': 1e-10,
 }
 
+# Colors used for composite channels that don't specify one
+_compositeColors = ['#FF0000', '#00FF00', '#0000FF', '#FFFF00', '#FF00FF', '#00FFFF']
+
+# A thread that opens the directories of neighboring frames, created as needed
+_prefetchPool = None
+_prefetchPoolLock = threading.Lock()
+
+
+def _getPrefetchPool():
+    """
+    Get the thread pool that opens the directories of neighboring frames in
+    the background.
+
+    :returns: a ThreadPool.
+    """
+    global _prefetchPool
+
+    with _prefetchPoolLock:
+        if _prefetchPool is None:
+            _prefetchPool = ThreadPool(1)
+        return _prefetchPool
+
+
+def _prefetchDirectories(sourceRef, dirnums):
+    """
+    Open directories of a source in the background.  The source is referenced
+    weakly, so queued work doesn't keep a source alive after it is evicted
+    from the tile source cache.
+
+    :param sourceRef: a weak reference to an OMETiffFileTileSource.
+    :param dirnums: a list of directory numbers.
+    """
+    source = sourceRef()
+    if source is not None:
+        source._prefetchDirectories(dirnums)
+
 
 @six.add_metaclass(LruCacheMetaclass)
 class OMETiffFileTileSource(TiffFileTileSource):
@@ -79,6 +124,10 @@ class OMETiffFileTileSource(TiffFileTileSource):
         'tiff': SourcePriority.MEDIUM,
         'ome': SourcePriority.PREFERRED,
     }
+    # The number of directories of frames other than the first that are kept
+    # open.  All directories share the source's file handle, so this only
+    # bounds the memory used by their tile offsets and tags.
+    directoryPoolSize = 256
 
     def __init__(self, path, **kwargs):
         """
@@ -90,9 +139,14 @@ class OMETiffFileTileSource(TiffFileTileSource):
         super(TiffFileTileSource, self).__init__(path, **kwargs)
 
         largeImagePath = self._getLargeImagePath()
+        try:
+            self._tiffInfos = readTiffDirectories(largeImagePath)
+        except (ValueError, EnvironmentError):
+            self._tiffInfos = None
 
         try:
-            base = TiledTiffDirectory(largeImagePath, 0)
+            self._sharedFile = SharedTiffFile(largeImagePath)
+            base = self._openDirectory(0)
         except TiffException:
             raise TileSourceException('Not a tiled OME Tiff')
         info = getattr(base, '_description_xml', None)
@@ -127,11 +181,13 @@ class OMETiffFileTileSource(TiffFileTileSource):
         omebylevel = dict(zip(levels, omeimages))
         self._omeLevels = [omebylevel.get(key) for key in range(max(omebylevel.keys()) + 1)]
         self._tiffDirectories = [
-            TiledTiffDirectory(largeImagePath, int(entry['TiffData'][0]['IFD']))
+            self._openDirectory(int(entry['TiffData'][0]['IFD']))
             if entry else None
             for entry in self._omeLevels]
-        self._directoryCache = {}
-        self._directoryCacheMaxSize = max(20, len(self._omebase['TiffData']) * 3)
+        self._directoryPool = cachetools.LRUCache(self.directoryPoolSize)
+        self._directoryPoolLock = threading.Lock()
+        # Directories that are waiting to be opened in the background
+        self._prefetchQueued = set()
         self.tileWidth = base.tileWidth
         self.tileHeight = base.tileHeight
         self.levels = len(self._tiffDirectories)
@@ -143,6 +199,79 @@ class OMETiffFileTileSource(TiffFileTileSource):
         # directories not mentioned by the ome list.
         self._associatedImages = {}
 
+    def _openDirectory(self, dirnum):
+        """
+        Open a tiled directory of the file.
+
+        :param dirnum: the number of the directory in the TIFF file.
+        :returns: a TiledTiffDirectory.
+        """
+        tiffInfo = None
+        if self._tiffInfos is not None:
+            if dirnum >= len(self._tiffInfos):
+                raise IOTiffException('Could not set TIFF directory to %d' % dirnum)
+            tiffInfo = self._tiffInfos[dirnum]
+        return TiledTiffDirectory(
+            self._getLargeImagePath(), dirnum, sharedFile=self._sharedFile, tiffInfo=tiffInfo)
+
+    def _getFrameDirectory(self, z, frame):
+        """
+        Get the directory of a frame at a level from the pool of open
+        directories, opening it if needed.  The directories of the
+        neighboring frames are opened in the background, since frames are
+        usually viewed in sequence.  A directory is only queued to be opened
+        once at a time.
+
+        :param z: the level.
+        :param frame: the frame number.
+        :returns: a TiledTiffDirectory.
+        """
+        dirnum = int(self._omeLevels[z]['TiffData'][frame]['IFD'])
+        with self._directoryPoolLock:
+            dir = self._directoryPool.get(dirnum)
+        if dir is None:
+            dir = self._openDirectory(dirnum)
+            with self._directoryPoolLock:
+                self._directoryPool[dirnum] = dir
+        # Neighbors are queued even if this directory was prefetched, so that
+        # stepping through frames stays ahead of the requests.
+        neighbors = [
+            int(self._omeLevels[z]['TiffData'][neighbor]['IFD'])
+            for neighbor in (frame - 1, frame + 1)
+            if 0 <= neighbor < len(self._omebase['TiffData'])]
+        with self._directoryPoolLock:
+            neighbors = [
+                neighbor for neighbor in neighbors
+                if neighbor not in self._directoryPool and
+                neighbor not in self._prefetchQueued]
+            self._prefetchQueued.update(neighbors)
+        if neighbors:
+            _getPrefetchPool().apply_async(
+                _prefetchDirectories, (weakref.ref(self), neighbors))
+        return dir
+
+    def _prefetchDirectories(self, dirnums):
+        """
+        Open directories and add them to the pool if they aren't already
+        there.
+
+        :param dirnums: a list of directory numbers.
+        """
+        for dirnum in dirnums:
+            try:
+                with self._directoryPoolLock:
+                    if dirnum in self._directoryPool:
+                        continue
+                try:
+                    dir = self._openDirectory(dirnum)
+                except TiffException:
+                    continue
+                with self._directoryPoolLock:
+                    self._directoryPool[dirnum] = dir
+            finally:
+                with self._directoryPoolLock:
+                    self._prefetchQueued.discard(dirnum)
+
     def getMetadata(self):
         """
         Return a dictionary of metadata containing levels, sizeX, sizeY,
@@ -185,19 +314,14 @@ class OMETiffFileTileSource(TiffFileTileSource):
         frame = int(kwargs['frame'])
         if frame < 0 or frame >= len(self._omebase['TiffData']):
             raise TileSourceException('Frame does not exist')
-        dirnum = int(self._omeLevels[z]['TiffData'][frame]['IFD'])
-        if dirnum in self._directoryCache:
-            dir = self._directoryCache[dirnum]
-        else:
-            if len(self._directoryCache) >= self._directoryCacheMaxSize:
-                self._directoryCache = {}
-            dir = TiledTiffDirectory(self._getLargeImagePath(), dirnum)
-            self._directoryCache[dirnum] = dir
+        dir = self._getFrameDirectory(z, frame)
         try:
             tile = dir.getTile(x, y)
             format = 'JPEG'
             if PIL and isinstance(tile, PIL.Image.Image):
                 format = TILE_FORMAT_PIL
+            if isinstance(tile, numpy.ndarray):
+                format = TILE_FORMAT_NUMPY
             return self._outputTile(tile, format, x, y, z, pilImageAllowed,
                                     **kwargs)
         except InvalidOperationTiffException as e:
@@ -206,3 +330,82 @@ class OMETiffFileTileSource(TiffFileTileSource):
             return self.getTileIOTiffException(
                 x, y, z, pilImageAllowed=pilImageAllowed,
                 sparseFallback=sparseFallback, exception=e, **kwargs)
+
+    def getCompositeTile(self, x, y, z, channels, pilImageAllowed=False, **kwargs):
+        """
+        Get a tile that blends several frames, such as the channels of a
+        multiplexed image, into one color image.  Each frame is scaled from
+        its min to max value, tinted by its color, and added to the result.
+
+        :param x: the x tile location.
+        :param y: the y tile location.
+        :param z: the tile level.
+        :param channels: a list of dictionaries, each with 'frame', the frame
+            number, and optionally 'color', a PIL color string, and 'min' and
+            'max', the values that map to black and to the full color.  The
+            colors default to red, green, blue, yellow, magenta, and cyan in
+            order, and min and max default to the range of the frame's data
+            type, or 0 to 1 for floating point data.
+        :param pilImageAllowed: True if a PIL image may be returned.
+        :returns: the tile in the source's encoding or as a PIL image.
+        """
+        if not channels:
+            raise TileSourceException('At least one channel is required')
+        composite = []
+        for idx, channel in enumerate(channels):
+            if not isinstance(channel, dict):
+                raise TileSourceException('Invalid composite channel %r' % (channel, ))
+            try:
+                frame = int(channel['frame'])
+                color = PIL.ImageColor.getrgb(
+                    channel.get('color') or _compositeColors[idx % len(_compositeColors)])
+                minValue, maxValue = [
+                    float(channel[key]) if channel.get(key) is not None else None
+                    for key in ('min', 'max')]
+            except (KeyError, TypeError, ValueError):
+                raise TileSourceException('Invalid composite channel %r' % (channel, ))
+            if frame < 0 or frame >= len(self._omebase['TiffData']):
+                raise TileSourceException('Frame does not exist')
+            composite.append((frame, color[:3], minValue, maxValue))
+        # The channels are normalized so that equivalent requests share a
+        # cache entry.
+        return self._getCompositeTile(
+            x, y, z, tuple(composite), pilImageAllowed=pilImageAllowed, **kwargs)
+
+    @methodcache(key=partial(strhash, '_getCompositeTile'))
+    def _getCompositeTile(self, x, y, z, channels, pilImageAllowed=False, **kwargs):
+        """
+        Get a composite tile.  See getCompositeTile.
+
+        :param x: the x tile location.
+        :param y: the y tile location.
+        :param z: the tile level.
+        :param channels: a tuple of (frame, (red, green, blue), min, max).
+        :param pilImageAllowed: True if a PIL image may be returned.
+        :returns: the tile in the source's encoding or as a PIL image.
+        """
+        tiles = self.getTiles(
+            [(x, y, z, frame) for frame, _, _, _ in channels],
+            pilImageAllowed=True, numpyAllowed=True, edge=False)
+        result = None
+        for (_, color, minValue, maxValue), tile in zip(channels, tiles):
+            if isinstance(tile, six.binary_type):
+                tile = PIL.Image.open(BytesIO(tile))
+            tile = numpy.asarray(tile)
+            if tile.ndim == 3:
+                tile = tile[:, :, 0]
+            if minValue is None or maxValue is None:
+                if tile.dtype.kind == 'f':
+                    low, high = 0, 1
+                else:
+                    low, high = numpy.iinfo(tile.dtype).min, numpy.iinfo(tile.dtype).max
+                minValue = low if minValue is None else minValue
+                maxValue = high if maxValue is None else maxValue
+            scaled = numpy.clip(
+                (tile.astype(float) - minValue) / max(maxValue - minValue, 1e-10), 0, 1)
+            if result is None:
+                result = numpy.zeros(tile.shape + (3, ), dtype=float)
+            result += scaled[:, :, numpy.newaxis] * numpy.array(color, dtype=float)
+        result = numpy.clip(result, 0, 255).round().astype(numpy.uint8)
+        return self._outputTile(
+            result, TILE_FORMAT_NUMPY, x, y, z, pilImageAllowed, **kwargs)
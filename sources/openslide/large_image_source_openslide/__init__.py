@@ -16,9 +16,13 @@
 #  limitations under the License.
 ##############################################################################
 
+import cachetools
 import math
 import six
+import struct
+import threading
 
+from six import BytesIO
 from six.moves import range
 
 import openslide
@@ -27,10 +31,19 @@ from pkg_resources import DistributionNotFound, get_distribution
 
 from large_image import config
 from large_image.cache_util import LruCacheMetaclass, methodcache
+from large_image.cache_util.cachefactory import estimateSize, getAvailableMemory
 from large_image.constants import SourcePriority
 from large_image.exceptions import TileSourceException
 from large_image.tilesource import FileTileSource, nearPowerOfTwo
 
+try:
+    from large_image_source_tiff.tiff_ifd import readTiffDirectories
+    from large_image_source_tiff.tiff_reader import TiledTiffDirectory, TiffException, \
+        SharedTiffFile
+    from libtiff.libtiff_ctypes import PHOTOMETRIC_MINISBLACK, PHOTOMETRIC_RGB, \
+        PHOTOMETRIC_YCBCR
+except ImportError:
+    TiledTiffDirectory = None
 
 try:
     __version__ = get_distribution(__name__).version
@@ -39,6 +52,31 @@ except DistributionNotFound:
     pass
 
 
+# An Adobe APP14 JPEG segment with a color transform of 0, which tells
+# decoders that three-component data is RGB rather than YCbCr.
+AdobeRgbSegment = b'\xff\xee\x00\x0eAdobe\x00\x64\x00\x00\x00\x00\x00'
+
+
+def _markJpegRgb(data):
+    """
+    Mark a JPEG that stores RGB data as RGB.  Without a marker, decoders
+    assume that three-component JPEGs are YCbCr.
+
+    :param data: a complete JPEG.
+    :returns: the JPEG with an Adobe segment after its start of image marker,
+        unless it already has one.
+    """
+    pos = 2
+    while pos + 4 <= len(data) and data[pos:pos + 1] == b'\xff':
+        marker = data[pos + 1:pos + 2]
+        if marker == b'\xda':  # start of scan
+            break
+        if marker == b'\xee' and data[pos + 4:pos + 9] == b'Adobe':
+            return data
+        pos += 2 + struct.unpack('>H', data[pos + 2:pos + 4])[0]
+    return data[:2] + AdobeRgbSegment + data[2:]
+
+
 @six.add_metaclass(LruCacheMetaclass)
 class OpenslideFileTileSource(FileTileSource):
     """
@@ -68,6 +106,18 @@ class OpenslideFileTileSource(FileTileSource):
         'image/x-tiff': SourcePriority.MEDIUM,
     }
 
+    # Output tiles that don't line up with the tiles of the level they are read
+    # from are read in super-regions of several output tiles.  This is the
+    # largest width or height of a super-region in level pixels and the
+    # number of bytes of recently read super-regions that each source keeps.
+    # The tile source cache expects each source to use about 24 MB, so this is
+    # kept below that; it holds one super-region of the largest size.
+    superRegionSize = 2048
+    superRegionCacheBytes = 16 * 1024 ** 2
+    # JPEG tiles of files from these OpenSlide vendors are read directly from
+    # the TIFF file when the large_image_source_tiff package is available.
+    directTiffVendors = {'aperio', 'generic-tiff'}
+
     def __init__(self, path, **kwargs):
         """
         Initialize the tile class.  See the base class for other available
@@ -116,7 +166,7 @@ class OpenslideFileTileSource(FileTileSource):
         # resolution SVS level that contains at least as many pixels.  If this
         # is not the same scale as we expect, note the scale factor so we can
         # load an appropriate area and scale it to the tile size later.
-        maxSize = 16384   # This should probably be based on available memory
+        maxSize = self._getMaxReadSize()
         for level in range(self.levels):
             levelW = max(1, self.sizeX / 2 ** (self.levels - 1 - level))
             levelH = max(1, self.sizeY / 2 ** (self.levels - 1 - level))
@@ -133,18 +183,22 @@ class OpenslideFileTileSource(FileTileSource):
                 scale = int(round(svsAvailableLevels[svslevel]['width'] / levelW))
             # If there are no tiles at a particular level, we have to read a
             # larger area of a higher resolution level.  If such an area would
-            # be excessively large, we could have memroy issues, so raise an
-            # error.
-            if (self.tileWidth * scale > maxSize or
-                    self.tileHeight * scale > maxSize):
-                msg = ('OpenSlide has no small-scale tiles (level %d is at %d '
-                       'scale)' % (level, scale))
-                config.getConfig('logger').info(msg)
-                raise TileSourceException(msg)
+            # be excessively large, the tiles of the level are instead made
+            # from four tiles of the next level.
+            synthesized = (self.tileWidth * scale > maxSize or
+                           self.tileHeight * scale > maxSize)
             self._svslevels.append({
                 'svslevel': bestlevel,
-                'scale': scale
+                'scale': scale,
+                'synthesized': synthesized,
+                'superRegion': (1, 1) if synthesized else self._getSuperRegionTiles(
+                    bestlevel, scale),
             })
+        self._superRegions = cachetools.LRUCache(
+            self.superRegionCacheBytes, getsizeof=estimateSize)
+        self._superRegionsLock = threading.Lock()
+        self._rgbJpegLevels = set()
+        self._tiffDirectories = self._getDirectTiffDirectories(largeImagePath)
 
     def _getTileSize(self):
         """
@@ -179,6 +233,105 @@ class OpenslideFileTileSource(FileTileSource):
         self.tileWidth = min(width, self.sizeX)
         self.tileHeight = min(height, self.sizeY)
 
+    def _getMaxReadSize(self):
+        """
+        Get the largest width or height of a region that is read to make one
+        tile, based on the 'openslide_max_read_size' config value or, if that
+        isn't set, so that a region uses at most 1/64th of the memory.
+
+        :returns: a size in pixels.
+        """
+        maxSize = config.getConfig('openslide_max_read_size')
+        if not maxSize:
+            maxSize = int(math.sqrt(getAvailableMemory() // 64 // 4))
+        return max(int(maxSize), self.tileWidth, self.tileHeight)
+
+    def _getDirectTiffDirectories(self, path):
+        """
+        Find the SVS levels that are stored as JPEG-compressed TIFF directories
+        with the same tile size as our tiles.  Tiles of these levels can be
+        returned without decoding and reencoding them.  Levels whose JPEGs
+        store RGB rather than YCbCr are added to self._rgbJpegLevels, since
+        their tiles need a marker that says so.
+
+        :param path: the path of the SVS file.
+        :returns: a dictionary of TiledTiffDirectory objects keyed by SVS
+            level number.
+        """
+        directories = {}
+        if (TiledTiffDirectory is None or self._openslide.properties.get(
+                openslide.PROPERTY_NAME_VENDOR) not in self.directTiffVendors):
+            return directories
+        try:
+            tiffInfos = readTiffDirectories(path)
+            sharedFile = SharedTiffFile(path)
+        except (ValueError, EnvironmentError, TiffException):
+            return directories
+        svslevels = {entry['svslevel'] for entry in self._svslevels
+                     if entry['scale'] == 1 and not entry['synthesized']}
+        for directoryNum, tiffInfo in enumerate(tiffInfos):
+            if (tiffInfo.get('compression') != 7 or
+                    tiffInfo.get('photometric') not in {
+                        PHOTOMETRIC_MINISBLACK, PHOTOMETRIC_RGB, PHOTOMETRIC_YCBCR} or
+                    tiffInfo.get('tilewidth') != self.tileWidth or
+                    tiffInfo.get('tilelength') != self.tileHeight):
+                continue
+            size = (tiffInfo.get('imagewidth'), tiffInfo.get('imagelength'))
+            for svslevel in svslevels:
+                if (svslevel not in directories and
+                        tuple(self._openslide.level_dimensions[svslevel]) == size):
+                    try:
+                        directories[svslevel] = TiledTiffDirectory(
+                            path, directoryNum, sharedFile=sharedFile, tiffInfo=tiffInfo)
+                    except TiffException:
+                        pass
+                    else:
+                        if tiffInfo.get('photometric') == PHOTOMETRIC_RGB:
+                            self._rgbJpegLevels.add(svslevel)
+                    break
+        return directories
+
+    def _getSuperRegionTiles(self, svslevel, scale):
+        """
+        Determine how many output tiles are read at once from an SVS level.
+        If an output tile doesn't cover a whole number of the level's tiles,
+        neighboring output tiles would decode the same level tiles, so a
+        region of several output tiles is read instead.  Where possible, the
+        region is aligned to the level's tiles.
+
+        :param svslevel: the SVS level number.
+        :param scale: the scale between the SVS level and the output tiles.
+        :returns: the number of output tiles in a super-region horizontally
+            and vertically.  (1, 1) reads each output tile separately.
+        """
+        tiles = []
+        for tileSize, key in ((self.tileWidth, 'tile-width'), (self.tileHeight, 'tile-height')):
+            try:
+                nativeSize = int(self._openslide.properties[
+                    'openslide.level[%d].%s' % (svslevel, key)])
+            except (ValueError, KeyError):
+                nativeSize = 0
+            tiles.append(self._superRegionTileCount(nativeSize, tileSize * scale))
+        return tuple(tiles)
+
+    def _superRegionTileCount(self, nativeSize, footprint):
+        """
+        Determine how many output tiles are in a super-region along one axis.
+
+        :param nativeSize: the tile size of the SVS level or 0 if unknown.
+        :param footprint: the size of an output tile in SVS level pixels.
+        :returns: the number of output tiles.
+        """
+        if nativeSize <= 0 or not footprint % nativeSize:
+            return 1
+        a, b = nativeSize, footprint
+        while b:
+            a, b = b, a % b
+        aligned = nativeSize * footprint // a
+        if aligned <= self.superRegionSize:
+            return aligned // footprint
+        return max(1, self.superRegionSize // footprint)
+
     def _getAvailableLevels(self, path):
         """
         Some SVS files (notably some NDPI variants) have levels that cannot be
@@ -262,22 +415,127 @@ class OpenslideFileTileSource(FileTileSource):
         offsety = y * self.tileHeight * scale
         if not (0 <= offsety < self.sizeY):
             raise TileSourceException('y is outside layer')
-        # We ask to read an area that will cover the tile at the z level.  The
-        # scale we computed in the __init__ process for this svs level tells
-        # how much larger a region we need to read.
+        if svslevel['synthesized']:
+            tile = self._getSynthesizedTile(
+                x, y, z, lambda: self._makeTileFromNextLevel(x, y, z))
+            return self._outputTile(tile, 'PIL', x, y, z, pilImageAllowed, **kwargs)
+        if svslevel['scale'] == 1 and svslevel['svslevel'] in self._tiffDirectories:
+            try:
+                tile = self._tiffDirectories[svslevel['svslevel']].getTile(x, y)
+            except TiffException:
+                # The tile may not be stored in the file; let OpenSlide decide
+                # what it contains.
+                pass
+            else:
+                if svslevel['svslevel'] in self._rgbJpegLevels:
+                    tile = _markJpegRgb(tile)
+                return self._outputTile(tile, 'JPEG', x, y, z, pilImageAllowed, **kwargs)
+        if svslevel['superRegion'] != (1, 1):
+            tile = self._getTileFromSuperRegion(x, y, z)
+        else:
+            tile = self._readRegion(
+                offsetx, offsety, svslevel, self.tileWidth, self.tileHeight)
+        return self._outputTile(tile, 'PIL', x, y, z, pilImageAllowed, **kwargs)
+
+    def _makeTileFromNextLevel(self, x, y, z):
+        """
+        Make a tile from the four tiles of the next level that it covers.
+        Tiles of the next level may also be made this way, so lower resolution
+        levels are built progressively and only a few tiles are in memory at
+        once.
+
+        :param x: the x tile location.
+        :param y: the y tile location.
+        :param z: the tile level.
+        :returns: a PIL image.
+        """
+        scale = 2 ** (self.levels - 2 - z)
+        maxX = (self.sizeX - 1) // (self.tileWidth * scale)
+        maxY = (self.sizeY - 1) // (self.tileHeight * scale)
+        subtiles = [(x * 2 + dx, y * 2 + dy, z + 1) for dy in range(2) for dx in range(2)
+                    if x * 2 + dx <= maxX and y * 2 + dy <= maxY]
+        tile = PIL.Image.new('RGBA', (self.tileWidth * 2, self.tileHeight * 2))
+        for (subX, subY, _), subtile in zip(subtiles, self.getTiles(
+                subtiles, pilImageAllowed=True, edge=False)):
+            if not isinstance(subtile, PIL.Image.Image):
+                subtile = PIL.Image.open(BytesIO(subtile))
+            tile.paste(subtile, ((subX - x * 2) * self.tileWidth, (subY - y * 2) * self.tileHeight))
+        return self._reduceTile(tile, self.tileWidth, self.tileHeight)
+
+    def _readRegion(self, offsetx, offsety, svslevel, width, height):
+        """
+        Read a region from an SVS level and scale it to the output resolution.
+
+        :param offsetx: the left of the region in SVS level 0 coordinates.
+        :param offsety: the top of the region in SVS level 0 coordinates.
+        :param svslevel: an entry from self._svslevels.
+        :param width: the width of the region at the output resolution.
+        :param height: the height of the region at the output resolution.
+        :returns: a PIL image.
+        """
+        # We ask to read an area that will cover the region at the z level.
+        # The scale we computed in the __init__ process for this svs level
+        # tells how much larger a region we need to read.
         try:
-            tile = self._openslide.read_region(
+            region = self._openslide.read_region(
                 (offsetx, offsety), svslevel['svslevel'],
-                (self.tileWidth * svslevel['scale'],
-                 self.tileHeight * svslevel['scale']))
+                (width * svslevel['scale'], height * svslevel['scale']))
         except openslide.lowlevel.OpenSlideError as exc:
             raise TileSourceException(
                 'Failed to get OpenSlide region (%r).' % exc)
         # Always scale to the svs level 0 tile size.
         if svslevel['scale'] != 1:
-            tile = tile.resize((self.tileWidth, self.tileHeight),
-                               PIL.Image.LANCZOS)
-        return self._outputTile(tile, 'PIL', x, y, z, pilImageAllowed, **kwargs)
+            region = self._reduceTile(region, width, height)
+        return region
+
+    def _getTileFromSuperRegion(self, x, y, z):
+        """
+        Get a tile by cropping it from a super-region of several output tiles.
+        Recently read super-regions are kept so that neighboring tiles don't
+        read them again.
+
+        :param x: the x tile location.
+        :param y: the y tile location.
+        :param z: the tile level.
+        :returns: a PIL image.
+        """
+        svslevel = self._svslevels[z]
+        tilesX, tilesY = svslevel['superRegion']
+        key = (z, x // tilesX, y // tilesY)
+        with self._superRegionsLock:
+            region = self._superRegions.get(key)
+        if region is None:
+            scale = 2 ** (self.levels - 1 - z)
+            region = self._readRegion(
+                key[1] * tilesX * self.tileWidth * scale,
+                key[2] * tilesY * self.tileHeight * scale, svslevel,
+                tilesX * self.tileWidth, tilesY * self.tileHeight)
+            with self._superRegionsLock:
+                try:
+                    self._superRegions[key] = region
+                except ValueError:
+                    pass  # larger than the cache
+        left = (x % tilesX) * self.tileWidth
+        top = (y % tilesY) * self.tileHeight
+        return region.crop((left, top, left + self.tileWidth, top + self.tileHeight))
+
+    def _reduceTile(self, tile, width, height):
+        """
+        Scale a region that was read from a higher resolution level to the
+        output size.  OpenSlide decodes the region at its full size, so where
+        PIL supports it, the region is first shrunk by an integer factor with
+        a box filter, which is much faster than resampling all of it.
+
+        :param tile: a PIL image that is larger than the output size.
+        :param width: the output width.
+        :param height: the output height.
+        :returns: a PIL image of the output size.
+        """
+        try:
+            return tile.resize((width, height), PIL.Image.LANCZOS, reducing_gap=2.0)
+        except TypeError:
+            # Versions of PIL before 7.0 don't have a reducing_gap option
+            return tile.resize((width, height), PIL.Image.LANCZOS)
 
     def getPreferredLevel(self, level):
         """
@@ -285,10 +543,15 @@ class OpenslideFileTileSource(FileTileSource):
         resolution), return the level that contains actual data that is no
         lower resolution.
 
+        Levels that are made from the next level are used as they are, since
+        their tiles are built progressively and may be in the disk cache.
+
         :param level: desired level
         :returns level: a level with actual data that is no lower resolution.
         """
         level = max(0, min(level, self.levels - 1))
+        if self._svslevels[level]['synthesized']:
+            return level
         scale = self._svslevels[level]['scale']
         while scale > 1:
             level += 1
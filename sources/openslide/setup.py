@@ -46,6 +46,7 @@ setup(
     ],
     extras_require={
         'girder': 'girder-large-image>=1.0.0',
+        'tiff': 'large-image-source-tiff>=1.0.0',
     },
     license='Apache Software License 2.0',
     keywords='large_image, tile source',
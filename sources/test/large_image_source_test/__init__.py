@@ -166,9 +166,10 @@ class TestTileSource(TileSource):
                 *args, **kwargs),
             kwargs.get('minLevel'), kwargs.get('maxLevel'),
             kwargs.get('tileWidth'), kwargs.get('tileHeight'),
-            kwargs.get('fractal'))
+            kwargs.get('sizeX'), kwargs.get('sizeY'), kwargs.get('fractal'))
 
     def getState(self):
-        return 'test %r %r %r %r %r %r' % (
+        return 'test %r %r %r %r %r %r %r %r' % (
             super(TestTileSource, self).getState(), self.minLevel,
-            self.maxLevel, self.tileWidth, self.tileHeight, self.fractal)
+            self.maxLevel, self.tileWidth, self.tileHeight, self.sizeX,
+            self.sizeY, self.fractal)
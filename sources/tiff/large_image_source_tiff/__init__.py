@@ -19,6 +19,7 @@
 import base64
 import itertools
 import math
+import numpy
 import PIL.Image
 import six
 from pkg_resources import DistributionNotFound, get_distribution
@@ -26,13 +27,15 @@ from six import BytesIO
 from six.moves import range
 
 from large_image import config
-from large_image.cache_util import LruCacheMetaclass, methodcache
+from large_image.cache_util import LruCacheMetaclass, getSynthesizedLevelCache, methodcache
 from large_image.constants import SourcePriority
 from large_image.exceptions import TileSourceException
-from large_image.tilesource import FileTileSource, TILE_FORMAT_PIL, nearPowerOfTwo
+from large_image.tilesource import FileTileSource, TILE_FORMAT_NUMPY, TILE_FORMAT_PIL, \
+    nearPowerOfTwo
 
+from .tiff_ifd import readTiffDirectories
 from .tiff_reader import TiledTiffDirectory, TiffException, \
-    InvalidOperationTiffException, IOTiffException, ValidationTiffException
+    InvalidOperationTiffException, IOTiffException, ValidationTiffException, SharedTiffFile
 
 
 try:
@@ -46,9 +49,16 @@ except DistributionNotFound:
 class TiffFileTileSource(FileTileSource):
     """
     Provides tile access to TIFF files.
+
+    A source can be used from many threads at once.  JPEG and JPEG 2000
+    tiles are read from a memory map or with positional reads and don't take
+    a lock; tiles that libtiff decodes are serialized on the file's single
+    libtiff handle.  See the 'tiff_read_mode' config value.
     """
 
     cacheName = 'tilesource'
+    # All levels share a memory map or file descriptor and a libtiff handle
+    cacheFileHandles = 2
     name = 'tifffile'
     extensions = {
         None: SourcePriority.MEDIUM,
@@ -74,7 +84,6 @@ class TiffFileTileSource(FileTileSource):
         super(TiffFileTileSource, self).__init__(path, **kwargs)
 
         largeImagePath = self._getLargeImagePath()
-        lastException = None
         # Associated images are smallish TIFF images that have an image
         # description and are not tiled.  They have their own TIFF directory.
         # Individual TIFF images can also have images embedded into their
@@ -82,33 +91,13 @@ class TiffFileTileSource(FileTileSource):
         # images into a file) -- those are stored in the individual
         # directories' _embeddedImages field.
         self._associatedImages = {}
-
-        # Query all know directories in the tif file.  Only keep track of
-        # directories that contain tiled images.
-        alldir = []
-        for directoryNum in itertools.count():  # pragma: no branch
-            try:
-                td = TiledTiffDirectory(largeImagePath, directoryNum)
-            except ValidationTiffException as exc:
-                lastException = exc
-                self._addAssociatedImage(largeImagePath, directoryNum)
-                continue
-            except TiffException as exc:
-                if not lastException:
-                    lastException = exc
-                break
-            if not td.tileWidth or not td.tileHeight:
-                continue
-            # Calculate the tile level, where 0 is a single tile, 1 is up to a
-            # set of 2x2 tiles, 2 is 4x4, etc.
-            level = int(math.ceil(math.log(max(
-                float(td.imageWidth) / td.tileWidth,
-                float(td.imageHeight) / td.tileHeight)) / math.log(2)))
-            if level < 0:
-                continue
-            # Store information for sorting with the directory.
-            alldir.append((td.tileWidth * td.tileHeight, level,
-                           td.imageWidth * td.imageHeight, directoryNum, td))
+        # All of the directories share one handle to the file.
+        try:
+            self._sharedFile = SharedTiffFile(largeImagePath)
+        except TiffException as exc:
+            raise TileSourceException(
+                "File %s didn't meet requirements for tile source: %s" % (largeImagePath, exc))
+        alldir, lastException = self._scanDirectories(largeImagePath)
         # If there are no tiled images, raise an exception.
         if not len(alldir):
             msg = "File %s didn't meet requirements for tile source: %s" % (
@@ -151,17 +140,72 @@ class TiffFileTileSource(FileTileSource):
         self.sizeX = highest.imageWidth
         self.sizeY = highest.imageHeight
 
-    def _addAssociatedImage(self, largeImagePath, directoryNum):
+    def _scanDirectories(self, largeImagePath):
+        """
+        Open each directory of the TIFF file, keeping the tiled directories and
+        adding associated images.
+
+        :param largeImagePath: path to the TIFF file.
+        :returns: a list of (tile area, level, image area, directory number,
+            TiledTiffDirectory) tuples for the tiled directories, and the
+            last exception raised when opening a directory.
+        """
+        # Read the tags of all directories at once.  If the file can't be
+        # parsed this way, libtiff reads each directory's tags.
+        try:
+            tiffInfos = readTiffDirectories(largeImagePath)
+        except (ValueError, EnvironmentError):
+            tiffInfos = None
+
+        # Query all know directories in the tif file.  Only keep track of
+        # directories that contain tiled images.
+        alldir = []
+        lastException = None
+        for directoryNum in itertools.count():  # pragma: no branch
+            if tiffInfos is not None and directoryNum >= len(tiffInfos):
+                break
+            tiffInfo = tiffInfos[directoryNum] if tiffInfos is not None else None
+            try:
+                td = TiledTiffDirectory(
+                    largeImagePath, directoryNum, sharedFile=self._sharedFile, tiffInfo=tiffInfo)
+            except ValidationTiffException as exc:
+                lastException = exc
+                self._addAssociatedImage(largeImagePath, directoryNum, tiffInfo)
+                continue
+            except TiffException as exc:
+                if not lastException:
+                    lastException = exc
+                break
+            if not td.tileWidth or not td.tileHeight:
+                continue
+            # Calculate the tile level, where 0 is a single tile, 1 is up to a
+            # set of 2x2 tiles, 2 is 4x4, etc.
+            level = int(math.ceil(math.log(max(
+                float(td.imageWidth) / td.tileWidth,
+                float(td.imageHeight) / td.tileHeight)) / math.log(2)))
+            if level < 0:
+                continue
+            # Store information for sorting with the directory.
+            alldir.append((td.tileWidth * td.tileHeight, level,
+                           td.imageWidth * td.imageHeight, directoryNum, td))
+        return alldir, lastException
+
+    def _addAssociatedImage(self, largeImagePath, directoryNum, tiffInfo=None):
         """
         Check if the specified TIFF directory contains a non-tiled image with a
         sensible image description that can be used as an ID.  If so, and if
-        the image isn't too large, add this image as an associated image.
+        the image isn't too large, add this image as an associated image.  The
+        image isn't read until it is requested.
 
         :param largeImagePath: path to the TIFF file.
         :param directoryNum: libtiff directory number of the image.
+        :param tiffInfo: the tags of the directory from readTiffDirectories,
+            or None to read them with libtiff.
         """
         try:
-            associated = TiledTiffDirectory(largeImagePath, directoryNum, False)
+            associated = TiledTiffDirectory(
+                largeImagePath, directoryNum, False, sharedFile=self._sharedFile,
+                tiffInfo=tiffInfo)
             id = associated._tiffInfo.get(
                 'imagedescription').strip().split(None, 1)[0].lower()
             if not isinstance(id, six.text_type):
@@ -172,7 +216,12 @@ class TiffFileTileSource(FileTileSource):
             if (id.isalnum() and len(id) > 3 and len(id) <= 20 and
                     associated._pixelInfo['width'] <= 8192 and
                     associated._pixelInfo['height'] <= 8192):
-                self._associatedImages[id] = associated._tiffFile.read_image()
+                self._associatedImages[id] = {
+                    'directoryNum': directoryNum,
+                    'tiffInfo': tiffInfo,
+                    'width': associated._pixelInfo['width'],
+                    'height': associated._pixelInfo['height'],
+                }
         except (TiffException, AttributeError):
             # If we can't validate or read an associated image or it has no
             # useful imagedescription, fail quietly without adding an
@@ -217,6 +266,8 @@ class TiffFileTileSource(FileTileSource):
                 format = 'JPEG'
             if PIL and isinstance(tile, PIL.Image.Image):
                 format = TILE_FORMAT_PIL
+            if isinstance(tile, numpy.ndarray):
+                format = TILE_FORMAT_NUMPY
             return self._outputTile(tile, format, x, y, z, pilImageAllowed,
                                     **kwargs)
         except IndexError:
@@ -228,11 +279,34 @@ class TiffFileTileSource(FileTileSource):
                 x, y, z, pilImageAllowed=pilImageAllowed,
                 sparseFallback=sparseFallback, exception=e, **kwargs)
 
+    def _sortTileRequests(self, indices, calls):
+        """
+        Read tiles that are not in the cache in the order they are stored in
+        the file: by directory, then by the offset of the tile data.  Tiles
+        without a known offset are ordered by row, then by column.
+
+        :param indices: a list of indices within calls that need to be read.
+        :param calls: a list of ((x, y, z), kwargs) tuples for getTile.
+        :returns: the list of indices in the order they should be read.
+        """
+        def fileOrder(idx):
+            (x, y, z), kwargs = calls[idx]
+            directory = None
+            if 0 <= z < len(self._tiffDirectories):
+                directory = self._tiffDirectories[z]
+            offset = directory.getTileOffset(x, y) if directory is not None else None
+            return (kwargs.get('frame') or 0,
+                    getattr(directory, '_directoryNum', -1), offset or 0, y, x)
+
+        return sorted(indices, key=fileOrder)
+
     def getTileIOTiffException(self, x, y, z, pilImageAllowed=False,
                                sparseFallback=False, exception=None, **kwargs):
         if sparseFallback and z and PIL:
             noedge = kwargs.copy()
             noedge.pop('edge', None)
+            # The lower resolution tile is scaled as an 8-bit PIL image
+            noedge.pop('numpyAllowed', None)
             image = self.getTile(
                 x / 2, y / 2, z - 1, pilImageAllowed=True,
                 sparseFallback=sparseFallback, edge=False, **noedge)
@@ -253,32 +327,73 @@ class TiffFileTileSource(FileTileSource):
         Given the x, y, z tile location in an unpopulated level, get tiles from
         higher resolution levels to make the lower-res tile.
 
+        If the 'cache_synthesized_levels_path' config value is set, the tile
+        is made from the next level, which may itself be made, and is stored
+        in a disk cache so that later requests read it as a single tile.
+
         :param x: location of tile within original level.
         :param y: location of tile within original level.
         :param z: original level.
         :returns: tile in PIL format.
         """
-        scale = 1
-        while self._tiffDirectories[z] is None:
+        if getSynthesizedLevelCache() is None:
+            return self._makeTileFromHigherLevel(x, y, z, **kwargs)
+        return self._getSynthesizedTile(
+            x, y, z, lambda: self._makeTileFromHigherLevel(x, y, z, nextLevel=True, **kwargs),
+            kwargs.get('frame'))
+
+    def _makeTileFromHigherLevel(self, x, y, z, nextLevel=False, **kwargs):
+        """
+        Make the tile of an unpopulated level from the tiles of a higher
+        resolution level.
+
+        JPEG tiles are decoded at 1/2, 1/4, or 1/8 of their size using the
+        scaled IDCT of the JPEG decoder when the scale allows it, rather than
+        decoding them fully and then shrinking them.
+
+        :param x: location of tile within original level.
+        :param y: location of tile within original level.
+        :param z: original level.
+        :param nextLevel: if True, use the next level even if it is also
+            unpopulated.  Otherwise, use the closest populated level.
+        :returns: tile in PIL format.
+        """
+        scale = 2
+        z += 1
+        while not nextLevel and self._tiffDirectories[z] is None:
             scale *= 2
             z += 1
+        # The scale that subtiles are reduced to when they are decoded.  This
+        # must evenly divide the tile size.
+        reduction = min(scale, 8)
+        while self.tileWidth % reduction or self.tileHeight % reduction:
+            reduction //= 2
+        subtileWidth = self.tileWidth // reduction
+        subtileHeight = self.tileHeight // reduction
         tile = PIL.Image.new(
-            'RGBA', (self.tileWidth * scale, self.tileHeight * scale))
+            'RGBA', (subtileWidth * scale, subtileHeight * scale))
         maxX = 2.0 ** (z + 1 - self.levels) * self.sizeX / self.tileWidth
         maxY = 2.0 ** (z + 1 - self.levels) * self.sizeY / self.tileHeight
-        for newX in range(scale):
-            for newY in range(scale):
-                if ((newX or newY) and ((x * scale + newX) >= maxX or
-                                        (y * scale + newY) >= maxY)):
-                    continue
-                subtile = self.getTile(
-                    x * scale + newX, y * scale + newY, z,
-                    pilImageAllowed=True, sparseFallback=True, edge=False,
-                    frame=kwargs.get('frame'))
-                if not isinstance(subtile, PIL.Image.Image):
-                    subtile = PIL.Image.open(BytesIO(subtile))
-                tile.paste(subtile, (newX * self.tileWidth,
-                                     newY * self.tileHeight))
+        subtiles = [
+            (newX, newY) for newX in range(scale) for newY in range(scale)
+            if not ((newX or newY) and ((x * scale + newX) >= maxX or
+                                        (y * scale + newY) >= maxY))]
+        subtileList = self.getTiles(
+            [(x * scale + newX, y * scale + newY, z, kwargs.get('frame'))
+             for newX, newY in subtiles],
+            pilImageAllowed=True, edge=False,
+            sparseFallback=self._tiffDirectories[z] is not None)
+        for (newX, newY), subtile in zip(subtiles, subtileList):
+            if not isinstance(subtile, PIL.Image.Image):
+                subtile = PIL.Image.open(BytesIO(subtile))
+                if reduction > 1:
+                    # This only affects JPEGs
+                    subtile.draft('RGB', (subtileWidth, subtileHeight))
+            if subtile.size != (subtileWidth, subtileHeight):
+                subtile = subtile.resize((subtileWidth, subtileHeight), PIL.Image.LANCZOS)
+            tile.paste(subtile, (newX * subtileWidth, newY * subtileHeight))
+        if reduction == scale:
+            return tile
         return tile.resize((self.tileWidth, self.tileHeight),
                            PIL.Image.LANCZOS)
 
@@ -327,5 +442,21 @@ class TiffFileTileSource(FileTileSource):
                 image = PIL.Image.open(BytesIO(base64.b64decode(td._embeddedImages[imageKey])))
                 return image
         if imageKey in self._associatedImages:
-            return PIL.Image.fromarray(self._associatedImages[imageKey])
+            return self._readAssociatedImage(self._associatedImages[imageKey])
+        return None
+
+    def _readAssociatedImage(self, record):
+        """
+        Read and decode an associated image from its TIFF directory.
+
+        :param record: the entry of the image in _associatedImages.
+        :return: the image in PIL format or None if it can't be read.
+        """
+        try:
+            associated = TiledTiffDirectory(
+                self._getLargeImagePath(), record['directoryNum'], False,
+                sharedFile=self._sharedFile, tiffInfo=record['tiffInfo'])
+            return PIL.Image.fromarray(associated.readImage())
+        except Exception:
+            config.getConfig('logger').exception('Could not read associated image.')
         return None
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import numpy
+import struct
+import sys
+
+# The tags that are read from each directory, keyed by tag number.  The names
+# match the lower-case names libtiff uses, so the results can be used in place
+# of values from TIFFGetField.
+Tags = {
+    254: 'subfiletype',
+    256: 'imagewidth',
+    257: 'imagelength',
+    258: 'bitspersample',
+    259: 'compression',
+    262: 'photometric',
+    266: 'fillorder',
+    270: 'imagedescription',
+    271: 'make',
+    272: 'model',
+    273: 'stripoffsets',
+    274: 'orientation',
+    277: 'samplesperpixel',
+    278: 'rowsperstrip',
+    279: 'stripbytecounts',
+    282: 'xresolution',
+    283: 'yresolution',
+    284: 'planarconfig',
+    296: 'resolutionunit',
+    305: 'software',
+    306: 'datetime',
+    317: 'predictor',
+    322: 'tilewidth',
+    323: 'tilelength',
+    324: 'tileoffsets',
+    325: 'tilebytecounts',
+    339: 'sampleformat',
+    347: 'jpegtables',
+}
+
+# Tags that are returned as a single value by libtiff, even though the file
+# stores one value per sample.
+SingleValueTags = {'bitspersample', 'sampleformat'}
+
+# Tags that are always returned as arrays.
+ArrayTags = {'stripoffsets', 'stripbytecounts', 'tileoffsets', 'tilebytecounts'}
+
+# TIFF data types: (numpy type, number of numpy values per TIFF value)
+DataTypes = {
+    1: ('u1', 1),   # BYTE
+    2: ('S1', 1),   # ASCII
+    3: ('u2', 1),   # SHORT
+    4: ('u4', 1),   # LONG
+    5: ('u4', 2),   # RATIONAL
+    6: ('i1', 1),   # SBYTE
+    7: ('u1', 1),   # UNDEFINED
+    8: ('i2', 1),   # SSHORT
+    9: ('i4', 1),   # SLONG
+    10: ('i4', 2),  # SRATIONAL
+    11: ('f4', 1),  # FLOAT
+    12: ('f8', 1),  # DOUBLE
+    13: ('u4', 1),  # IFD
+    16: ('u8', 1),  # LONG8
+    17: ('i8', 1),  # SLONG8
+    18: ('u8', 1),  # IFD8
+}
+
+# Files with more directories than this are probably corrupt.
+MaxDirectories = 65536
+
+
+class BlockReader(object):
+    """
+    Read parts of a file in large blocks, so that reading many small values
+    that are near each other only reads from the file a few times.
+    """
+
+    def __init__(self, fptr, blockSize=65536):
+        """
+        :param fptr: a file-like object opened in binary mode.
+        :param blockSize: the size of each read from the file.
+        """
+        self._fptr = fptr
+        self._blockSize = blockSize
+        self._blocks = {}
+
+    def read(self, offset, length):
+        """
+        Read data from the file.
+
+        :param offset: the position in the file.
+        :param length: the number of bytes to read.
+        :returns: the data.
+        :raises: ValueError if the file is too short.
+        """
+        if length > self._blockSize:
+            self._fptr.seek(offset)
+            data = self._fptr.read(length)
+        else:
+            data = b''
+            pos = offset
+            while len(data) < length:
+                blockNum = pos // self._blockSize
+                if blockNum not in self._blocks:
+                    self._fptr.seek(blockNum * self._blockSize)
+                    self._blocks[blockNum] = self._fptr.read(self._blockSize)
+                block = self._blocks[blockNum]
+                start = pos - blockNum * self._blockSize
+                chunk = block[start:start + length - len(data)]
+                if not chunk:
+                    break
+                data += chunk
+                pos += len(chunk)
+        if len(data) != length:
+            raise ValueError('TIFF file is truncated')
+        return data
+
+
+def _readValue(reader, byteOrder, bigTiff, name, datatype, count, valueData):
+    """
+    Decode the value of a tag.
+
+    :param reader: a BlockReader for the file.
+    :param byteOrder: '<' or '>'.
+    :param bigTiff: True if this is a BigTIFF file.
+    :param name: the libtiff name of the tag.
+    :param datatype: the TIFF data type of the tag.
+    :param count: the number of values in the tag.
+    :param valueData: the value or offset field of the directory entry.
+    :returns: the decoded value, or None if the type isn't understood.
+    """
+    if datatype not in DataTypes:
+        return None
+    dtype, perValue = DataTypes[datatype]
+    dtype = numpy.dtype(dtype).newbyteorder(byteOrder)
+    length = dtype.itemsize * perValue * count
+    if length > len(valueData):
+        offset = struct.unpack(byteOrder + ('Q' if bigTiff else 'I'), valueData)[0]
+        data = reader.read(offset, length)
+    else:
+        data = valueData[:length]
+    if datatype == 2:
+        return data.split(b'\0', 1)[0]
+    if name == 'jpegtables':
+        return data
+    values = numpy.frombuffer(data, dtype=dtype)
+    if perValue == 2:
+        values = values[::2].astype(float) / numpy.maximum(values[1::2], 1)
+    if name in ArrayTags:
+        return values
+    if count == 1 or name in SingleValueTags:
+        return values[0].item()
+    return values.tolist()
+
+
+def _readDirectory(reader, byteOrder, bigTiff, offset):
+    """
+    Read one image file directory.
+
+    :param reader: a BlockReader for the file.
+    :param byteOrder: '<' or '>'.
+    :param bigTiff: True if this is a BigTIFF file.
+    :param offset: the position of the directory in the file.
+    :returns: a dictionary of tag values and the offset of the next directory.
+    """
+    countFormat, entryFormat, offsetFormat = (
+        ('Q', 'HHQ8s', 'Q') if bigTiff else ('H', 'HHI4s', 'I'))
+    countSize = struct.calcsize(countFormat)
+    entrySize = struct.calcsize('<' + entryFormat)
+    count = struct.unpack(byteOrder + countFormat, reader.read(offset, countSize))[0]
+    data = reader.read(offset + countSize, count * entrySize + struct.calcsize(offsetFormat))
+    info = {}
+    for idx in range(count):
+        tag, datatype, valueCount, valueData = struct.unpack(
+            byteOrder + entryFormat, data[idx * entrySize:(idx + 1) * entrySize])
+        name = Tags.get(tag)
+        if name is None or not valueCount:
+            continue
+        value = _readValue(reader, byteOrder, bigTiff, name, datatype, valueCount, valueData)
+        if value is not None:
+            info[name] = value
+    nextOffset = struct.unpack(byteOrder + offsetFormat, data[count * entrySize:])[0]
+    return info, nextOffset
+
+
+def readTiffDirectories(filePath):
+    """
+    Read the tags that are used by the TIFF tile source from all of the image
+    file directories of a TIFF file.  This reads the file in a few large
+    blocks rather than asking libtiff for each tag of each directory.
+
+    Each directory is described with the same names and default values that
+    libtiff would report, plus 'istiled', 'isbyteswapped' if the file's byte
+    order isn't the native byte order, and, for the last directory,
+    'lastdirectory'.
+
+    :param filePath: a path to a TIFF file on disk.
+    :returns: a list of dictionaries, one per directory.
+    :raises: ValueError if the file isn't a TIFF file or can't be parsed, or
+        EnvironmentError if it can't be read.
+    """
+    with open(filePath, 'rb') as fptr:
+        reader = BlockReader(fptr)
+        header = reader.read(0, 8)
+        if header[:2] not in (b'II', b'MM'):
+            raise ValueError('Not a TIFF file')
+        byteOrder = '<' if header[:2] == b'II' else '>'
+        version = struct.unpack(byteOrder + 'H', header[2:4])[0]
+        if version == 42:
+            bigTiff = False
+            offset = struct.unpack(byteOrder + 'I', header[4:8])[0]
+        elif version == 43:
+            bigTiff = True
+            offset = struct.unpack(byteOrder + 'Q', reader.read(8, 8))[0]
+        else:
+            raise ValueError('Not a TIFF file')
+        directories = []
+        seen = set()
+        while offset:
+            if offset in seen or len(directories) >= MaxDirectories:
+                raise ValueError('TIFF file has a directory loop')
+            seen.add(offset)
+            info, offset = _readDirectory(reader, byteOrder, bigTiff, offset)
+            _addDefaults(info)
+            if byteOrder != ('<' if sys.byteorder == 'little' else '>'):
+                info['isbyteswapped'] = 1
+            directories.append(info)
+    if not directories:
+        raise ValueError('TIFF file has no directories')
+    directories[-1]['lastdirectory'] = 1
+    return directories
+
+
+def _addDefaults(info):
+    """
+    Add the values that libtiff reports for a directory even if they are not
+    in the file.
+
+    :param info: a dictionary of tag values that is modified.
+    """
+    info.setdefault('compression', 1)
+    info.setdefault('planarconfig', 1)
+    if info['compression'] == 7:
+        # JPEGTABLESMODE is a pseudo-tag of libtiff's JPEG codec; its default
+        # is that both the quantization and Huffman tables are shared.
+        info.setdefault('jpegtablesmode', 3)
+    if 'tilewidth' in info and 'tilelength' in info:
+        info['istiled'] = 1
+    elif 'stripoffsets' in info:
+        info['numberofstrips'] = len(info['stripoffsets'])
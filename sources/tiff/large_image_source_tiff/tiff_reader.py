@@ -17,9 +17,13 @@
 ###############################################################################
 
 import ctypes
+import mmap
+import numpy
 import PIL.Image
 import os
 import six
+import threading
+import zlib
 
 from collections import defaultdict
 from functools import partial
@@ -93,6 +97,30 @@ def patchLibtiff():
 
 patchLibtiff()
 
+# Some versions of pylibtiff set an explicit list of argtypes for
+# TIFFGetField, which doesn't allow fetching fields that are returned through
+# pointers.  Rather than altering the shared function's argtypes, use a
+# separate function object without argtypes for those fields.
+_TIFFGetFieldPointer = libtiff_ctypes.libtiff['TIFFGetField']
+_TIFFGetFieldPointer.restype = ctypes.c_int
+
+# Compression schemes whose tiles are decoded into numpy arrays at their full
+# bit depth.  Deflate compressed tiles are decompressed with zlib; the others
+# are read directly or decoded by libtiff.
+DecodedCompressions = {
+    libtiff_ctypes.COMPRESSION_NONE,
+    libtiff_ctypes.COMPRESSION_LZW,
+    libtiff_ctypes.COMPRESSION_ADOBE_DEFLATE,
+    libtiff_ctypes.COMPRESSION_DEFLATE,
+}
+
+# numpy type kinds for each TIFF sample format
+SampleFormatKinds = {
+    libtiff_ctypes.SAMPLEFORMAT_UINT: 'u',
+    libtiff_ctypes.SAMPLEFORMAT_INT: 'i',
+    libtiff_ctypes.SAMPLEFORMAT_IEEEFP: 'f',
+}
+
 
 class TiffException(Exception):
     pass
@@ -124,14 +152,154 @@ class ValidationTiffException(TiffException):
     pass
 
 
+class SharedTiffFile(object):
+    """
+    A TIFF file that is opened once and shared by all of its directories.
+
+    Raw data is read from a memory map of the file or with positional reads
+    from a single file descriptor, depending on the 'tiff_read_mode' config
+    value.  Both of these are safe to use from multiple threads.  Anything
+    that needs libtiff uses one libtiff handle, which is switched to the
+    needed directory; the lock must be held while using it.
+    """
+
+    def __init__(self, filePath, readMode=None):
+        """
+        Open a TIFF file.
+
+        :param filePath: A path to a TIFF file on disk.
+        :param readMode: 'mmap', 'pread', or 'libtiff'.  If None, this is
+            taken from the 'tiff_read_mode' config value.  With 'libtiff', raw
+            data is not read directly.
+        :raises: InvalidOperationTiffException
+        """
+        self.filePath = filePath
+        self.lock = threading.RLock()
+        self._map = None
+        self._fd = None
+        self._libtiff = None
+        self._libtiffDirectory = None
+        readMode = readMode or config.getConfig('tiff_read_mode')
+        try:
+            fd = os.open(filePath, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        except (EnvironmentError, TypeError):
+            raise InvalidOperationTiffException(
+                'TIFF file does not exist: %s' % filePath)
+        self.size = os.fstat(fd).st_size
+        if readMode == 'mmap':
+            try:
+                self._map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                # Python 2 mmap objects don't support memoryviews
+                memoryview(self._map)
+            except (EnvironmentError, ValueError, TypeError):
+                self._map = None
+        if readMode == 'pread' or (readMode == 'mmap' and self._map is None):
+            self._fd = fd
+        else:
+            # A memory map keeps its own reference to the file
+            os.close(fd)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Close the file.  This is done automatically when the file is no longer
+        used.
+        """
+        with self.lock:
+            if self._libtiff is not None:
+                self._libtiff.close()
+                self._libtiff = None
+            if self._map is not None:
+                try:
+                    self._map.close()
+                except BufferError:
+                    # Some tile data is still in use; the map will be closed
+                    # when it is released.
+                    pass
+                self._map = None
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def read(self, offset, length):
+        """
+        Read raw data from the file.
+
+        :param offset: the position in the file.
+        :param length: the number of bytes to read.
+        :returns: the data as a memoryview into the memory map or as bytes, or
+            None if raw data can't be read.
+        """
+        if not length or offset + length > self.size:
+            return None
+        if self._map is not None:
+            return memoryview(self._map)[offset:offset + length]
+        if self._fd is None:
+            return None
+        if hasattr(os, 'pread'):
+            data = os.pread(self._fd, length, offset)
+        else:
+            with self.lock:
+                os.lseek(self._fd, offset, os.SEEK_SET)
+                data = os.read(self._fd, length)
+        return data if len(data) == length else None
+
+    def libtiffHandle(self, directoryNum):
+        """
+        Get the libtiff handle for the file, set to a directory.  The lock
+        must be held while the handle is used.
+
+        :param directoryNum: The number of the TIFF IFD to be used.
+        :returns: a libtiff TIFF object.
+        :raises: IOTiffException
+        """
+        if self._libtiff is None:
+            try:
+                bytePath = self.filePath
+                if not isinstance(bytePath, six.binary_type):
+                    bytePath = self.filePath.encode('utf8')
+                tiffFile = libtiff_ctypes.TIFF.open(bytePath)
+            except TypeError:
+                raise IOTiffException(
+                    'Could not open TIFF file: %s' % self.filePath)
+            # pylibtiff changed the case of some functions between version 0.4
+            # and the version that supports libtiff 4.0.6.  To support both,
+            # ensure that the cased functions exist.
+            for func in TiledTiffDirectory.CoreFunctions:
+                if (not hasattr(tiffFile, func) and
+                        hasattr(tiffFile, func.lower())):
+                    setattr(tiffFile, func, getattr(
+                        tiffFile, func.lower()))
+            self._libtiff = tiffFile
+            self._libtiffDirectory = None
+        if self._libtiffDirectory != directoryNum:
+            self._libtiffDirectory = None
+            if self._libtiff.SetDirectory(directoryNum) != 1:
+                raise IOTiffException(
+                    'Could not set TIFF directory to %d' % directoryNum)
+            self._libtiffDirectory = directoryNum
+        return self._libtiff
+
+
 class TiledTiffDirectory(object):
+    """
+    A reader for one image file directory of a TIFF file.
+
+    Tiles can be read from many threads at once.  The tile offsets, sizes,
+    and tags are read when the directory is opened and are not modified
+    afterwards, raw tile data is read from the SharedTiffFile without a lock,
+    and the few operations that need libtiff hold the shared file's lock.
+    """
 
     CoreFunctions = [
         'SetDirectory', 'GetField', 'LastDirectory', 'GetMode', 'IsTiled',
         'IsByteSwapped', 'IsUpSampled', 'IsMSB2LSB', 'NumberOfStrips'
     ]
 
-    def __init__(self, filePath, directoryNum, mustBeTiled=True):
+    def __init__(self, filePath, directoryNum, mustBeTiled=True, sharedFile=None,
+                 tiffInfo=None):
         """
         Create a new reader for a tiled image file directory in a TIFF file.
 
@@ -142,6 +310,12 @@ class TiledTiffDirectory(object):
         :type directoryNum: int
         :param mustBeTiled: if True, only tiled images validate.  If False,
             only non-tiled images validate.  None validates both.
+        :param sharedFile: a SharedTiffFile for the file, so that all of the
+            directories of a file use one file handle.  If None, this
+            directory opens its own.
+        :param tiffInfo: an optional dictionary of the directory's tags from
+            readTiffDirectories.  If present, the metadata is not read through
+            libtiff.
         :raises: InvalidOperationTiffException or IOTiffException or
         ValidationTiffException
         """
@@ -150,16 +324,31 @@ class TiledTiffDirectory(object):
         # getTileByteCountsType
 
         self.cache = LRUCache(10)
+        self.cache_lock = threading.Lock()
         self._mustBeTiled = mustBeTiled
 
-        self._tiffFile = None
+        self._sharedFile = None
+        self._directoryNum = directoryNum
+        self._tileOffsets = self._tileByteCounts = None
 
-        self._open(filePath, directoryNum)
-        self._loadMetadata()
+        self._open(filePath, directoryNum, sharedFile)
+        tileArrays = None
+        if tiffInfo is None:
+            with self._sharedFile.lock:
+                self._loadMetadata()
+        else:
+            tiffInfo = tiffInfo.copy()
+            tileArrays = (tiffInfo.pop('tileoffsets', None), tiffInfo.pop('tilebytecounts', None))
+            tiffInfo.pop('stripoffsets', None)
+            tiffInfo.pop('stripbytecounts', None)
+            self._setMetadata(tiffInfo)
         config.getConfig('logger').debug(
             'TiffDirectory %d Information %r', directoryNum, self._tiffInfo)
         try:
             self._validate()
+            if self._tiffInfo.get('istiled'):
+                with self._sharedFile.lock:
+                    self._loadTileArrays(tileArrays)
         except ValidationTiffException:
             self._close()
             raise
@@ -167,7 +356,18 @@ class TiledTiffDirectory(object):
     def __del__(self):
         self._close()
 
-    def _open(self, filePath, directoryNum):
+    @property
+    def _tiffFile(self):
+        """
+        Get the libtiff handle of the file, set to this directory.  The shared
+        file's lock must be held while it is used.
+
+        :return: a libtiff TIFF object.
+        :raises: IOTiffException
+        """
+        return self._sharedFile.libtiffHandle(self._directoryNum)
+
+    def _open(self, filePath, directoryNum, sharedFile=None):
         """
         Open a TIFF file to a given file and IFD number.
 
@@ -175,39 +375,22 @@ class TiledTiffDirectory(object):
         :type filePath: str
         :param directoryNum: The number of the TIFF IFD to be used.
         :type directoryNum: int
+        :param sharedFile: a SharedTiffFile to use, or None to open the file.
         :raises: InvalidOperationTiffException or IOTiffException
         """
         self._close()
-        if not os.path.isfile(filePath):
-            raise InvalidOperationTiffException(
-                'TIFF file does not exist: %s' % filePath)
-        try:
-            bytePath = filePath
-            if not isinstance(bytePath, six.binary_type):
-                bytePath = filePath.encode('utf8')
-            self._tiffFile = libtiff_ctypes.TIFF.open(bytePath)
-        except TypeError:
-            raise IOTiffException(
-                'Could not open TIFF file: %s' % filePath)
-        # pylibtiff changed the case of some functions between version 0.4 and
-        # the version that supports libtiff 4.0.6.  To support both, ensure
-        # that the cased functions exist.
-        for func in self.CoreFunctions:
-            if (not hasattr(self._tiffFile, func) and
-                    hasattr(self._tiffFile, func.lower())):
-                setattr(self._tiffFile, func, getattr(
-                    self._tiffFile, func.lower()))
-
+        if sharedFile is None:
+            if not os.path.isfile(filePath):
+                raise InvalidOperationTiffException(
+                    'TIFF file does not exist: %s' % filePath)
+            sharedFile = SharedTiffFile(filePath)
+        self._sharedFile = sharedFile
         self._directoryNum = directoryNum
-        if self._tiffFile.SetDirectory(self._directoryNum) != 1:
-            self._tiffFile.close()
-            raise IOTiffException(
-                'Could not set TIFF directory to %d' % directoryNum)
 
     def _close(self):
-        if self._tiffFile:
-            self._tiffFile.close()
-            self._tiffFile = None
+        # The file is shared with other directories, so it is closed when
+        # none of them use it.
+        self._sharedFile = None
 
     def _validate(self):  # noqa
         """
@@ -223,24 +406,25 @@ class TiledTiffDirectory(object):
         # the create_image.py script, such as flatten or colourspace.  These
         # should only be done if necessary, which would require the conversion
         # job to check output and perform subsequent processing as needed.
+        decoded = self._tiffInfo.get('compression') in DecodedCompressions
         if (not self._tiffInfo.get('samplesperpixel') or
-                (self._tiffInfo.get('samplesperpixel') != 1 and
+                (not decoded and self._tiffInfo.get('samplesperpixel') != 1 and
                  self._tiffInfo.get('samplesperpixel') < 3)):
             raise ValidationTiffException(
                 'Only RGB and greyscale TIFF files are supported')
 
-        if (self._tiffInfo.get('bitspersample') != 8 and (
-                self._tiffInfo.get('compression') != libtiff_ctypes.COMPRESSION_NONE or
-                self._tiffInfo.get('bitspersample') != 16)):
-            raise ValidationTiffException(
-                'Only single-byte sampled TIFF files are supported')
-
         if self._tiffInfo.get('sampleformat') not in {
                 None,  # default is still SAMPLEFORMAT_UINT
-                libtiff_ctypes.SAMPLEFORMAT_UINT}:
+                libtiff_ctypes.SAMPLEFORMAT_UINT} and (
+                not decoded or self._tiffInfo.get('sampleformat') not in SampleFormatKinds):
             raise ValidationTiffException(
                 'Only unsigned int sampled TIFF files are supported')
 
+        if self._tiffInfo.get('bitspersample') != 8 and (
+                not decoded or self._sampleDtype() is None):
+            raise ValidationTiffException(
+                'Only single-byte sampled TIFF files are supported')
+
         if (self._tiffInfo.get('planarconfig') != libtiff_ctypes.PLANARCONFIG_CONTIG and
                 self._tiffInfo.get('photometric') not in {
                     libtiff_ctypes.PHOTOMETRIC_MINISBLACK}):
@@ -259,12 +443,12 @@ class TiledTiffDirectory(object):
             raise ValidationTiffException(
                 'Only top-left orientation TIFF files are supported')
 
-        if self._tiffInfo.get('compression') not in {
-                libtiff_ctypes.COMPRESSION_NONE,
+        if not decoded and self._tiffInfo.get('compression') not in {
                 libtiff_ctypes.COMPRESSION_JPEG,
                 33003, 33005}:
             raise ValidationTiffException(
-                'Only uncompressed and JPEG compressed TIFF files are supported')
+                'Only uncompressed, LZW, Deflate, and JPEG compressed TIFF files '
+                'are supported')
         if (not self._tiffInfo.get('istiled') or
                 not self._tiffInfo.get('tilewidth') or
                 not self._tiffInfo.get('tilelength')):
@@ -303,6 +487,15 @@ class TiledTiffDirectory(object):
                 value = getattr(self._tiffFile, func)()
                 if value:
                     info[func.lower()] = value
+        self._setMetadata(info)
+
+    def _setMetadata(self, info):
+        """
+        Store the tags of the directory and the image and pixel information
+        that is derived from them.
+
+        :param info: a dictionary of tag values, keyed by libtiff tag name.
+        """
         self._tiffInfo = info
         self._tileWidth = info.get('tilewidth')
         self._tileHeight = info.get('tilelength')
@@ -340,30 +533,29 @@ class TiledTiffDirectory(object):
         :rtype: bytes
         :raises: Exception
         """
-        # TIFFTAG_JPEGTABLES uses (uint32*, void**) output arguments
-        # http://www.remotesensing.org/libtiff/man/TIFFGetField.3tiff.html
-
-        tableSize = ctypes.c_uint32()
-        tableBuffer = ctypes.c_voidp()
-
-        # Some versions of pylibtiff set an explicit list of argtypes for
-        # TIFFGetField.  When this is done, we need to adjust them to match
-        # what is needed for our specific call.  Other versions do not set
-        # argtypes, allowing any types to be passed without validation, in
-        # which case we do not need to alter the list.
-        if libtiff_ctypes.libtiff.TIFFGetField.argtypes:
-            libtiff_ctypes.libtiff.TIFFGetField.argtypes = \
-                libtiff_ctypes.libtiff.TIFFGetField.argtypes[:2] + \
-                [ctypes.POINTER(ctypes.c_uint32), ctypes.POINTER(ctypes.c_void_p)]
-        if libtiff_ctypes.libtiff.TIFFGetField(
-                self._tiffFile,
-                libtiff_ctypes.TIFFTAG_JPEGTABLES,
-                ctypes.byref(tableSize),
-                ctypes.byref(tableBuffer)) != 1:
-            raise IOTiffException('Could not get JPEG Huffman / quantization tables')
-
-        tableSize = tableSize.value
-        tableBuffer = ctypes.cast(tableBuffer, ctypes.POINTER(ctypes.c_char))
+        # Tables from readTiffDirectories don't need libtiff
+        tableBuffer = self._tiffInfo.get('jpegtables')
+        if tableBuffer is not None:
+            tableSize = len(tableBuffer)
+        else:
+            # TIFFTAG_JPEGTABLES uses (uint32*, void**) output arguments
+            # http://www.remotesensing.org/libtiff/man/TIFFGetField.3tiff.html
+
+            tableSize = ctypes.c_uint32()
+            tableBuffer = ctypes.c_voidp()
+
+            with self._sharedFile.lock:
+                if _TIFFGetFieldPointer(
+                        self._tiffFile,
+                        libtiff_ctypes.TIFFTAG_JPEGTABLES,
+                        ctypes.byref(tableSize),
+                        ctypes.byref(tableBuffer)) != 1:
+                    raise IOTiffException('Could not get JPEG Huffman / quantization tables')
+
+                tableSize = tableSize.value
+                tableBuffer = ctypes.cast(tableBuffer, ctypes.POINTER(ctypes.c_char))
+                # Copy the tables before another directory can be read
+                tableBuffer = tableBuffer[:tableSize]
 
         if tableBuffer[:2] != b'\xff\xd8':
             raise IOTiffException(
@@ -390,20 +582,18 @@ class TiledTiffDirectory(object):
         :rtype int
         :raises: InvalidOperationTiffException
         """
-        # TIFFCheckTile and TIFFComputeTile require pixel coordinates
-        pixelX = int(x * self._tileWidth)
-        pixelY = int(y * self._tileHeight)
-
-        if pixelX >= self._imageWidth or pixelY >= self._imageHeight:
+        # This is the same as TIFFComputeTile for the first sample plane of a
+        # two-dimensional image.
+        tilesAcross = (self._imageWidth + self._tileWidth - 1) // self._tileWidth
+        x, y = int(x), int(y)
+        if (x < 0 or y < 0 or x >= tilesAcross or
+                y * self._tileHeight >= self._imageHeight):
             raise InvalidOperationTiffException(
                 'Tile x=%d, y=%d does not exist' % (x, y))
-        if libtiff_ctypes.libtiff.TIFFCheckTile(
-                self._tiffFile, pixelX, pixelY, 0, 0) == 0:
+        tileNum = y * tilesAcross + x
+        if tileNum >= len(self._tileOffsets):
             raise InvalidOperationTiffException(
                 'Tile x=%d, y=%d does not exist' % (x, y))
-
-        tileNum = libtiff_ctypes.libtiff.TIFFComputeTile(
-            self._tiffFile, pixelX, pixelY, 0, 0).value
         return tileNum
 
     @methodcache(key=partial(strhash, '_getTileByteCountsType'))
@@ -428,6 +618,86 @@ class TiledTiffDirectory(object):
             raise IOTiffException(
                 'Invalid type for TIFFTAG_TILEBYTECOUNTS: %s' % tileByteCountsLibtiffType)
 
+    def _loadTileArrays(self, tileArrays=None):
+        """
+        Read the file offsets and byte counts of all of the tiles in the
+        directory.  These are stored as the smallest unsigned numpy type that
+        holds them, so that tile lookups don't need to use libtiff.
+
+        :param tileArrays: if not None, a tuple of the offset and byte count
+            arrays from readTiffDirectories.  Otherwise, these are read
+            through libtiff.
+        :raises: ValidationTiffException
+        """
+        if tileArrays is None:
+            tileArrays = self._readTileArrays()
+        tilesAcross = (self._imageWidth + self._tileWidth - 1) // self._tileWidth
+        tilesDown = (self._imageHeight + self._tileHeight - 1) // self._tileHeight
+        arrays = []
+        for array in tileArrays:
+            if array is None or len(array) < tilesAcross * tilesDown:
+                raise ValidationTiffException('Missing raw tile offsets or sizes')
+            dtype = numpy.uint64
+            if not len(array) or int(array.max()) < 2 ** 32:
+                dtype = numpy.uint32
+            arrays.append(array.astype(dtype))
+        self._tileOffsets, self._tileByteCounts = arrays
+
+    def _readTileArrays(self):
+        """
+        Read the file offsets and byte counts of all of the tiles in the
+        directory through libtiff.
+
+        :return: a tuple of two numpy arrays of offsets and byte counts.
+        :raises: ValidationTiffException
+        """
+        # pylibtiff treats the output of TIFFTAG_TILEBYTECOUNTS as a scalar
+        # uint32; libtiff's documentation specifies that the output will be an
+        # array of uint32; in reality and per the TIFF spec, the output is an
+        # array of either uint64 or unit16, so we need to call the ctypes
+        # interface directly to get these tags
+        # http://www.awaresystems.be/imaging/tiff/tifftags/tilebytecounts.html
+        try:
+            rawType = self._getTileByteCountsType()
+        except IOTiffException as exc:
+            raise ValidationTiffException(exc.args[0])
+        totalTileCount = libtiff_ctypes.libtiff.TIFFNumberOfTiles(
+            self._tiffFile).value
+        arrays = []
+        for tag in (libtiff_ctypes.TIFFTAG_TILEOFFSETS,
+                    libtiff_ctypes.TIFFTAG_TILEBYTECOUNTS):
+            rawArray = ctypes.POINTER(rawType)()
+            if _TIFFGetFieldPointer(self._tiffFile, tag, ctypes.byref(rawArray)) != 1:
+                raise ValidationTiffException('Could not get raw tile offsets or sizes')
+            arrays.append(numpy.ctypeslib.as_array(rawArray, shape=(totalTileCount, )))
+        return tuple(arrays)
+
+    def _isTileSparse(self, tileNum):
+        """
+        Check if a tile has no data in the file.
+
+        :param tileNum: The internal tile number of the desired tile.
+        :type tileNum: int
+        :return: True if the tile is not stored in the file.
+        """
+        return not self._tileOffsets[tileNum] or not self._tileByteCounts[tileNum]
+
+    def getTileOffset(self, x, y):
+        """
+        Get the position in the file of the data of a tile.  This can be used
+        to read tiles in file order.
+
+        :param x: The column index of the desired tile.
+        :type x: int
+        :param y: The row index of the desired tile.
+        :type y: int
+        :return: the offset in bytes, or None if the tile doesn't exist.
+        """
+        try:
+            return int(self._tileOffsets[self._toTileNum(x, y)])
+        except (InvalidOperationTiffException, TypeError):
+            return None
+
     def _getJpegFrameSize(self, tileNum):
         """
         Get the file size in bytes of the raw encoded JPEG frame for a tile.
@@ -436,65 +706,50 @@ class TiledTiffDirectory(object):
         :type tileNum: int
         :return: The size in bytes of the raw tile data for the desired tile.
         :rtype: int
-        :raises: InvalidOperationTiffException or IOTiffException
+        :raises: InvalidOperationTiffException
         """
-        # TODO: is it worth it to memoize this?
-
-        # TODO: remove this check, for additional speed
-        totalTileCount = libtiff_ctypes.libtiff.TIFFNumberOfTiles(
-            self._tiffFile).value
-        if tileNum >= totalTileCount:
+        if tileNum >= len(self._tileByteCounts):
             raise InvalidOperationTiffException('Tile number out of range')
+        return int(self._tileByteCounts[tileNum])
 
-        # pylibtiff treats the output of TIFFTAG_TILEBYTECOUNTS as a scalar
-        # uint32; libtiff's documentation specifies that the output will be an
-        # array of uint32; in reality and per the TIFF spec, the output is an
-        # array of either uint64 or unit16, so we need to call the ctypes
-        # interface directly to get this tag
-        # http://www.awaresystems.be/imaging/tiff/tifftags/tilebytecounts.html
+    def _getSharedTile(self, tileNum):
+        """
+        Get the raw data of a tile from the shared file without libtiff.
 
-        rawTileSizesType = self._getTileByteCountsType()
-        rawTileSizes = ctypes.POINTER(rawTileSizesType)()
-
-        # Some versions of pylibtiff set an explicit list of argtypes for
-        # TIFFGetField.  When this is done, we need to adjust them to match
-        # what is needed for our specific call.  Other versions do not set
-        # argtypes, allowing any types to be passed without validation, in
-        # which case we do not need to alter the list.
-        if libtiff_ctypes.libtiff.TIFFGetField.argtypes:
-            libtiff_ctypes.libtiff.TIFFGetField.argtypes = \
-                libtiff_ctypes.libtiff.TIFFGetField.argtypes[:2] + \
-                [ctypes.POINTER(ctypes.POINTER(rawTileSizesType))]
-        if libtiff_ctypes.libtiff.TIFFGetField(
-                self._tiffFile,
-                libtiff_ctypes.TIFFTAG_TILEBYTECOUNTS,
-                ctypes.byref(rawTileSizes)) != 1:
-            raise IOTiffException('Could not get raw tile size')
-
-        # In practice, this will never overflow, and it's simpler to convert the
-        # long to an int
-        return int(rawTileSizes[tileNum])
+        :param tileNum: The internal tile number of the desired tile.
+        :type tileNum: int
+        :return: the raw tile data as a memoryview of the memory-mapped file
+            or as bytes, or None if the tile can't be read this way.
+        """
+        if tileNum >= len(self._tileOffsets):
+            return None
+        return self._sharedFile.read(
+            int(self._tileOffsets[tileNum]), int(self._tileByteCounts[tileNum]))
 
-    def _getJpegFrame(self, tileNum, entire=False):
+    def _readRawTile(self, tileNum):
         """
-        Get the raw encoded JPEG image frame from a tile.
+        Read the raw encoded data of a tile.  If the file is memory-mapped,
+        this is a view into the map.  It is read with libtiff only if it can't
+        be read from the shared file.
 
         :param tileNum: The internal tile number of the desired tile.
         :type tileNum: int
-        :param entire: True to return the entire frame.  False to strip off
-            container information.
-        :return: The JPEG image frame, including a JPEG Start Of Frame marker.
-        :rtype: bytes
+        :return: The raw tile data.
+        :rtype: memoryview or bytes
         :raises: InvalidOperationTiffException or IOTiffException
         """
+        frame = self._getSharedTile(tileNum)
+        if frame is not None:
+            return frame
         # This raises an InvalidOperationTiffException if the tile doesn't exist
         rawTileSize = self._getJpegFrameSize(tileNum)
 
         frameBuffer = ctypes.create_string_buffer(rawTileSize)
 
-        bytesRead = libtiff_ctypes.libtiff.TIFFReadRawTile(
-            self._tiffFile, tileNum,
-            frameBuffer, rawTileSize).value
+        with self._sharedFile.lock:
+            bytesRead = libtiff_ctypes.libtiff.TIFFReadRawTile(
+                self._tiffFile, tileNum,
+                frameBuffer, rawTileSize).value
         if bytesRead == -1:
             raise IOTiffException('Failed to read raw tile')
         elif bytesRead < rawTileSize:
@@ -503,57 +758,151 @@ class TiledTiffDirectory(object):
             # It's unlikely that this will ever occur, but incomplete reads will
             # be checked for by looking for the JPEG end marker
             raise IOTiffException('Buffer overflow when reading tile')
+        return frameBuffer.raw
+
+    def _getJpegFrame(self, tileNum, entire=False):
+        """
+        Get the raw encoded JPEG image frame from a tile.
+
+        :param tileNum: The internal tile number of the desired tile.
+        :type tileNum: int
+        :param entire: True to return the entire frame.  False to strip off
+            container information.
+        :return: The JPEG image frame, including a JPEG Start Of Frame marker.
+            This may be a view into a memory-mapped file.
+        :rtype: memoryview or bytes
+        :raises: InvalidOperationTiffException or IOTiffException
+        """
+        frame = self._readRawTile(tileNum)
         if entire:
-            return frameBuffer.raw[:]
+            return frame
 
-        if frameBuffer.raw[:2] != b'\xff\xd8':
+        if frame[:2] != b'\xff\xd8':
             raise IOTiffException('Missing JPEG Start Of Image marker in frame')
-        if frameBuffer.raw[-2:] != b'\xff\xd9':
+        if frame[-2:] != b'\xff\xd9':
             raise IOTiffException('Missing JPEG End Of Image marker in frame')
-        if frameBuffer.raw[2:4] in (b'\xff\xc0', b'\xff\xc2'):
+        if frame[2:4] in (b'\xff\xc0', b'\xff\xc2'):
             frameStartPos = 2
         else:
             # VIPS may encode TIFFs with the quantization (but not Huffman)
             # tables also at the start of every frame, so locate them for
             # removal
             # VIPS seems to prefer Baseline DCT, so search for that first
-            frameStartPos = frameBuffer.raw.find(b'\xff\xc0', 2, -2)
+            frame = bytes(frame)
+            frameStartPos = frame.find(b'\xff\xc0', 2, -2)
             if frameStartPos == -1:
-                frameStartPos = frameBuffer.raw.find(b'\xff\xc2', 2, -2)
+                frameStartPos = frame.find(b'\xff\xc2', 2, -2)
                 if frameStartPos == -1:
                     raise IOTiffException('Missing JPEG Start Of Frame marker')
 
         # Strip the Start / End Of Image markers
-        tileData = frameBuffer.raw[frameStartPos:-2]
+        tileData = frame[frameStartPos:-2]
         return tileData
 
+    def _sampleDtype(self):
+        """
+        Get the numpy data type of the samples of the directory.
+
+        :return: a numpy dtype in the native byte order, or None if the bit
+            depth and sample format aren't supported.
+        """
+        kind = SampleFormatKinds.get(
+            self._tiffInfo.get('sampleformat') or libtiff_ctypes.SAMPLEFORMAT_UINT)
+        bits = self._tiffInfo.get('bitspersample')
+        if kind is None or bits not in {8, 16, 32, 64} or (kind == 'f' and bits == 8):
+            return None
+        return numpy.dtype('%s%d' % (kind, bits // 8))
+
+    def _decodeTilePlane(self, tileNum, samples, dtype):
+        """
+        Decode the data of one tile in one sample plane.  Uncompressed and
+        Deflate compressed data is read from the shared file without libtiff;
+        other data is decoded by libtiff.
+
+        :param tileNum: The internal tile number of the tile and plane.
+        :param samples: the number of samples per pixel in the plane.
+        :param dtype: the native numpy data type of the samples.
+        :return: a numpy array with a shape of (tileHeight, tileWidth,
+            samples).
+        :raises: IOTiffException
+        """
+        shape = (self._tileHeight, self._tileWidth, samples)
+        count = shape[0] * shape[1] * shape[2]
+        compression = self._tiffInfo.get('compression')
+        predictor = self._tiffInfo.get('predictor') or libtiff_ctypes.PREDICTOR_NONE
+        data = None
+        if (compression != libtiff_ctypes.COMPRESSION_LZW and
+                predictor in {libtiff_ctypes.PREDICTOR_NONE,
+                              libtiff_ctypes.PREDICTOR_HORIZONTAL} and
+                self._tiffInfo.get('fillorder', 1) == libtiff_ctypes.FILLORDER_MSB2LSB):
+            data = self._getSharedTile(tileNum)
+        if data is not None:
+            if compression != libtiff_ctypes.COMPRESSION_NONE:
+                try:
+                    data = zlib.decompress(data)
+                except zlib.error:
+                    raise IOTiffException('Failed to decompress tile')
+            if len(data) < count * dtype.itemsize:
+                raise IOTiffException('Read an unexpected number of bytes from an encoded tile')
+            fileDtype = dtype.newbyteorder('S') if self._tiffInfo.get('isbyteswapped') else dtype
+            # This copies the data, so the tile doesn't refer to the file.
+            tile = numpy.frombuffer(data, dtype=fileDtype, count=count).reshape(shape).astype(dtype)
+            if predictor == libtiff_ctypes.PREDICTOR_HORIZONTAL:
+                # Each sample is stored as the difference from the sample to
+                # its left.
+                tile = numpy.cumsum(tile, axis=1, dtype=dtype)
+            return tile
+        # libtiff undoes predictors and returns samples in the native byte
+        # order.
+        with self._sharedFile.lock:
+            tileSize = libtiff_ctypes.libtiff.TIFFTileSize(self._tiffFile).value
+            imageBuffer = ctypes.create_string_buffer(tileSize)
+
+            readSize = libtiff_ctypes.libtiff.TIFFReadEncodedTile(
+                self._tiffFile, tileNum, imageBuffer, tileSize)
+        if readSize < tileSize or tileSize < count * dtype.itemsize:
+            raise IOTiffException('Read an unexpected number of bytes from an encoded tile')
+        return numpy.frombuffer(imageBuffer, dtype=dtype, count=count).reshape(shape)
+
     def _getUncompressedTile(self, tileNum):
         """
-        Get an uncompressed tile.
+        Get a tile that isn't JPEG or JPEG 2000 compressed at the full bit
+        depth of the file.
 
         :param tileNum: The internal tile number of the desired tile.
         :type tileNum: int
-        :return: the tile as a PIL 8-bit-per-channel images.
-        :rtype: PIL.Image
+        :return: the tile as a numpy array with a shape of (tileHeight,
+            tileWidth, samplesPerPixel) and a data type based on the bits per
+            sample and sample format of the file.  8-bit YCbCr tiles are
+            returned as PIL images.
+        :rtype: numpy.ndarray or PIL.Image
         :raises: IOTiffException
         """
-        tileSize = libtiff_ctypes.libtiff.TIFFTileSize(self._tiffFile).value
-        imageBuffer = ctypes.create_string_buffer(tileSize)
+        dtype = self._sampleDtype()
+        samples = self._tiffInfo.get('samplesperpixel')
+        if self._tiffInfo.get('planarconfig') == libtiff_ctypes.PLANARCONFIG_SEPARATE:
+            # Each sample is stored in its own set of tiles
+            tilesPerPlane = len(self._tileOffsets) // samples
+            tile = numpy.concatenate([
+                self._decodeTilePlane(tileNum + plane * tilesPerPlane, 1, dtype)
+                for plane in range(samples)], axis=2)
+        else:
+            tile = self._decodeTilePlane(tileNum, samples, dtype)
+        if (self._tiffInfo.get('photometric') == libtiff_ctypes.PHOTOMETRIC_YCBCR and
+                samples == 3 and dtype == numpy.uint8):
+            return PIL.Image.fromarray(tile, 'YCbCr')
+        return tile
 
-        readSize = libtiff_ctypes.libtiff.TIFFReadEncodedTile(
-            self._tiffFile, tileNum, imageBuffer, tileSize)
-        if readSize < tileSize:
-            raise IOTiffException('Read an unexpected number of bytes from an encoded tile')
-        if self._tiffInfo.get('samplesperpixel') == 1:
-            mode = 'L'
-        elif self._tiffInfo.get('samplesperpixel') == 3:
-            mode = ('YCbCr' if self._tiffInfo.get('photometric') ==
-                    libtiff_ctypes.PHOTOMETRIC_YCBCR else 'RGB')
-        if self._tiffInfo.get('bitspersample') == 16:
-            # Just take the high byte
-            imageBuffer = imageBuffer[1::2]
-        image = PIL.Image.frombytes(mode, (self._tileWidth, self._tileHeight), imageBuffer)
-        return image
+    def readImage(self):
+        """
+        Read the entire image of the directory with libtiff.  This is intended
+        for small, non-tiled images.
+
+        :return: the image as a numpy array.
+        :raises: IOTiffException
+        """
+        with self._sharedFile.lock:
+            return self._tiffFile.read_image()
 
     @property
     def tileWidth(self):
@@ -595,31 +944,30 @@ class TiledTiffDirectory(object):
         :type x: int
         :param y: The row index of the desired tile.
         :type y: int
-        :return: either a buffer with a JPEG or a PIL image.
-        :rtype: bytes
+        :return: either a buffer with a JPEG, a PIL image, or a numpy array
+            with the full bit depth of the file.
+        :rtype: bytes, PIL.Image, or numpy.ndarray
         :raises: InvalidOperationTiffException or IOTiffException
         """
         # This raises an InvalidOperationTiffException if the tile doesn't exist
         tileNum = self._toTileNum(x, y)
-
-        imageBuffer = six.BytesIO()
+        if self._isTileSparse(tileNum):
+            raise IOTiffException('Tile x=%d, y=%d is not stored in the file' % (x, y))
 
         if self._tiffInfo.get('compression') == libtiff_ctypes.COMPRESSION_JPEG:
+            # The frame may be a view into a memory-mapped file; this is the
+            # only copy of it that is made.
             if not getattr(self, '_completeJpeg', False):
-                # Write JPEG Start Of Image marker
-                imageBuffer.write(b'\xff\xd8')
-                imageBuffer.write(self._getJpegTables())
-                imageBuffer.write(self._getJpegFrame(tileNum))
-                # Write JPEG End Of Image marker
-                imageBuffer.write(b'\xff\xd9')
-            else:
-                imageBuffer.write(self._getJpegFrame(tileNum, True))
-            return imageBuffer.getvalue()
+                # Add JPEG Start Of Image and End Of Image markers
+                return b''.join([
+                    b'\xff\xd8', self._getJpegTables(), self._getJpegFrame(tileNum),
+                    b'\xff\xd9'])
+            return bytes(self._getJpegFrame(tileNum, True))
 
         if self._tiffInfo.get('compression') in (33003, 33005):
             # Get the whole frame, which is JPEG 2000 format, and convert it to
             # a PIL image
-            imageBuffer.write(self._getJpegFrame(tileNum, True))
+            imageBuffer = six.BytesIO(self._getJpegFrame(tileNum, True))
             image = PIL.Image.open(imageBuffer)
             # Converting the image mode ensures that it gets loaded once and is
             # in a form we expect.  IF this isn't done, then PIL can load the
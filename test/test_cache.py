@@ -1,14 +1,24 @@
 # -*- coding: utf-8 -*-
 
 import cachetools
+import multiprocessing
+import numpy
+import os
+import PIL.Image
 import pytest
 import six
 import threading
+import time
 
 import large_image.cache_util.cache
+import large_image.cache_util.diskcache
+import large_image.cache_util.shmcache
+import large_image_source_test
 from large_image import config
-from large_image.cache_util import cached, strhash, Cache, MemCache, \
-    methodcache, LruCacheMetaclass, cachesInfo, cachesClear, getTileCache
+from large_image.cache_util.cachefactory import estimateSize
+from large_image.cache_util import cached, strhash, Cache, MemCache, SharedMemCache, DiskCache, \
+    LayeredCache, CacheProperties, cachesStatsReset, methodStatsInfo, getCacheStats, \
+    methodcache, methodcacheMany, LruCacheMetaclass, cachesInfo, cachesClear, getTileCache
 
 
 class Fib(object):
@@ -48,6 +58,14 @@ def testCheckCacheMemcached():
     assert val == 354224848179261915075
 
 
+def testMemcachedGetSetMany():
+    cache = MemCache()
+    cache.setMany({'many1': 1, 'many2': 'two'})
+    assert cache['many1'] == 1
+    assert cache.getMany(['many1', 'many2', 'many3']) == {'many1': 1, 'many2': 'two'}
+    assert cache.getMany([]) == {}
+
+
 def testBadMemcachedUrl():
     # go though and check if all 100 fib numbers are in cache
     # it is stored in cache as ('fib', #)
@@ -56,6 +74,8 @@ def testBadMemcachedUrl():
     cache_test(cache, 3)
     with pytest.raises(KeyError):
         cache['(2,)']
+    cache.setMany({'(2,)': 1})
+    assert cache.getMany(['(2,)']) == {}
 
 
 def testGetTileCachePython():
@@ -66,6 +86,307 @@ def testGetTileCachePython():
     assert isinstance(tileCache, cachetools.LRUCache)
 
 
+def testTileCacheByteSize():
+    large_image.cache_util.cache._tileCache = None
+    large_image.cache_util.cache._tileLock = None
+    config.setConfig('cache_backend', 'python')
+    config.setConfig('cache_python_memory_size', 1024 ** 2)
+    try:
+        tileCache, tileLock = getTileCache()
+        assert tileCache.maxsize == 1024 ** 2
+        for idx in range(4):
+            tileCache[idx] = b'\0' * 300000
+        assert len(tileCache) == 3
+        assert 900000 < tileCache.currsize <= 1024 ** 2
+        info = cachesInfo()['tileCache']
+        assert info['used'] == tileCache.currsize
+        assert info['items'] == 3
+        # A 512x512 RGBA image uses more than 1 MB
+        with pytest.raises(ValueError):
+            tileCache['image'] = PIL.Image.new('RGBA', (512, 512))
+        tileCache['image'] = PIL.Image.new('L', (512, 512))
+        assert 'image' in tileCache
+        assert len(tileCache) == 3
+        assert tileCache.currsize <= 1024 ** 2
+    finally:
+        config.setConfig('cache_python_memory_size', None)
+        large_image.cache_util.cache._tileCache = None
+        large_image.cache_util.cache._tileLock = None
+
+
+def testEstimateSize():
+    assert 1000 < estimateSize(b'\0' * 1000) < 1100
+    assert 256 * 256 * 4 < estimateSize(PIL.Image.new('RGB', (256, 256))) < 256 * 256 * 4 + 1000
+    assert 256 * 256 * 2 < estimateSize(PIL.Image.new('I;16', (256, 256))) < 256 * 256 * 2 + 1000
+    data = numpy.zeros((256, 256, 3), dtype=numpy.uint16)
+    assert 256 * 256 * 6 < estimateSize(data) < 256 * 256 * 6 + 1000
+    assert 256 * 256 * 2 < estimateSize(data[:, :, 0]) < 256 * 256 * 2 + 1000
+    assert estimateSize((b'\0' * 1000, data)) > 256 * 256 * 6 + 1000
+
+
+def testSharedMemCache(tmpdir):
+    path = str(tmpdir.join('cache'))
+    cache = SharedMemCache(path, 1024 ** 2, sizeClasses=[1024, 16384])
+    cache_test(cache)
+    assert cache['(100,)'] == 354224848179261915075
+    assert len(cache) == 100
+    cache['image'] = PIL.Image.new('L', (100, 100), 12)
+    assert cache['image'].getpixel((5, 5)) == 12
+    assert len(cache) == 101
+    used = cache.currsize
+    cache['image'] = b'\0' * 2000
+    assert cache['image'] == b'\0' * 2000
+    assert len(cache) == 101
+    assert cache.currsize < used
+    del cache['image']
+    assert 'image' not in cache
+    with pytest.raises(KeyError):
+        cache['image']
+    with pytest.raises(ValueError):
+        cache['image'] = b'\0' * 20000
+    cache.setMany({'many1': 1, 'many2': b'\0' * 20000, 'many3': [3]})
+    assert cache.getMany(['many1', 'many2', 'many3']) == {'many1': 1, 'many3': [3]}
+    # Another instance uses the same data and layout
+    other = SharedMemCache(path, 1024)
+    assert other.maxsize == cache.maxsize
+    # and excludes this one within the process
+    assert other._threadLock is cache._threadLock
+    assert other['(50,)'] == 12586269025
+    other.clear()
+    assert len(cache) == 0
+    with pytest.raises(KeyError):
+        cache['(50,)']
+
+
+def testSharedMemCacheIncompatible(tmpdir):
+    path = str(tmpdir.join('cache'))
+    with open(path, 'wb') as fptr:
+        fptr.write(b'not a cache' * 1000)
+    with pytest.raises(ValueError):
+        SharedMemCache(path)
+    # The file isn't changed
+    with open(path, 'rb') as fptr:
+        assert fptr.read() == b'not a cache' * 1000
+
+
+def testSharedMemCacheUnsafeFile(tmpdir):
+    path = str(tmpdir.join('cache'))
+    SharedMemCache(path, 1024 ** 2)
+    # Links aren't followed
+    link = str(tmpdir.join('link'))
+    os.symlink(path, link)
+    with pytest.raises(OSError):
+        SharedMemCache(link)
+    # Files others can access aren't used
+    os.chmod(path, 0o660)
+    with pytest.raises(ValueError):
+        SharedMemCache(path)
+    assert str(os.getuid()) in large_image.cache_util.shmcache.defaultSharedCachePath()
+
+
+def testSharedMemCacheEviction(tmpdir):
+    cache = SharedMemCache(str(tmpdir.join('cache')), 256 * 1024, sizeClasses=[1024])
+    assert cache.maxsize <= 256 * 1024
+    for idx in range(1000):
+        cache[str(idx)] = b'\1' * 500
+    assert len(cache) <= cache.maxsize // 1024
+    assert cache.currsize <= cache.maxsize
+    # Recently set values are still present
+    assert cache['999'] == b'\1' * 500
+
+
+def _setSharedValue(path):
+    SharedMemCache(path)['fromchild'] = 'value'
+
+
+def testSharedMemCacheProcesses(tmpdir):
+    path = str(tmpdir.join('cache'))
+    cache = SharedMemCache(path, 1024 ** 2)
+    process = multiprocessing.Process(target=_setSharedValue, args=(path, ))
+    process.start()
+    process.join()
+    assert cache['fromchild'] == 'value'
+
+
+def testGetTileCacheShared(tmpdir):
+    large_image.cache_util.cache._tileCache = None
+    large_image.cache_util.cache._tileLock = None
+    config.setConfig('cache_backend', 'shared')
+    config.setConfig('cache_shared_path', str(tmpdir.join('cache')))
+    try:
+        tileCache, tileLock = getTileCache()
+        assert isinstance(tileCache, SharedMemCache)
+        assert 'tileCache' in cachesInfo()
+        # An incompatible file falls back to the python cache
+        large_image.cache_util.cache._tileCache = None
+        large_image.cache_util.cache._tileLock = None
+        with open(str(tmpdir.join('other')), 'wb') as fptr:
+            fptr.write(b'\1' * 8192)
+        config.setConfig('cache_shared_path', str(tmpdir.join('other')))
+        tileCache, tileLock = getTileCache()
+        assert not isinstance(tileCache, SharedMemCache)
+    finally:
+        config.setConfig('cache_backend', 'python')
+        config.setConfig('cache_shared_path', None)
+        large_image.cache_util.cache._tileCache = None
+        large_image.cache_util.cache._tileLock = None
+
+
+def testDiskCache(tmpdir):
+    path = str(tmpdir.join('cache'))
+    cache = DiskCache(path, 1024 ** 2)
+    cache_test(cache)
+    assert cache['(100,)'] == 354224848179261915075
+    assert len(cache) == 100
+    cache['image'] = PIL.Image.new('L', (100, 100), 12)
+    assert cache['image'].getpixel((5, 5)) == 12
+    assert 'image' in cache
+    del cache['image']
+    assert 'image' not in cache
+    with pytest.raises(KeyError):
+        cache['image']
+    with pytest.raises(ValueError):
+        cache['image'] = b'\0' * 1024 ** 2
+    # The values persist
+    cache._waitForScan()
+    other = DiskCache(path, 1024 ** 2)
+    other._waitForScan()
+    assert len(other) == 100
+    assert other.currsize == cache.currsize
+    assert other['(50,)'] == 12586269025
+    other.clear()
+    assert len(other) == 0
+    with pytest.raises(KeyError):
+        cache['(50,)']
+
+
+def testDiskCacheUnsafeDirectory(tmpdir):
+    path = str(tmpdir.join('cache'))
+    DiskCache(path)
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    # Links aren't followed
+    link = str(tmpdir.join('link'))
+    os.symlink(path, link)
+    with pytest.raises(ValueError):
+        DiskCache(link)
+    # Directories others can write to aren't used
+    os.chmod(path, 0o777)
+    with pytest.raises(ValueError):
+        DiskCache(path)
+    assert str(os.getuid()) in large_image.cache_util.diskcache.defaultDiskCachePath()
+
+
+def testDiskCacheEviction(tmpdir):
+    cache = DiskCache(str(tmpdir.join('cache')), 100000)
+    for idx in range(12):
+        cache[str(idx)] = b'\1' * 9000
+        time.sleep(0.01)
+        if idx == 5:
+            # Reading a value makes it recently used
+            assert cache['0'] == b'\1' * 9000
+            time.sleep(0.01)
+    # Eviction is done in the background
+    cache._waitForScan()
+    assert cache.currsize <= 100000
+    assert len(cache) < 12
+    assert '0' in cache
+    assert '1' not in cache
+    assert '11' in cache
+
+
+def testDiskCacheProcesses(tmpdir):
+    # Each instance only knows about its own writes until it rescans the
+    # directory, so separate instances stand in for separate processes.
+    path = str(tmpdir.join('cache'))
+    caches = [DiskCache(path, 100000), DiskCache(path, 100000)]
+    for cache in caches:
+        cache._waitForScan()
+    for idx in range(12):
+        caches[idx % 2][str(idx)] = b'\1' * 9000
+    for cache in caches:
+        cache._waitForScan()
+        assert len(cache) == 6
+    # Rescanning finds the files written by the other instance and evicts
+    caches[0].scanInterval = 0
+    caches[0]['12'] = b'\1' * 9000
+    caches[0]._waitForScan()
+    assert caches[0].currsize <= 100000
+    assert len(caches[0]) < 13
+
+
+def testGetTileCacheDisk(tmpdir):
+    large_image.cache_util.cache._tileCache = None
+    large_image.cache_util.cache._tileLock = None
+    config.setConfig('cache_backend', 'disk')
+    config.setConfig('cache_disk_path', str(tmpdir.join('cache')))
+    try:
+        tileCache, tileLock = getTileCache()
+        assert isinstance(tileCache, DiskCache)
+        assert 'tileCache' in cachesInfo()
+    finally:
+        config.setConfig('cache_backend', 'python')
+        config.setConfig('cache_disk_path', None)
+        large_image.cache_util.cache._tileCache = None
+        large_image.cache_util.cache._tileLock = None
+
+
+def testLayeredCache(tmpdir):
+    l2 = DiskCache(str(tmpdir.join('cache')))
+    l2['(2,)'] = 1
+    cache = LayeredCache(cachetools.LRUCache(100000, getsizeof=estimateSize), l2)
+    assert cache['(2,)'] == 1
+    assert cache.stats == {'l1': {'hits': 0, 'misses': 1}, 'l2': {'hits': 1, 'misses': 0}}
+    assert cache['(2,)'] == 1
+    assert cache.stats['l1']['hits'] == 1
+    cache_test(cache)
+    assert cache['(100,)'] == 354224848179261915075
+    assert len(l2) == 100
+    cache.clear()
+    assert len(cache) == 0
+    assert cache['(100,)'] == 354224848179261915075
+    # Values too large for the L1 cache are still stored in the L2 cache
+    cache['large'] = b'\0' * 200000
+    assert 'large' not in cache.l1
+    assert cache['large'] == b'\0' * 200000
+    stats = {'l1': dict(cache.stats['l1']), 'l2': dict(cache.stats['l2'])}
+    cache.setMany({'many1': b'1', 'many2': b'2'})
+    cache.l1.clear()
+    assert cache.getMany(['many1', 'many2', 'many3']) == {'many1': b'1', 'many2': b'2'}
+    assert cache.getMany(['many1', 'many2']) == {'many1': b'1', 'many2': b'2'}
+    assert cache.stats['l1']['hits'] == stats['l1']['hits'] + 2
+    assert cache.stats['l1']['misses'] == stats['l1']['misses'] + 3
+    assert cache.stats['l2']['hits'] == stats['l2']['hits'] + 2
+    assert cache.stats['l2']['misses'] == stats['l2']['misses'] + 1
+
+
+def testGetTileCacheLayered(tmpdir):
+    large_image.cache_util.cache._tileCache = None
+    large_image.cache_util.cache._tileLock = None
+    config.setConfig('cache_backend', 'disk')
+    config.setConfig('cache_disk_path', str(tmpdir.join('cache')))
+    config.setConfig('cache_l1_size', 1024 ** 2)
+    try:
+        tileCache, tileLock = getTileCache()
+        assert isinstance(tileCache, LayeredCache)
+        assert isinstance(tileCache.l2, DiskCache)
+        tileCache['key'] = 'value'
+        info = cachesInfo()['tileCache']
+        assert info['maxsize'] == 1024 ** 2
+        assert info['items'] == 1
+        assert info['tiers']['l2']['items'] == 1
+        cachesClear()
+        assert tileCache['key'] == 'value'
+        info = cachesInfo()['tileCache']
+        assert info['tiers']['l1']['misses'] == 1
+        assert info['tiers']['l2']['hits'] == 1
+    finally:
+        config.setConfig('cache_backend', 'python')
+        config.setConfig('cache_disk_path', None)
+        config.setConfig('cache_l1_size', 0)
+        large_image.cache_util.cache._tileCache = None
+        large_image.cache_util.cache._tileLock = None
+
+
 def testGetTileCacheMemcached():
     large_image.cache_util.cache._tileCache = None
     large_image.cache_util.cache._tileLock = None
@@ -123,6 +444,118 @@ class TestClass(object):
         for sum in sums:
             assert sum == loopSize * (loopSize - 1) / 2 + loopSize * sumDelta
 
+    def testMethodcacheMany(self):
+        class ManyCache(cachetools.LRUCache):
+            requests = 0
+
+            def getMany(self, keys):
+                self.requests += 1
+                return {k: self[k] for k in keys if k in self}
+
+            def setMany(self, items):
+                self.requests += 1
+                self.update(items)
+
+        calls = []
+
+        @methodcache()
+        def add(self, x, delta=1):
+            calls.append(x)
+            return x + delta
+
+        self.wrapKey = strhash
+        self.cache_lock = threading.Lock()
+        for cache in (cachetools.LRUCache(10), ManyCache(10)):
+            self.cache = cache
+            calls[:] = []
+            assert add(self, 3) == 4
+            args = [((x, ), {}) for x in (1, 2, 3, 2)] + [((1, ), {'delta': 5})]
+            results = methodcacheMany(self, add, args, order=lambda idx: idx[::-1])
+            assert results == [2, 3, 4, 3, 6]
+            assert calls == [3, 1, 2, 1]
+            assert methodcacheMany(self, add, args) == results
+            assert len(calls) == 4
+        assert cache.requests == 3
+
+    def testMethodcacheRefusedBytes(self):
+        # Values the cache refuses aren't counted as stored bytes
+        self.cache = cachetools.LRUCache(10, getsizeof=len)
+        self.cache_lock = threading.Lock()
+        self.wrapKey = strhash
+
+        @methodcache()
+        def make(self, size):
+            return b'\0' * size
+
+        cachesStatsReset()
+        make(self, 100)
+        methodcacheMany(self, make, [((200, ), {}), ((5, ), {})])
+        stats = getCacheStats(self.cache).info()
+        assert stats['misses'] == 3
+        assert stats['bytes'] == estimateSize(b'\0' * 5)
+
+    def testMethodcacheSingleFlight(self):
+        self.cache = cachetools.LRUCache(10)
+        self.cache_lock = threading.Lock()
+        self.wrapKey = strhash
+        calls = []
+        started = threading.Event()
+
+        @methodcache()
+        def slow(self, x):
+            calls.append(x)
+            started.set()
+            time.sleep(0.1)
+            if x < 0:
+                raise ValueError('negative')
+            return x * 2
+
+        results = []
+
+        def call(x):
+            try:
+                results.append(slow(self, x))
+            except ValueError:
+                results.append(None)
+
+        threadList = [threading.Thread(target=call, args=(3, ))]
+        threadList[0].start()
+        started.wait()
+        threadList += [threading.Thread(target=call, args=(3, )) for t in range(5)]
+        threadList.append(threading.Thread(target=call, args=(4, )))
+        for t in threadList[1:]:
+            t.start()
+        for t in threadList:
+            t.join()
+        assert sorted(calls) == [3, 4]
+        assert sorted(results) == [6] * 6 + [8]
+        # Failures aren't shared; each caller tries again
+        calls[:] = []
+        results[:] = []
+        threadList = [threading.Thread(target=call, args=(-1, )) for t in range(3)]
+        for t in threadList:
+            t.start()
+        for t in threadList:
+            t.join()
+        assert calls == [-1] * 3
+        assert results == [None] * 3
+
+    def testMethodcacheReentrant(self):
+        self.cache = cachetools.LRUCache(10)
+        self.cache_lock = threading.Lock()
+        self.wrapKey = strhash
+
+        @methodcache()
+        def inner(self, x):
+            return x * 2
+
+        @methodcache()
+        def outer(self, x):
+            # A subclass method calling its parent with the same key
+            return inner(self, x) + 1
+
+        assert outer(self, 3) == 7
+
     @six.add_metaclass(LruCacheMetaclass)
     class ExampleWithMetaclass(object):
         cacheName = 'test'
@@ -131,6 +564,64 @@ class TestClass(object):
         def __init__(self, arg):
             pass
 
+    def testMetaclassFileHandles(self, monkeypatch):
+        monkeypatch.setitem(CacheProperties, 'testhandles', {
+            'itemExpectedSize': 1, 'maxItems': 2, 'itemFileHandles': 4})
+
+        @six.add_metaclass(LruCacheMetaclass)
+        class ManyHandles(object):
+            cacheName = 'testhandles'
+
+            def __init__(self, arg):
+                pass
+
+        class FewHandles(ManyHandles):
+            cacheName = 'testhandles'
+            cacheFileHandles = 1
+
+        cache = LruCacheMetaclass.classCaches[ManyHandles][0]
+        try:
+            # Sources that use fewer file handles can be cached in greater
+            # numbers
+            for idx in range(8):
+                FewHandles(idx)
+            assert len(cache) == 8
+            for idx in range(3):
+                ManyHandles(idx)
+            assert len(cache) == 2
+            info = cachesInfo()['testhandles']
+            assert info['used'] == 2
+            assert info['maxFileHandles'] == 8
+            assert info['fileHandles'] == 8
+        finally:
+            del LruCacheMetaclass.namedCaches['testhandles']
+
+    def testMetaclassFileHandlesItemLimit(self, monkeypatch):
+        # The number of items is still limited separately
+        monkeypatch.setitem(CacheProperties, 'testhandles', {
+            'maxItems': 2, 'itemFileHandles': 4})
+
+        @six.add_metaclass(LruCacheMetaclass)
+        class FewHandles(object):
+            cacheName = 'testhandles'
+            cacheMaxSize = 3
+            cacheFileHandles = 1
+
+            def __init__(self, arg):
+                pass
+
+        cache = LruCacheMetaclass.classCaches[FewHandles][0]
+        try:
+            for idx in range(8):
+                FewHandles(idx)
+            assert len(cache) == 3
+            info = cachesInfo()['testhandles']
+            assert info['maxsize'] == 3
+            assert info['used'] == 3
+            assert info['fileHandles'] == 3
+        finally:
+            del LruCacheMetaclass.namedCaches['testhandles']
+
     def testCachesInfo(self):
         large_image.cache_util.cache._tileCache = None
         large_image.cache_util.cache._tileLock = None
@@ -145,8 +636,75 @@ class TestClass(object):
         large_image.cache_util.cache._tileLock = None
         config.setConfig('cache_backend', 'memcached')
         getTileCache()
-        # memcached won't show that it is present
-        assert 'tileCache' not in cachesInfo()
+        # memcached won't show its size, but does have statistics
+        assert 'maxsize' not in cachesInfo()['tileCache']
+        assert 'stats' in cachesInfo()['tileCache']
+
+    def testCachesStats(self):
+        large_image.cache_util.cache._tileCache = None
+        large_image.cache_util.cache._tileLock = None
+        config.setConfig('cache_backend', 'python')
+        cachesClear()
+        cachesStatsReset()
+        self.ExampleWithMetaclass('test')
+        self.ExampleWithMetaclass('test')
+        self.ExampleWithMetaclass('other')
+        stats = cachesInfo()['test']['stats']
+        assert stats['hits'] == 1
+        assert stats['misses'] == 2
+        assert stats['evictions'] == 0
+        for idx in range(4):
+            self.ExampleWithMetaclass(idx)
+        assert cachesInfo()['test']['stats']['evictions'] == 2
+
+        source = large_image_source_test.TestTileSource(tileWidth=128, tileHeight=128)
+        source.getTile(0, 0, 0)
+        source.getTile(0, 0, 0)
+        source.getTiles([(0, 0, 0), (0, 0, 1)])
+        info = cachesInfo()
+        stats = info['tileCache']['stats']
+        assert stats['hits'] == 2
+        assert stats['misses'] == 2
+        assert stats['bytes'] > 0
+        assert stats['computeTime'] > 0
+        assert stats['lockTime'] >= 0
+        assert methodStatsInfo()['large_image_source_test.TestTileSource.getTile'] == stats
+        cachesStatsReset()
+        info = cachesInfo()
+        assert info['tileCache']['stats']['hits'] == 0
+        assert methodStatsInfo() == {}
+        cachesClear()
+
+    @six.add_metaclass(LruCacheMetaclass)
+    class SlowExampleWithMetaclass(object):
+        cacheName = 'slowtest'
+        cacheMaxSize = 4
+        instances = []
+
+        def __init__(self, arg):
+            time.sleep(0.2)
+            self.instances.append(arg)
+
+    def testMetaclassSingleFlight(self):
+        results = []
+
+        def create(arg):
+            results.append(self.SlowExampleWithMetaclass(arg))
+
+        threadList = [threading.Thread(target=create, args=(arg, ))
+                      for arg in ('a', 'a', 'a', 'b', 'b')]
+        start = time.time()
+        for t in threadList:
+            t.start()
+        for t in threadList:
+            t.join()
+        # Different sources are opened concurrently
+        assert time.time() - start < 0.35
+        assert sorted(self.SlowExampleWithMetaclass.instances) == ['a', 'b']
+        assert len(set(id(result) for result in results)) == 2
+        stats = cachesInfo()['slowtest']['stats']
+        assert stats['misses'] == 2
+        assert stats['coalesced'] == 3
 
     def testCachesClear(self):
         large_image.cache_util.cache._tileCache = None
@@ -88,6 +88,21 @@ class LargeImageCachedTilesTest(object):
         utilities.checkTilesZXY(source, meta, params, utilities.PNGHeader)
         assert large_image_source_test._counters['tiles'] == counter3
 
+    def testGetTiles(self, monitorTileCounts):
+        source = monitorTileCounts(None, encoding='PNG', tileWidth=160, tileHeight=120)
+        tiles = [(1, 2, 3), (0, 0, 3), (1, 2, 3), (4, 5, 4)]
+        results = source.getTiles(tiles)
+        # The repeated tile is only read once
+        assert large_image_source_test._counters['tiles'] == 3
+        for tile, result in zip(tiles, results):
+            assert result == source.getTile(*tile)
+        assert large_image_source_test._counters['tiles'] == 3
+        # Only tiles that aren't cached are read
+        results = source.getTiles([(0, 0, 3), (3, 3, 3)])
+        assert large_image_source_test._counters['tiles'] == 4
+        assert results[1] == source.getTile(3, 3, 3)
+        assert source.getTiles([]) == []
+
     def testLargeRegion(self):
         imagePath = utilities.externaldata(
             'data/sample_jp2k_33003_TCGA-CV-7242-11A-01-TS1.1838afb1-9eee-'
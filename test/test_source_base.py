@@ -1,6 +1,17 @@
 # -*- coding: utf-8 -*-
 
-from large_image.tilesource import nearPowerOfTwo
+import numpy
+import PIL.Image
+import pytest
+import threading
+from six import BytesIO
+
+import large_image_source_test
+
+from large_image import config
+from large_image.constants import TILE_FORMAT_IMAGE, TILE_FORMAT_NUMPY, TILE_FORMAT_PIL
+from large_image.tilesource import base, nearPowerOfTwo
+from large_image.tilesource.base import _cropJpeg
 
 
 def testNearPowerOfTwo():
@@ -11,3 +22,108 @@ def testNearPowerOfTwo():
     assert not nearPowerOfTwo(45808, 11400, 0.005)
     assert nearPowerOfTwo(45808, 11500)
     assert not nearPowerOfTwo(45808, 11500, 0.005)
+
+
+def testGetRegionThreaded():
+    source = large_image_source_test.TestTileSource(
+        None, tileWidth=160, tileHeight=120, sizeX=2000, sizeY=1500)
+    params = {
+        'region': {'left': 100, 'top': 50, 'width': 1500, 'height': 1100},
+        'output': {'maxWidth': 800},
+        'format': TILE_FORMAT_NUMPY,
+    }
+    serial, _ = source.getRegion(**params)
+    try:
+        config.setConfig('region_threads', 4)
+        threaded, _ = source.getRegion(**params)
+    finally:
+        config.setConfig('region_threads', 0)
+    assert threaded.shape == serial.shape
+    assert (threaded == serial).all()
+
+
+def testRegionPoolResize():
+    try:
+        config.setConfig('region_threads', 4)
+        pool = base._getRegionPool()
+        assert base._getRegionPool() is pool
+        threadCount = threading.active_count()
+        config.setConfig('region_threads', 2)
+        assert base._getRegionPool() is not pool
+        # The old pool's threads have all exited
+        assert threading.active_count() == threadCount - 2
+    finally:
+        config.setConfig('region_threads', 0)
+
+
+@pytest.mark.parametrize('params', [
+    {'region': {'left': 100, 'top': 50, 'width': 1500, 'height': 1100}},
+    {'region': {'left': 100, 'top': 50, 'width': 1500, 'height': 1100},
+     'output': {'maxWidth': 800}},
+    {'output': {'maxWidth': 400, 'maxHeight': 400}, 'fill': '#FF0000'},
+    {'region': {'left': 1990, 'top': 1490}, 'encoding': 'PNG'},
+])
+def testGetRegionNumpy(params):
+    source = large_image_source_test.TestTileSource(
+        None, tileWidth=160, tileHeight=120, sizeX=2000, sizeY=1500)
+    image, imageFormat = source.getRegion(format=TILE_FORMAT_NUMPY, **params)
+    assert imageFormat == TILE_FORMAT_NUMPY
+    pilImage, _ = source.getRegion(format=TILE_FORMAT_PIL, **params)
+    assert image.shape == numpy.asarray(pilImage).shape
+    assert (image == numpy.asarray(pilImage)).all()
+
+
+@pytest.mark.parametrize('subsampling,width,height,cropped', [
+    (0, 256, 256, True),
+    (0, 256, 100, True),
+    (0, 250, 256, True),
+    (0, 100, 256, False),
+    (2, 250, 97, True),
+    (2, 248, 256, True),
+    (2, 240, 256, False),
+])
+def testCropJpeg(subsampling, width, height, cropped):
+    image = PIL.Image.fromarray(
+        (numpy.random.RandomState(0).rand(256, 256, 3) * 255).astype(numpy.uint8))
+    output = BytesIO()
+    image.save(output, 'JPEG', quality=90, subsampling=subsampling)
+    data = output.getvalue()
+    result = _cropJpeg(data, width, height)
+    if not cropped:
+        assert result is None
+        return
+    assert len(result) == len(data)
+    croppedImage = PIL.Image.open(BytesIO(result))
+    assert croppedImage.size == (width, height)
+    if not subsampling:
+        # Without chroma subsampling, the pixels are exactly those of the
+        # original image.
+        original = numpy.asarray(PIL.Image.open(BytesIO(data)))
+        assert (numpy.asarray(croppedImage) == original[:height, :width]).all()
+    output = BytesIO()
+    image.save(output, 'JPEG', progressive=True)
+    assert _cropJpeg(output.getvalue(), width, height) is None
+
+
+def testGetRegionJpegPassthrough():
+    source = large_image_source_test.TestTileSource(
+        None, tileWidth=256, tileHeight=256, sizeX=2000, sizeY=1500, encoding='JPEG')
+    level = source.levels - 1
+    tile = source.getTile(2, 1, level)
+    region, mimeType = source.getRegion(
+        format=TILE_FORMAT_IMAGE, region={'left': 512, 'top': 256, 'width': 256, 'height': 256})
+    assert mimeType == 'image/jpeg'
+    assert region == tile
+    # A bottom edge tile is cropped without reencoding it
+    region, mimeType = source.getRegion(
+        format=TILE_FORMAT_IMAGE, region={'left': 512, 'top': 1280, 'width': 256, 'height': 256})
+    assert len(region) == len(source.getTile(2, 5, level))
+    assert PIL.Image.open(BytesIO(region)).size == (256, 220)
+    # Different JPEG options or regions that span tiles are reencoded
+    region, mimeType = source.getRegion(
+        format=TILE_FORMAT_IMAGE, jpegQuality=80,
+        region={'left': 512, 'top': 256, 'width': 256, 'height': 256})
+    assert region != tile
+    region, mimeType = source.getRegion(
+        format=TILE_FORMAT_IMAGE, region={'left': 500, 'top': 256, 'width': 256, 'height': 256})
+    assert PIL.Image.open(BytesIO(region)).size == (256, 256)
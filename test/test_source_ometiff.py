@@ -1,10 +1,37 @@
 # -*- coding: utf-8 -*-
 
+import gc
+import numpy
+import pytest
+import threading
+import weakref
+
+from large_image.cache_util import cachesClear
+from large_image.exceptions import TileSourceException
 import large_image_source_ometiff
 
 from . import utilities
 
 
+def writeOMETiff(path, frames, tileSize=64):
+    """
+    Write a single level OME TIFF file with one channel per frame from a list
+    of numpy arrays with a shape of (height, width, 1).
+    """
+    height, width = frames[0].shape[:2]
+    description = (
+        '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">'
+        '<Image ID="Image:0"><Pixels DimensionOrder="XYCZT" ID="Pixels:0" '
+        'SizeC="%d" SizeT="1" SizeZ="1" SizeX="%d" SizeY="%d" Type="uint8">' % (
+            len(frames), width, height) +
+        ''.join('<TiffData FirstC="%d" IFD="%d" PlaneCount="1">'
+                '<UUID FileName="image.ome.tif">urn:uuid:0</UUID></TiffData>' % (
+                    idx, idx) for idx in range(len(frames))) +
+        ''.join('<Plane TheC="%d" TheT="0" TheZ="0"/>' % idx for idx in range(len(frames))) +
+        '</Pixels></Image></OME>')
+    utilities.writeTiledTiff(path, frames, tileSize=tileSize, description=description)
+
+
 def testTilesFromOMETiff():
     imagePath = utilities.externaldata('data/sample.ome.tif.sha512')
     source = large_image_source_ometiff.OMETiffFileTileSource(imagePath)
@@ -17,3 +44,120 @@ def testTilesFromOMETiff():
     assert tileMetadata['levels'] == 3
     assert len(tileMetadata['frames']) == 3
     utilities.checkTilesZXY(source, tileMetadata)
+
+
+def testFrameDirectoryPool(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        large_image_source_ometiff.OMETiffFileTileSource, 'directoryPoolSize', 3)
+    imagePath = str(tmpdir.join('image.ome.tif'))
+    frames = [numpy.full((256, 256, 1), 40 * idx, dtype=numpy.uint8) for idx in range(5)]
+    writeOMETiff(imagePath, frames)
+    source = large_image_source_ometiff.OMETiffFileTileSource(imagePath)
+    assert len(source.getMetadata()['frames']) == 5
+    tile = source.getTile(1, 1, 2, frame=2, numpyAllowed=True)
+    assert tile.shape == (64, 64, 1)
+    assert (tile == 80).all()
+    # The neighboring frames are opened in the background
+    large_image_source_ometiff._getPrefetchPool().apply(lambda: None)
+    assert sorted(source._directoryPool) == [1, 2, 3]
+    # A prefetched frame is read from the pool, and stepping to it prefetches
+    # the next frame.  Directories are evicted in least recently used order.
+    prefetched = source._directoryPool[3]
+    tile = source.getTile(0, 0, 2, frame=3, numpyAllowed=True)
+    assert (tile == 120).all()
+    assert source._directoryPool[3] is prefetched
+    large_image_source_ometiff._getPrefetchPool().apply(lambda: None)
+    assert sorted(source._directoryPool) == [1, 3, 4]
+    # The first frame is a neighbor, too
+    source.getTile(0, 0, 2, frame=1, numpyAllowed=True)
+    large_image_source_ometiff._getPrefetchPool().apply(lambda: None)
+    assert sorted(source._directoryPool) == [0, 1, 2]
+    assert (source.getTile(0, 0, 2, frame=2, numpyAllowed=True) == 80).all()
+
+
+def testFrameDirectoryPrefetch(tmpdir):
+    imagePath = str(tmpdir.join('image.ome.tif'))
+    frames = [numpy.full((256, 256, 1), 40 * idx, dtype=numpy.uint8) for idx in range(5)]
+    writeOMETiff(imagePath, frames)
+    source = large_image_source_ometiff.OMETiffFileTileSource(imagePath)
+    # Hold the background thread so that prefetches stay queued
+    release = threading.Event()
+    large_image_source_ometiff._getPrefetchPool().apply_async(release.wait)
+    try:
+        source.getTile(0, 0, 2, frame=2, numpyAllowed=True)
+        source.getTile(0, 0, 2, frame=4, numpyAllowed=True)
+        # Frame 3 is only queued once
+        assert source._prefetchQueued == {1, 3}
+        # Queued work doesn't keep an evicted source alive
+        sourceRef = weakref.ref(source)
+        cachesClear()
+        del source
+        gc.collect()
+        assert sourceRef() is None
+    finally:
+        release.set()
+    large_image_source_ometiff._getPrefetchPool().apply(lambda: None)
+
+
+def testFrameDirectoryPrefetchError(tmpdir, monkeypatch):
+    imagePath = str(tmpdir.join('image.ome.tif'))
+    frames = [numpy.full((256, 256, 1), 40 * idx, dtype=numpy.uint8) for idx in range(5)]
+    writeOMETiff(imagePath, frames)
+    source = large_image_source_ometiff.OMETiffFileTileSource(imagePath)
+    source.getTile(0, 0, 2, frame=2, numpyAllowed=True)
+    large_image_source_ometiff._getPrefetchPool().apply(lambda: None)
+
+    def failOpen(dirnum):
+        raise RuntimeError('failed')
+
+    # A failed prefetch can be queued again
+    monkeypatch.setattr(source, '_openDirectory', failOpen)
+    source.getTile(0, 0, 2, frame=3, numpyAllowed=True)
+    large_image_source_ometiff._getPrefetchPool().apply(lambda: None)
+    assert 4 not in source._directoryPool
+    assert source._prefetchQueued == set()
+    monkeypatch.undo()
+    source.getTile(1, 0, 2, frame=3, numpyAllowed=True)
+    large_image_source_ometiff._getPrefetchPool().apply(lambda: None)
+    assert 4 in source._directoryPool
+
+
+def testCompositeTile(tmpdir):
+    imagePath = str(tmpdir.join('image.ome.tif'))
+    frames = [numpy.full((256, 256, 1), 40 * idx, dtype=numpy.uint8) for idx in range(5)]
+    frames[1][:, :128] = 200
+    writeOMETiff(imagePath, frames)
+    source = large_image_source_ometiff.OMETiffFileTileSource(imagePath)
+    channels = [
+        {'frame': 1, 'color': '#FF0000', 'min': 0, 'max': 200},
+        {'frame': 2},
+        {'frame': 4, 'color': 'blue', 'min': 80, 'max': 240},
+    ]
+    tile = source.getCompositeTile(1, 0, 2, channels, pilImageAllowed=True)
+    assert tile.size == (64, 64)
+    # The second channel uses the default color of green and the range of
+    # the data type.
+    assert numpy.asarray(tile)[0, 0].tolist() == [255, 80, 128]
+    tile = source.getCompositeTile(3, 0, 2, channels, pilImageAllowed=True)
+    assert numpy.asarray(tile)[0, 0].tolist() == [51, 80, 128]
+    # Equivalent requests share a cache entry
+    assert source.getCompositeTile(3, 0, 2, [
+        {'max': 200, 'frame': '1', 'color': 'red', 'min': 0},
+        {'frame': 2, 'color': 'lime'},
+        {'frame': 4, 'color': '#0000ff', 'min': 80, 'max': 240},
+    ], pilImageAllowed=True) is tile
+    # Single frame tiles are cached separately
+    assert (source.getTile(3, 0, 2, frame=1, numpyAllowed=True) == 40).all()
+    assert source.getCompositeTile(3, 0, 2, channels)[:3] == b'\xff\xd8\xff'
+    # Levels that aren't in the file are made for each frame
+    tile = source.getCompositeTile(
+        0, 0, 0, [{'frame': 0, 'max': 40}, {'frame': 2}], pilImageAllowed=True)
+    assert numpy.asarray(tile)[10, 10].tolist() == [0, 80, 0]
+    with pytest.raises(TileSourceException):
+        source.getCompositeTile(0, 0, 2, [{'frame': 5}])
+    with pytest.raises(TileSourceException):
+        source.getCompositeTile(0, 0, 2, [])
+    with pytest.raises(TileSourceException):
+        source.getCompositeTile(0, 0, 2, ['red'])
+    with pytest.raises(TileSourceException):
+        source.getCompositeTile(0, 0, 2, [{'frame': 1, 'min': 'low'}])
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import math
 import numpy
 import os
 import PIL.Image
 import pytest
 import struct
+from six import BytesIO
 
-from large_image import constants
+from large_image import config, constants
+from large_image.cache_util import getSynthesizedLevelCache
 import large_image_source_openslide
 
 from . import utilities
@@ -414,3 +417,99 @@ def testTilesFromSmallFile():
     assert tileMetadata['sizeY'] == 1
     assert tileMetadata['levels'] == 1
     utilities.checkTilesZXY(source, tileMetadata)
+
+
+@pytest.mark.parametrize('nativeSize,footprint,tiles', [
+    (256, 256, 1),
+    (256, 1024, 1),
+    (256, 384, 2),
+    (240, 256, 8),
+    (0, 256, 1),
+])
+def testSuperRegionTileCount(nativeSize, footprint, tiles):
+    source = large_image_source_openslide.OpenslideFileTileSource
+    assert source._superRegionTileCount(source, nativeSize, footprint) == tiles
+
+
+def testTilesFromSuperRegions(tmpdir, monkeypatch):
+    # Keep four of the full resolution super-regions
+    monkeypatch.setattr(large_image_source_openslide.OpenslideFileTileSource,
+                        'superRegionCacheBytes', 4 * (384 * 256 * 4 + 1024))
+    imagePath = str(tmpdir.join('image.tiff'))
+    yy, xx = numpy.mgrid[0:1000, 0:900]
+    data = numpy.dstack([xx // 4, yy // 4, (xx + yy) // 8]).astype(numpy.uint8)
+    utilities.writeTiledTiff(imagePath, data, tileSize=128)
+    source = large_image_source_openslide.OpenslideFileTileSource(imagePath)
+    assert [entry['superRegion'] for entry in source._svslevels] == [(1, 1)] * 4
+    tiles = {}
+    for z in (2, 3):
+        for y in range(int(math.ceil(1000 / 128.0 / 2 ** (3 - z)))):
+            for x in range(int(math.ceil(900 / 128.0 / 2 ** (3 - z)))):
+                tiles[(x, y, z)] = numpy.asarray(source._readRegion(
+                    x * 128 * 2 ** (3 - z), y * 128 * 2 ** (3 - z),
+                    source._svslevels[z], 128, 128))
+    source._svslevels[2]['superRegion'] = (2, 2)
+    source._svslevels[3]['superRegion'] = (3, 2)
+    for (x, y, z), expected in tiles.items():
+        tile = numpy.asarray(source.getTile(x, y, z, pilImageAllowed=True))
+        if z == 3:
+            assert numpy.array_equal(tile, expected)
+        else:
+            # Reduced super-regions are resampled across tile boundaries
+            assert numpy.abs(tile.astype(int) - expected).mean() < 1
+    # The full resolution level was read as 3 x 4 super-regions, and each
+    # source only keeps as many as fit in its byte limit
+    assert len([key for key in source._superRegions if key[0] == 3]) == 4
+    assert source._superRegions.currsize <= source.superRegionCacheBytes
+
+
+@pytest.mark.parametrize('rgbJpeg', [False, True])
+def testTilesFromTiffDirectory(tmpdir, rgbJpeg):
+    imagePath = str(tmpdir.join('image.tiff'))
+    yy, xx = numpy.mgrid[0:1000, 0:900]
+    data = numpy.dstack([xx // 4, yy // 4, (xx + yy) // 8]).astype(numpy.uint8)
+    utilities.writeTiledTiff(imagePath, data, tileSize=128, compression=7, rgbJpeg=rgbJpeg)
+    source = large_image_source_openslide.OpenslideFileTileSource(imagePath)
+    assert list(source._tiffDirectories) == [0]
+    # Full resolution tiles are the JPEGs stored in the file.  JPEGs that
+    # store RGB are marked as such.
+    tile = source.getTile(1, 2, 3)
+    stored = source._tiffDirectories[0].getTile(1, 2)
+    if rgbJpeg:
+        assert tile == large_image_source_openslide._markJpegRgb(stored) != stored
+    else:
+        assert tile == stored
+    expected = source._readRegion(128, 256, source._svslevels[3], 128, 128)
+    assert numpy.array_equal(
+        numpy.asarray(PIL.Image.open(BytesIO(tile))),
+        numpy.asarray(expected.convert('RGB')))
+    # Other levels are read through OpenSlide
+    tile = source.getTile(0, 0, 2, pilImageAllowed=True)
+    assert isinstance(tile, PIL.Image.Image)
+
+
+def testTilesFromSynthesizedLevels(tmpdir):
+    imagePath = str(tmpdir.join('image.tiff'))
+    cachePath = str(tmpdir.join('levels'))
+    yy, xx = numpy.mgrid[0:1000, 0:900]
+    data = numpy.dstack([xx // 4, yy // 4, (xx + yy) // 8]).astype(numpy.uint8)
+    utilities.writeTiledTiff(imagePath, data, tileSize=128)
+    config.setConfig('openslide_max_read_size', 256)
+    config.setConfig('cache_synthesized_levels_path', cachePath)
+    try:
+        source = large_image_source_openslide.OpenslideFileTileSource(imagePath)
+        assert [entry['synthesized'] for entry in source._svslevels] == [
+            True, True, False, False]
+        assert source.getPreferredLevel(0) == 0
+        assert source.getPreferredLevel(2) == 3
+        tile = source.getTile(0, 0, 0, pilImageAllowed=True)
+        assert tile.size == (128, 128)
+        expected = PIL.Image.fromarray(data).resize((113, 125), PIL.Image.LANCZOS)
+        diff = numpy.abs(numpy.asarray(tile.convert('RGB'))[:125, :113].astype(int) -
+                         numpy.asarray(expected))
+        assert diff[2:-2, 2:-2].mean() < 2
+        # The tile of level 0 and the four tiles of level 1 were stored
+        assert len(getSynthesizedLevelCache()) == 5
+    finally:
+        config.setConfig('openslide_max_read_size', None)
+        config.setConfig('cache_synthesized_levels_path', None)
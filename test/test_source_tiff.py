@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import numpy
 import os
+import PIL.Image
 import pytest
 import struct
+import threading
+from libtiff import libtiff_ctypes
 
-from large_image import constants
+from large_image import config, constants
+from large_image.tilesource import TILE_FORMAT_NUMPY
+from large_image.cache_util import cachesClear, getSynthesizedLevelCache
 import large_image_source_tiff
 
 from . import utilities
@@ -212,6 +218,124 @@ def testGetSingleTile():
     assert tile['iterator_range']['position'] == 33
 
 
+@pytest.mark.parametrize('readMode', ['mmap', 'pread'])
+def testSharedTileReads(readMode):
+    from large_image_source_tiff import tiff_reader
+
+    imagePath = utilities.externaldata('data/sample_image.ptif.sha512')
+    sharedFile = tiff_reader.SharedTiffFile(imagePath, readMode)
+    shared = tiff_reader.TiledTiffDirectory(imagePath, 0, sharedFile=sharedFile)
+    libtiffOnly = tiff_reader.TiledTiffDirectory(
+        imagePath, 0, sharedFile=tiff_reader.SharedTiffFile(imagePath, 'libtiff'))
+    frame = shared._getJpegFrame(shared._toTileNum(10, 5), True)
+    assert isinstance(frame, memoryview if readMode == 'mmap' else bytes)
+    for x, y in [(0, 0), (10, 5), (227, 47)]:
+        tile = shared.getTile(x, y)
+        assert isinstance(tile, bytes)
+        assert tile == libtiffOnly.getTile(x, y)
+    with pytest.raises(tiff_reader.InvalidOperationTiffException):
+        shared.getTile(228, 0)
+    # Raw reads don't open libtiff
+    assert sharedFile._libtiff is None
+
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    assert all(td._sharedFile is source._sharedFile
+               for td in source._tiffDirectories if td is not None)
+
+
+@pytest.mark.parametrize('readMode', ['mmap', 'pread', 'libtiff'])
+def testConcurrentTileReads(readMode):
+    imagePath = utilities.externaldata('data/sample_image.ptif.sha512')
+    config.setConfig('tiff_read_mode', readMode)
+    try:
+        cachesClear()
+        source = large_image_source_tiff.TiffFileTileSource(imagePath)
+        # Take tiles from every level, so that libtiff has to switch
+        # directories when it is used.
+        tiles = []
+        for z, directory in enumerate(source._tiffDirectories):
+            if directory is not None:
+                tiles.extend([(x, 0, z) for x in range(min(8, 2 ** z))])
+        expected = {
+            (x, y, z): source._tiffDirectories[z].getTile(x, y) for x, y, z in tiles}
+        errors = []
+
+        def readTiles(start):
+            try:
+                for _ in range(5):
+                    for x, y, z in tiles[start:] + tiles[:start]:
+                        if source._tiffDirectories[z].getTile(x, y) != expected[(x, y, z)]:
+                            errors.append((x, y, z))
+                    source.getTile(*tiles[start])
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=readTiles, args=(idx % len(tiles), ))
+                   for idx in range(32)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+    finally:
+        config.setConfig('tiff_read_mode', 'mmap')
+        cachesClear()
+
+
+def testTileOffsetArrays():
+    from large_image_source_tiff import tiff_reader
+
+    imagePath = utilities.externaldata('data/sample_image.ptif.sha512')
+    directory = tiff_reader.TiledTiffDirectory(imagePath, 0)
+    assert len(directory._tileOffsets) == 228 * 48
+    assert len(directory._tileByteCounts) == 228 * 48
+    assert directory._toTileNum(10, 5) == 5 * 228 + 10
+    tileNum = directory._toTileNum(10, 5)
+    assert directory._getJpegFrameSize(tileNum) == len(directory._getJpegFrame(tileNum, True))
+    assert directory.getTileOffset(10, 5) == int(directory._tileOffsets[tileNum])
+    assert directory.getTileOffset(228, 0) is None
+    for x, y in [(-1, 0), (228, 0), (0, 48)]:
+        with pytest.raises(tiff_reader.InvalidOperationTiffException):
+            directory._toTileNum(x, y)
+
+
+@pytest.mark.parametrize('filename', [
+    'grey10kx5k.tif',
+    'rgb_geotiff.tiff',
+    'small_la.tiff',
+])
+def testReadTiffDirectories(filename):
+    from large_image_source_tiff import tiff_ifd, tiff_reader
+
+    testDir = os.path.dirname(os.path.realpath(__file__))
+    imagePath = os.path.join(testDir, 'test_files', filename)
+    directories = tiff_ifd.readTiffDirectories(imagePath)
+    assert len(directories) >= 1
+    for directoryNum, info in enumerate(directories):
+        directory = tiff_reader.TiledTiffDirectory(imagePath, directoryNum, mustBeTiled=None)
+        for key in {'imagewidth', 'imagelength', 'tilewidth', 'tilelength', 'bitspersample',
+                    'samplesperpixel', 'compression', 'photometric', 'planarconfig',
+                    'sampleformat', 'imagedescription', 'istiled'}:
+            assert info.get(key) == directory._tiffInfo.get(key)
+        if info.get('istiled'):
+            assert (info['tileoffsets'] == directory._tileOffsets).all()
+            assert (info['tilebytecounts'] == directory._tileByteCounts).all()
+        parsed = tiff_reader.TiledTiffDirectory(
+            imagePath, directoryNum, mustBeTiled=None, tiffInfo=info)
+        assert parsed._sharedFile._libtiff is None
+        assert parsed.imageWidth == directory.imageWidth
+        assert parsed.pixelInfo == directory.pixelInfo
+
+
+def testReadTiffDirectoriesNotTiff():
+    from large_image_source_tiff import tiff_ifd
+
+    testDir = os.path.dirname(os.path.realpath(__file__))
+    imagePath = os.path.join(testDir, 'test_files', 'notanimage.txt')
+    with pytest.raises(ValueError):
+        tiff_ifd.readTiffDirectories(imagePath)
+
+
 def testTilesFromPTIFJpeg2K():
     imagePath = utilities.externaldata('data/huron.image2_jpeg2k.tif.sha512')
     source = large_image_source_tiff.TiffFileTileSource(imagePath)
@@ -457,6 +581,28 @@ def testTilesAssociatedImages():
     assert source.getAssociatedImage('nosuchimage') is None
 
 
+def testLazyDirectories(monkeypatch):
+    decoded = []
+    readImage = libtiff_ctypes.TIFF.read_image
+
+    def countedReadImage(tiff, *args, **kwargs):
+        decoded.append(tiff)
+        return readImage(tiff, *args, **kwargs)
+
+    monkeypatch.setattr(libtiff_ctypes.TIFF, 'read_image', countedReadImage)
+    imagePath = utilities.externaldata('data/sample_image.ptif.sha512')
+    cachesClear()
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    # Associated images are listed but not decoded until they are requested
+    assert 'label' in source.getAssociatedImagesList()
+    assert 'macro' in source.getAssociatedImagesList()
+    source.getTile(0, 0, source.levels - 1)
+    assert not decoded
+    image, mimeType = source.getAssociatedImage('label', encoding='PNG')
+    assert image[:len(utilities.PNGHeader)] == utilities.PNGHeader
+    assert len(decoded) == 1
+
+
 def testTilesFromSCN():
     imagePath = utilities.externaldata('data/sample_leica.scn.sha512')
     source = large_image_source_tiff.TiffFileTileSource(imagePath)
@@ -468,3 +614,133 @@ def testTilesFromSCN():
     assert tileMetadata['levels'] == 5
     assert tileMetadata['magnification'] == 20
     utilities.checkTilesZXY(source, tileMetadata)
+
+
+@pytest.mark.parametrize('dtype,samples,compression,predictor,planar,byteOrder,readMode', [
+    ('uint8', 3, 1, 1, 1, '<', 'mmap'),
+    ('uint16', 1, 1, 1, 1, '<', 'mmap'),
+    ('uint16', 1, 1, 1, 1, '>', 'pread'),
+    ('uint16', 5, 8, 2, 1, '<', 'mmap'),
+    ('uint16', 5, 8, 2, 1, '<', 'libtiff'),
+    ('int16', 2, 8, 1, 2, '>', 'mmap'),
+    ('uint32', 3, 8, 2, 1, '>', 'mmap'),
+    ('float32', 4, 8, 1, 2, '<', 'mmap'),
+    ('float64', 1, 1, 1, 1, '>', 'libtiff'),
+])
+def testDecodedTiles(tmpdir, dtype, samples, compression, predictor, planar, byteOrder,
+                     readMode):
+    imagePath = str(tmpdir.join('image.tiff'))
+    data = numpy.random.RandomState(0).rand(150, 170, samples)
+    if numpy.dtype(dtype).kind != 'f':
+        data = (data * numpy.iinfo(dtype).max).astype(dtype)
+    data = data.astype(dtype)
+    utilities.writeTiledTiff(imagePath, data, compression=compression, predictor=predictor,
+                             planar=planar, byteOrder=byteOrder)
+    config.setConfig('tiff_read_mode', readMode)
+    try:
+        source = large_image_source_tiff.TiffFileTileSource(imagePath)
+        tile = source.getTile(1, 2, source.levels - 1, numpyAllowed=True)
+        assert tile.dtype == numpy.dtype(dtype)
+        assert tile.shape == (64, 64, samples)
+        assert (tile[:22] == data[128:, 64:128]).all()
+        # The full bit depth is kept when getting a region as a numpy array
+        region, format = source.getRegion(format=TILE_FORMAT_NUMPY)
+        assert format == TILE_FORMAT_NUMPY
+        if dtype != 'uint8':
+            assert region.dtype == numpy.dtype(dtype)
+            assert (region == data).all()
+        # Tiles are converted to 8-bit only when they are encoded
+        image = source.getTile(0, 0, source.levels - 1)
+        assert image[:len(utilities.JPEGHeader)] == utilities.JPEGHeader
+    finally:
+        config.setConfig('tiff_read_mode', 'mmap')
+        cachesClear()
+
+
+def testDecodedTilesIterator(tmpdir):
+    imagePath = str(tmpdir.join('image.tiff'))
+    data = (numpy.random.RandomState(0).rand(150, 170, 5) * 65535).astype(numpy.uint16)
+    utilities.writeTiledTiff(imagePath, data, compression=8, predictor=2)
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    tiles = list(source.tileIterator(
+        format=TILE_FORMAT_NUMPY, region={'left': 10, 'top': 20, 'width': 100, 'height': 70}))
+    assert len(tiles) == 4
+    for tile in tiles:
+        assert tile['format'] == TILE_FORMAT_NUMPY
+        assert tile['tile'].dtype == numpy.uint16
+        assert tile['tile'].shape[2] == 5
+        assert (tile['tile'] == data[
+            tile['y']:tile['y'] + tile['height'], tile['x']:tile['x'] + tile['width']]).all()
+    # As PIL images, tiles are 8-bit images of the first band
+    tile = next(source.tileIterator(
+        format=constants.TILE_FORMAT_PIL, region={'width': 64, 'height': 64}))
+    assert tile['tile'].mode == 'L'
+    assert numpy.array_equal(numpy.asarray(tile['tile']), (data[:64, :64, 0] >> 8).astype(
+        numpy.uint8))
+
+
+def testDecodedRegionFill(tmpdir):
+    imagePath = str(tmpdir.join('image.tiff'))
+    data = (numpy.random.RandomState(0).rand(150, 170, 5) * 65535).astype(numpy.uint16)
+    utilities.writeTiledTiff(imagePath, data, compression=8, predictor=2)
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    output = {'maxWidth': 100, 'maxHeight': 100}
+    region, _ = source.getRegion(output=output, fill='none', format=TILE_FORMAT_NUMPY)
+    assert region.shape == (88, 100, 5)
+    assert region.dtype == numpy.uint16
+    # Other fill values letterbox the region with zeros
+    region, _ = source.getRegion(output=output, fill='#ff0000', format=TILE_FORMAT_NUMPY)
+    assert region.shape == (100, 100, 5)
+    assert not region[:6].any() and not region[-6:].any()
+
+
+def testTilesFromEmptyDirectoryJpeg(tmpdir):
+    imagePath = str(tmpdir.join('image.tiff'))
+    yy, xx = numpy.mgrid[0:1024, 0:1024]
+    data = numpy.dstack([xx // 4, yy // 4, (xx + yy) // 8]).astype(numpy.uint8)
+    utilities.writeTiledTiff(imagePath, data, tileSize=128, compression=7)
+    source = large_image_source_tiff.TiffFileTileSource(imagePath)
+    assert source.levels == 4
+    assert [td is None for td in source._tiffDirectories] == [True, True, True, False]
+    # Lower levels are made by decoding the JPEG tiles at a reduced size
+    for z, scale in ((2, 2), (1, 4), (0, 8)):
+        tile = source.getTile(0, 0, z, pilImageAllowed=True)
+        assert tile.size == (128, 128)
+        expected = PIL.Image.fromarray(data[:128 * scale, :128 * scale]).resize(
+            (128, 128), PIL.Image.LANCZOS)
+        diff = numpy.abs(numpy.asarray(tile.convert('RGB')).astype(int) -
+                         numpy.asarray(expected))
+        assert diff.mean() < 2
+
+
+def testTilesFromEmptyDirectoryDiskCache(tmpdir):
+    imagePath = str(tmpdir.join('image.tiff'))
+    cachePath = str(tmpdir.join('levels'))
+    yy, xx = numpy.mgrid[0:1024, 0:1024]
+    data = numpy.dstack([xx // 4, yy // 4, (xx + yy) // 8]).astype(numpy.uint8)
+    utilities.writeTiledTiff(imagePath, data, tileSize=128, compression=7)
+    config.setConfig('cache_synthesized_levels_path', cachePath)
+    # Wait for the cache's initial scan so that it only counts these tiles
+    getSynthesizedLevelCache()._waitForScan()
+    try:
+        source = large_image_source_tiff.TiffFileTileSource(imagePath)
+        tiles = {z: source.getTile(0, 0, z, pilImageAllowed=True) for z in range(3)}
+        # Each level is made from the next level, so the tile of level 0 also
+        # makes and stores all of the tiles of levels 1 and 2.
+        assert len(getSynthesizedLevelCache()) == 1 + 4 + 16
+        for z, scale in ((2, 2), (1, 4), (0, 8)):
+            expected = PIL.Image.fromarray(data[:128 * scale, :128 * scale]).resize(
+                (128, 128), PIL.Image.LANCZOS)
+            diff = numpy.abs(numpy.asarray(tiles[z].convert('RGB')).astype(int) -
+                             numpy.asarray(expected))
+            assert diff.mean() < 2
+        # A new source reads the stored tiles rather than making them
+        cachesClear()
+        source = large_image_source_tiff.TiffFileTileSource(imagePath)
+        source._tiffDirectories[-1] = None
+        for z in range(3):
+            tile = source.getTile(0, 0, z, pilImageAllowed=True)
+            assert tile.format == 'PNG'
+            assert numpy.array_equal(numpy.asarray(tile), numpy.asarray(tiles[z]))
+    finally:
+        config.setConfig('cache_synthesized_levels_path', None)
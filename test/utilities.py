@@ -1,8 +1,13 @@
 import math
+import numpy
 import os
+import PIL.Image
 import pytest
 import requests
 import six
+import struct
+import zlib
+from six import BytesIO
 
 
 JFIFHeader = b'\xff\xd8\xff\xe0\x00\x10JFIF'
@@ -92,3 +97,94 @@ def checkTilesZXY(source, metadata, tileParams=None, imgHeader=JPEGHeader):
     # Check too large z level
     with pytest.raises(Exception):
         source.getTile(0, 0, metadata['levels'], **tileParams)
+
+
+def writeTiledTiff(path, data, tileSize=64, compression=1, predictor=1, planar=1,
+                   byteOrder='<', description=None, rgbJpeg=False):
+    """
+    Write a tiled TIFF file from a numpy array with a shape of (height, width,
+    samples), or from a list of such arrays, one per directory.  JPEG
+    compressed tiles are complete JPEG files.  A description is stored in the
+    first directory.  If rgbJpeg is True, color JPEG tiles store RGB rather
+    than YCbCr without a marker that says so, as some Aperio files do.
+    """
+    fileData = bytearray((b'II' if byteOrder == '<' else b'MM') +
+                         struct.pack(byteOrder + 'HI', 42, 0))
+    nextOffsetPos = 4
+    for page in (data if isinstance(data, list) else [data]):
+        height, width, samples = page.shape
+        tiles = _tiledTiffTiles(
+            page, tileSize, compression, predictor, planar, byteOrder, rgbJpeg)
+        offsets = [len(fileData) + sum(len(tile) for tile in tiles[:idx])
+                   for idx in range(len(tiles))]
+        fileData += b''.join(tiles)
+        # PIL stores color JPEGs as YCbCr
+        photometric = (6 if compression == 7 and not rgbJpeg else 2) if samples == 3 else 1
+        entries = [
+            (256, 'I', [width]), (257, 'I', [height]),
+            (258, 'H', [page.dtype.itemsize * 8] * samples), (259, 'H', [compression]),
+            (262, 'H', [photometric]), (277, 'H', [samples]),
+            (284, 'H', [planar]), (317, 'H', [predictor]), (322, 'H', [tileSize]),
+            (323, 'H', [tileSize]), (324, 'I', offsets),
+            (325, 'I', [len(tile) for tile in tiles]),
+            (339, 'H', [{'u': 1, 'i': 2, 'f': 3}[page.dtype.kind]] * samples)]
+        if description is not None:
+            entries.insert(5, (270, 's', description.encode('utf8') + b'\0'))
+            description = None
+        ifdOffset = len(fileData)
+        fileData[nextOffsetPos:nextOffsetPos + 4] = struct.pack(byteOrder + 'I', ifdOffset)
+        nextOffsetPos = ifdOffset + 2 + 12 * len(entries)
+        extraOffset = nextOffsetPos + 4
+        ifd = struct.pack(byteOrder + 'H', len(entries))
+        extra = b''
+        for tag, valueType, values in entries:
+            if valueType == 's':
+                value = values
+            else:
+                value = struct.pack(byteOrder + valueType * len(values), *values)
+            ifd += struct.pack(byteOrder + 'HHI', tag, {'s': 2, 'H': 3, 'I': 4}[valueType],
+                               len(values))
+            if len(value) <= 4:
+                ifd += value.ljust(4, b'\0')
+            else:
+                ifd += struct.pack(byteOrder + 'I', extraOffset + len(extra))
+                extra += value
+        fileData += ifd + struct.pack(byteOrder + 'I', 0) + extra
+    with open(path, 'wb') as fptr:
+        fptr.write(fileData)
+
+
+def _tiledTiffTiles(data, tileSize, compression, predictor, planar, byteOrder, rgbJpeg):
+    """
+    Encode the tiles of one directory for writeTiledTiff.
+    """
+    samples = data.shape[2]
+    planes = [data] if planar == 1 else [data[:, :, s:s + 1] for s in range(samples)]
+    tiles = []
+    for plane in planes:
+        for y in range(0, data.shape[0], tileSize):
+            for x in range(0, data.shape[1], tileSize):
+                tile = numpy.zeros((tileSize, tileSize, plane.shape[2]), dtype=data.dtype)
+                part = plane[y:y + tileSize, x:x + tileSize]
+                tile[:part.shape[0], :part.shape[1]] = part
+                if predictor == 2:
+                    tile[:, 1:] = numpy.diff(tile, axis=1)
+                if compression == 7:
+                    output = BytesIO()
+                    if rgbJpeg and tile.shape[2] == 3:
+                        # Saving the RGB values as YCbCr stores them without
+                        # conversion; drop the JFIF marker that says the
+                        # data is YCbCr.
+                        PIL.Image.frombytes('YCbCr', (tileSize, tileSize), tile.tobytes()).save(
+                            output, 'JPEG', quality=95)
+                        jpeg = output.getvalue()
+                        if jpeg[2:4] == b'\xff\xe0':
+                            jpeg = jpeg[:2] + jpeg[4 + struct.unpack('>H', jpeg[4:6])[0]:]
+                        tiles.append(jpeg)
+                        continue
+                    PIL.Image.fromarray(tile).save(output, 'JPEG', quality=95)
+                    tiles.append(output.getvalue())
+                    continue
+                tile = tile.astype(data.dtype.newbyteorder(byteOrder)).tobytes()
+                tiles.append(zlib.compress(tile) if compression == 8 else tile)
+    return tiles